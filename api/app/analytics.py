@@ -0,0 +1,236 @@
+"""Contains models for usage analytics, and how usage records are rolled up into
+hourly, daily and weekly totals.
+
+Every usage record adds to the totals of its machine and of its floor: the
+number of cycles and their summed length, counted in the hour and day each cycle
+started, and the time the machine was busy, split across every hour it spans.
+Totals are kept in the local time of the laundry rooms, see
+`analytics_utc_offset` in app.config."""
+
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Dict, List, Optional, Protocol, abstractmethod
+
+from app.usage import UsageDetail
+from pydantic import BaseModel, Field
+
+# Totals of one period: cycles, cycle_seconds and busy_seconds.
+Totals = Dict[str, Dict[str, float]]
+
+# Longest a cycle is counted for. Longer usage records are machines left on or
+# sensors stuck, and clipping them bounds the rollups one record touches, and
+# how far back the records overlapping a range can have started.
+max_cycle = timedelta(hours=4)
+
+
+class Granularity(str, Enum):
+    """Length of the periods usage is totalled over."""
+
+    hour = "hour"
+    day = "day"
+
+
+class Source(str, Enum):
+    """Where usage totals are read from."""
+
+    rollups = "rollups"
+    records = "records"
+
+
+_period = {Granularity.hour: timedelta(hours=1), Granularity.day: timedelta(days=1)}
+
+# Longest range usage is reported over, per granularity, bounding the buckets
+# one request builds.
+max_range = {
+    Granularity.hour: timedelta(days=366),
+    Granularity.day: timedelta(days=5 * 366),
+}
+_period_format = {Granularity.hour: "H#%Y-%m-%dT%H", Granularity.day: "D#%Y-%m-%d"}
+
+
+def period_key(g: Granularity, at: datetime) -> str:
+    return at.strftime(_period_format[g])
+
+
+def profile_key(weekday: int, hour: int) -> str:
+    return f"W#{weekday}#{hour:02d}"
+
+
+def machine_scope(floor: int, pos: int) -> str:
+    return f"machine:{floor}:{pos}"
+
+
+def floor_scope(floor: int) -> str:
+    return f"floor:{floor}"
+
+
+def contributions(ud: UsageDetail, utc_offset: timedelta) -> Totals:
+    """Returns what one usage record adds to the totals of each hour, day and
+    hour of the week, keyed by period_key and profile_key."""
+    started = ud.started_at + utc_offset
+    stopped = min(ud.stopped_at + utc_offset, started + max_cycle)
+    totals: Totals = defaultdict(Counter)
+    cycle_seconds = max((stopped - started).total_seconds(), 0)
+    for key in (
+        period_key(Granularity.hour, started),
+        period_key(Granularity.day, started),
+        profile_key(started.weekday(), started.hour),
+    ):
+        totals[key]["cycles"] += 1
+        totals[key]["cycle_seconds"] += cycle_seconds
+
+    hour = started.replace(minute=0, second=0, microsecond=0)
+    while hour < stopped:
+        next_hour = hour + _period[Granularity.hour]
+        busy = (min(stopped, next_hour) - max(started, hour)).total_seconds()
+        for key in (
+            period_key(Granularity.hour, hour),
+            period_key(Granularity.day, hour),
+            profile_key(hour.weekday(), hour.hour),
+        ):
+            totals[key]["busy_seconds"] += busy
+        hour = next_hour
+    return totals
+
+
+class UsageBucket(BaseModel):
+    """Usage totals over one period."""
+
+    start: datetime = Field(..., description="Start of the period, in local time.")
+    cycles: int = Field(..., description="Number of cycles started in the period.")
+    busy_seconds: float = Field(
+        ..., description="Total time machines were busy in the period, in seconds."
+    )
+    utilisation: float = Field(
+        ..., description="Fraction of the period the machines were busy, from 0 to 1."
+    )
+    avg_cycle_seconds: Optional[float] = Field(
+        None,
+        description="Average length of the cycles started in the period, in seconds.",
+    )
+
+
+class UsageReport(UsageBucket):
+    """Usage of a machine or floor over a range of time, and per period."""
+
+    floor: int = Field(..., description="Self explanatory.")
+    pos: Optional[int] = Field(
+        None, description="Position of the machine, or null for the whole floor."
+    )
+    end: datetime = Field(..., description="End of the range, in local time.")
+    granularity: Granularity = Field(..., description="Length of each period.")
+    machines: int = Field(..., description="Number of machines counted.")
+    source: Source = Field(..., description="Where the totals were read from.")
+    buckets: List[UsageBucket] = Field(
+        ..., description="Totals of every period in the range, oldest first."
+    )
+
+
+class BusyHour(BaseModel):
+    """Usage totals of one hour of the week."""
+
+    weekday: int = Field(..., description="Day of the week, 0 being Monday.")
+    hour: int = Field(..., description="Hour of the day, in local time.")
+    cycles: int = Field(..., description="Number of cycles started in this hour.")
+    busy_seconds: float = Field(
+        ..., description="Total time machines were busy in this hour, in seconds."
+    )
+    share: float = Field(
+        ..., description="Fraction of all busy time which fell in this hour."
+    )
+
+
+class IAnalyticsService(Protocol):
+    """'Interface' declaration for the methods an analytics service should implement."""
+
+    @abstractmethod
+    async def usage(
+        self,
+        floor: int,
+        pos: Optional[int],
+        start: datetime,
+        end: datetime,
+        granularity: Granularity,
+        source: Optional[Source],
+    ) -> UsageReport:
+        pass
+
+    @abstractmethod
+    async def busiest_hours(
+        self, floor: int, pos: Optional[int], limit: int, source: Optional[Source]
+    ) -> List[BusyHour]:
+        pass
+
+
+def bucket(start: datetime, period: timedelta, machines: int, totals) -> dict:
+    """Returns the fields of a UsageBucket from the totals of a period."""
+    cycles = int(totals.get("cycles", 0))
+    busy = float(totals.get("busy_seconds", 0))
+    cycle_seconds = float(totals.get("cycle_seconds", 0))
+    return {
+        "start": start,
+        "cycles": cycles,
+        "busy_seconds": busy,
+        "utilisation": busy / (period.total_seconds() * machines) if machines else 0,
+        "avg_cycle_seconds": cycle_seconds / cycles if cycles else None,
+    }
+
+
+def report_buckets(
+    start: datetime,
+    end: datetime,
+    g: Granularity,
+    machines: int,
+    totals: Totals,
+) -> List[UsageBucket]:
+    """Returns a bucket for every period from the one containing `start` up to
+    `end`, including periods without any usage."""
+    at = datetime.combine(start.date(), datetime.min.time())
+    if g == Granularity.hour:
+        at = start.replace(minute=0, second=0, microsecond=0)
+    buckets = []
+    while at < end:
+        totals_at = totals.get(period_key(g, at), {})
+        buckets.append(UsageBucket(**bucket(at, _period[g], machines, totals_at)))
+        at += _period[g]
+    return buckets
+
+
+def busy_hours(profile: Totals) -> List[BusyHour]:
+    """Returns every hour of the week in the profile, busiest first."""
+    total = sum(t.get("busy_seconds", 0) for t in profile.values())
+    hours = []
+    for key, t in profile.items():
+        _, weekday, hour = key.split("#")
+        busy = float(t.get("busy_seconds", 0))
+        hours.append(
+            BusyHour(
+                weekday=int(weekday),
+                hour=int(hour),
+                cycles=int(t.get("cycles", 0)),
+                busy_seconds=busy,
+                share=busy / float(total) if total else 0,
+            )
+        )
+    return sorted(hours, key=lambda h: (-h.busy_seconds, h.weekday, h.hour))
+
+
+def summarise(
+    start: datetime, end: datetime, g: Granularity, machines: int, totals: Totals
+) -> dict:
+    """Returns the fields of a UsageReport over every period from `start` to
+    `end`, other than where it is for and where it was read from."""
+    buckets = report_buckets(start, end, g, machines, totals)
+    summed: Counter = Counter()
+    for b in buckets:
+        summed["cycles"] += b.cycles
+        summed["busy_seconds"] += b.busy_seconds
+        summed["cycle_seconds"] += (b.avg_cycle_seconds or 0) * b.cycles
+    return {
+        **bucket(start, len(buckets) * _period[g], machines, summed),
+        "end": end,
+        "granularity": g,
+        "machines": machines,
+        "buckets": buckets,
+    }
@@ -16,6 +16,15 @@ class Settings(BaseSettings):
     dynamodb_url: Optional[str]
     dynamodb_region: str = Field(..., env="DYNAMODB_REGION")
     dynamodb_usage_table: str = Field(..., env="DYNAMODB_USAGE_TABLE")
+    dynamodb_rollup_table: str = Field(..., env="DYNAMODB_ROLLUP_TABLE")
+
+    # Hours the local time of the laundry rooms is ahead of UTC. Usage rollups
+    # are totalled in local time as they are written, see app.analytics.
+    analytics_utc_offset: int = Field(8, env="ANALYTICS_UTC_OFFSET")
+
+    # Seconds without a heartbeat after which the machines of a raspi are
+    # flagged as errors, see app.worker.
+    raspi_stale_after: int = Field(1800, env="RASPI_STALE_AFTER")
 
     class Config:
         env_file = ".env.local"
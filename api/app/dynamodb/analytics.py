@@ -0,0 +1,254 @@
+"""Contains the analytics service, which reads usage totals from the rollup table
+and falls back to the usage records themselves.
+
+The rollup table is keyed by `scope`, either `machine:<floor>:<pos>` or
+`floor:<floor>`, and `period`, one of `H#<yyyy-mm-ddThh>`, `D#<yyyy-mm-dd>` or
+`W#<weekday>#<hh>` for an hour of the week. Rollups are updated in the same
+transaction as the usage records they count, see write_usage in
+app.dynamodb.usage. Neither table is ever scanned: rollups are read with a Query
+over one scope, and usage records with a Query over one loc and a range of
+started_at."""
+
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from app import utc
+from app.analytics import (
+    BusyHour,
+    Granularity,
+    IAnalyticsService,
+    Source,
+    Totals,
+    UsageReport,
+    busy_hours,
+    contributions,
+    floor_scope,
+    machine_scope,
+    max_cycle,
+    max_range,
+    period_key,
+    summarise,
+)
+from app.config import get_settings
+from app.machine import IMachineService, Machine, MachineFilter
+from app.redis.machine import get_machine_service
+from app.usage import UsageDetail
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from fastapi import status
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import HTTPException
+from fastapi.logger import logger
+from starlette.concurrency import run_in_threadpool
+
+from . import get_dynamodb
+
+# Weeks of usage records the busiest hours are computed from, when the rollups
+# cannot be read.
+profile_weeks = 12
+
+_totals = ["cycles", "cycle_seconds", "busy_seconds"]
+
+
+def utc_offset() -> timedelta:
+    return timedelta(hours=get_settings().analytics_utc_offset)
+
+
+def local_time(at: datetime) -> datetime:
+    """Converts a time with a time zone to naive local time, leaving naive times,
+    which already are, as they are."""
+    return at if at.tzinfo is None else utc.naive(at) + utc_offset()
+
+
+def rollup_transaction(uds: List[UsageDetail]) -> List[Dict[str, Any]]:
+    """Returns the TransactWriteItems which write usage records and add them to
+    the rollups of their machines and floors. The Put of each record comes
+    first, in the order given, and is only applied if the record was not
+    already written, so a record delivered twice is counted once. What the
+    records add to each rollup is summed into one update, as a transaction may
+    not touch an item twice."""
+    settings = get_settings()
+    items = []
+    rollups: Dict[Tuple[str, str], Counter] = defaultdict(Counter)
+    for ud in uds:
+        item = {k: {"S": v} for k, v in jsonable_encoder(ud).items()}
+        items.append(
+            {
+                "Put": {
+                    "TableName": settings.dynamodb_usage_table,
+                    "Item": item,
+                    "ConditionExpression": "attribute_not_exists(#loc)",
+                    "ExpressionAttributeNames": {"#loc": "loc"},
+                }
+            }
+        )
+        _, floor, pos = ud.loc.split(":")
+        for scope in (machine_scope(int(floor), int(pos)), floor_scope(int(floor))):
+            for period, totals in contributions(ud, utc_offset()).items():
+                rollups[(scope, period)].update(totals)
+
+    for (scope, period), totals in rollups.items():
+        adds = ", ".join(f"#{k} :{k}" for k in totals)
+        items.append(
+            {
+                "Update": {
+                    "TableName": settings.dynamodb_rollup_table,
+                    "Key": {"scope": {"S": scope}, "period": {"S": period}},
+                    "UpdateExpression": f"ADD {adds}",
+                    "ExpressionAttributeNames": {f"#{k}": k for k in totals},
+                    "ExpressionAttributeValues": {
+                        f":{k}": {"N": str(v)} for k, v in totals.items()
+                    },
+                }
+            }
+        )
+    return items
+
+
+def query_all(table: Any, **kwargs) -> List[Dict[str, Any]]:
+    """Runs a Query, following LastEvaluatedKey until every page is read."""
+    items = []
+    while True:
+        res = table.query(**kwargs)
+        items += res.get("Items", [])
+        if "LastEvaluatedKey" not in res:
+            return items
+        kwargs["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+
+
+class AnalyticsService(IAnalyticsService):
+    """Service class implementing the IAnalyticsService interface,
+    with DynamoDB as the datastore."""
+
+    def __init__(self, db: Any, ms: IMachineService):
+        settings = get_settings()
+        self.usage_table = db.Table(settings.dynamodb_usage_table)
+        self.rollup_table = db.Table(settings.dynamodb_rollup_table)
+        self.ms = ms
+
+    async def usage(
+        self,
+        floor: int,
+        pos: Optional[int],
+        start: datetime,
+        end: datetime,
+        granularity: Granularity = Granularity.hour,
+        source: Optional[Source] = None,
+    ) -> UsageReport:
+        """Returns the usage of a machine, or of every machine on a floor if
+        `pos` is None, from `start` to `end` in local time. Times with a time
+        zone are converted to local time."""
+        start, end = local_time(start), local_time(end)
+        if end <= start:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, detail="end must be after start."
+            )
+        if end - start > max_range[granularity]:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST,
+                detail=f"The range may be at most {max_range[granularity].days} days long for {granularity.value} buckets.",
+            )
+        machines = await self.machines(floor, pos)
+        lo, hi = period_key(granularity, start), period_key(granularity, end)
+        totals, source = await self.read(
+            floor,
+            pos,
+            source,
+            lambda scope: self.read_rollups(scope, lo, hi),
+            lambda: self.read_records(machines, start, end),
+        )
+        return UsageReport(
+            **summarise(start, end, granularity, len(machines), totals),
+            floor=floor,
+            pos=pos,
+            source=source,
+        )
+
+    async def busiest_hours(
+        self,
+        floor: int,
+        pos: Optional[int],
+        limit: int = 10,
+        source: Optional[Source] = None,
+    ) -> List[BusyHour]:
+        """Returns the busiest hours of the week of a machine or floor, busiest
+        first. Rollups cover all time, usage records the last few weeks."""
+        machines = await self.machines(floor, pos)
+        end = datetime.utcnow() + utc_offset()
+        profile, _ = await self.read(
+            floor,
+            pos,
+            source,
+            lambda scope: self.read_rollups(scope, "W#", "W#~"),
+            lambda: self.read_records(
+                machines, end - timedelta(weeks=profile_weeks), end
+            ),
+        )
+        profile = {k: v for k, v in profile.items() if k.startswith("W#")}
+        return busy_hours(profile)[:limit]
+
+    async def read(
+        self, floor: int, pos: Optional[int], source: Optional[Source], rollups, records
+    ) -> Tuple[Totals, Source]:
+        """Reads totals from the rollups, or from the usage records if asked
+        to or if the rollup table cannot be read."""
+        scope = floor_scope(floor) if pos is None else machine_scope(floor, pos)
+        if source != Source.records:
+            try:
+                return await run_in_threadpool(rollups, scope), Source.rollups
+            except ClientError as e:
+                if source == Source.rollups:
+                    raise
+                code = e.response.get("Error", {}).get("Code")
+                logger.warning(f"Reading usage records, as rollups failed: {code}")
+        return await run_in_threadpool(records), Source.records
+
+    async def machines(self, floor: int, pos: Optional[int]) -> List[Machine]:
+        machines = await self.ms.find(MachineFilter(floor=floor, pos=pos))
+        if not machines:
+            at = f"floor {floor}" if pos is None else f"floor {floor} position {pos}"
+            raise HTTPException(
+                status.HTTP_404_NOT_FOUND, detail=f"No machines were found at {at}."
+            )
+        return machines
+
+    def read_rollups(self, scope: str, lo: str, hi: str) -> Totals:
+        in_range = Key("scope").eq(scope) & Key("period").between(lo, hi)
+        items = query_all(
+            self.rollup_table,
+            KeyConditionExpression=in_range,
+            ProjectionExpression="#p, " + ", ".join(f"#{k}" for k in _totals),
+            ExpressionAttributeNames={"#p": "period", **{f"#{k}": k for k in _totals}},
+        )
+        return {item["period"]: item for item in items}
+
+    def read_records(
+        self, machines: List[Machine], start: datetime, end: datetime
+    ) -> Totals:
+        """Totals the usage records of the machines which overlap `start` to
+        `end`, in local time, the same way the rollups are totalled."""
+        offset = utc_offset()
+        lo = jsonable_encoder(start - offset - max_cycle)
+        hi = jsonable_encoder(end - offset)
+        totals: Totals = defaultdict(Counter)
+        for m in machines:
+            loc = m.create_typed_key()
+            in_range = Key("loc").eq(loc) & Key("started_at").between(lo, hi)
+            items = query_all(
+                self.usage_table,
+                KeyConditionExpression=in_range,
+                ProjectionExpression="started_at, stopped_at",
+            )
+            for item in items:
+                ud = UsageDetail(loc=loc, **item)
+                for period, t in contributions(ud, offset).items():
+                    totals[period].update(t)
+        return totals
+
+
+@lru_cache()
+def get_analytics_service() -> AnalyticsService:
+    """Fastapi dependency for getting the AnalyticsService instance of this process."""
+    return AnalyticsService(get_dynamodb(), get_machine_service())
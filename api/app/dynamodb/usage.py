@@ -1,19 +1,73 @@
-from datetime import datetime
-from typing import Any
+import asyncio
+from typing import Any, List
 
-from app.config import get_settings
-from app.machine import IMachineService, MachineFilter
+from app import metrics
 from app.usage import UsageDetail
-from fastapi.encoders import jsonable_encoder
-
-
-async def create(floor: int, pos: int, db: Any, ms: IMachineService) -> None:
-    table = db.Table(get_settings().dynamodb_usage_table)
-    res = ms.find(MachineFilter(floor=floor, pos=pos))[0]
-    ud = UsageDetail(
-        loc=res.create_key(),
-        type=res.type,
-        started_at=res.last_started_at,
-        stopped_at=datetime.utcnow(),
-    )
-    table.put_item(Item=jsonable_encoder(ud))
+from starlette.concurrency import run_in_threadpool
+
+from .analytics import rollup_transaction
+
+# Usage records written per drain of the usage stream.
+batch_size = 25
+
+# TransactWriteItems accepts at most 100 items per call.
+max_transaction_items = 100
+
+
+def group_usage(uds: List[UsageDetail]) -> List[List[UsageDetail]]:
+    """Splits usage details into groups which can each be written in one
+    transaction, keeping their order."""
+    groups: List[List[UsageDetail]] = []
+    for ud in uds:
+        grown = groups[-1] + [ud] if groups else []
+        if grown and len(rollup_transaction(grown)) <= max_transaction_items:
+            groups[-1] = grown
+        else:
+            groups.append([ud])
+    return groups
+
+
+async def write_usage(
+    db: Any, uds: List[UsageDetail], retries: int = 5, backoff: float = 0.1
+) -> List[UsageDetail]:
+    """Writes usage details along with the usage rollups they add to, see
+    app.dynamodb.analytics, in as few TransactWriteItems calls as fit them,
+    usually one per batch. Details which were already written are left out of
+    the transaction and skipped, so a batch can be retried after a partial
+    failure. Failed calls are retried with exponential backoff, and the last
+    error is raised if details are still not written after `retries` attempts.
+    Returns the details which were written, leaving out those which already
+    were."""
+    client = db.meta.client
+    written = []
+    for group in group_usage(uds):
+        attempt = 0
+        while group:
+            try:
+                await run_in_threadpool(
+                    client.transact_write_items, TransactItems=rollup_transaction(group)
+                )
+                written += group
+                break
+            except client.exceptions.TransactionCanceledException as e:
+                # the reasons of the Puts come first, in the order of the group
+                reasons = e.response.get("CancellationReasons") or []
+                duplicates = {
+                    i
+                    for i, r in enumerate(reasons[: len(group)])
+                    if r.get("Code") == "ConditionalCheckFailed"
+                }
+                if duplicates:
+                    metrics.incr("usage_duplicate", len(duplicates))
+                    group = [ud for i, ud in enumerate(group) if i not in duplicates]
+                    continue
+                if attempt == retries - 1:
+                    raise
+            except Exception:
+                if attempt == retries - 1:
+                    raise
+            metrics.incr("usage_write_retries")
+            await asyncio.sleep(backoff * 2**attempt)
+            attempt += 1
+    metrics.incr("usage_written", len(written))
+    return written
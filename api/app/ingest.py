@@ -0,0 +1,152 @@
+"""Contains the wire formats raspis report their heartbeat and machine states in,
+decoders for them which skip pydantic validation, and the ingest service."""
+
+import ipaddress
+import json
+import socket
+import struct
+from datetime import datetime
+from typing import Iterable, List, NamedTuple, Optional, Protocol, Tuple, abstractmethod
+
+from app.machine import MachineBulkResult, MachineStatus
+from fastapi import status
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel, Field
+
+# Most machine states accepted in one frame.
+max_records = 100
+
+json_media_type = "application/json"
+binary_media_type = "application/vnd.laundry.state"
+media_types = [json_media_type, binary_media_type]
+
+# Machine states as numbered by the raspis.
+state_codes = {
+    0: MachineStatus.idle,
+    1: MachineStatus.in_use,
+    2: MachineStatus.finishing,
+    -1: MachineStatus.error,
+}
+
+# A binary frame is a header followed by one record per machine, little endian.
+# The same layout is used by raspi/transport.py, so both must change together.
+# Version 2 adds the IP address of the raspi to the header, all zeroes if unknown.
+frame_version = 2
+_headers = {
+    1: struct.Struct("<BhH"),  # version, floor, number of records
+    2: struct.Struct("<BhH4s"),  # version, floor, number of records, IPv4 address
+}
+_record = struct.Struct("<BbdI")  # pos, state code, unix time, sequence number
+_no_ip = bytes(4)
+
+
+class Record(NamedTuple):
+    """A machine state reported by a raspi."""
+
+    pos: int
+    status: MachineStatus
+    at: datetime
+    seq: int  # Increases with every state the raspi reports
+
+
+class Frame(NamedTuple):
+    """A raspi heartbeat, and the machine states it reports."""
+
+    floor: int
+    ip_addr: Optional[str]
+    records: List[Record]
+
+
+class IngestResult(BaseModel):
+    """Outcome of ingesting a frame."""
+
+    applied: int = Field(..., description="Number of machine states applied.")
+    duplicate: int = Field(
+        ...,
+        description="Number of machine states skipped, as their sequence number was already applied.",
+    )
+    rejected: List[MachineBulkResult] = Field(
+        ..., description="Machine states which could not be applied, and why."
+    )
+
+
+class IIngestService(Protocol):
+    """'Interface' declaration for the methods an ingest service should implement."""
+
+    @abstractmethod
+    async def ingest(self, frame: Frame) -> IngestResult:
+        pass
+
+
+def decode(media_type: str, body: bytes) -> Frame:
+    """Decodes a frame in the given media type.
+
+    A JSON frame holds the same fields as a binary one:
+    `{"v": 2, "floor": 5, "ip_addr": "10.0.0.2", "records": [[pos, state, unix time, seq], ...]}`"""
+    if media_type == binary_media_type:
+        return decode_binary(body)
+    if media_type == json_media_type:
+        return decode_json(body)
+    raise HTTPException(
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        detail=f"Frames must be one of {', '.join(media_types)}.",
+    )
+
+
+def decode_binary(body: bytes) -> Frame:
+    if not body or body[0] not in _headers:
+        _bad_frame(f"Frame version {body[0] if body else None} is not supported.")
+    header = _headers[body[0]]
+    try:
+        _, floor, count, *ip = header.unpack_from(body)
+    except struct.error:
+        _bad_frame("Frame is shorter than its header.")
+    _check_count(count)
+    if len(body) != header.size + count * _record.size:
+        _bad_frame(f"Frame does not hold exactly {count} records.")
+    ip_addr = socket.inet_ntoa(ip[0]) if ip and ip[0] != _no_ip else None
+    offset = header.size
+    return Frame(
+        floor, ip_addr, _records(_record.iter_unpack(memoryview(body)[offset:]))
+    )
+
+
+def decode_json(body: bytes) -> Frame:
+    try:
+        frame = json.loads(body)
+        version, floor, records = frame["v"], frame["floor"], frame["records"]
+        ip_addr = frame.get("ip_addr")
+        if version not in _headers:
+            _bad_frame(f"Frame version {version} is not supported.")
+        _check_count(len(records))
+        if ip_addr is not None:
+            ip_addr = str(ipaddress.ip_address(ip_addr))
+        return Frame(
+            int(floor),
+            ip_addr,
+            _records((int(p), int(s), float(t), int(n)) for p, s, t, n in records),
+        )
+    except (ValueError, TypeError, KeyError, AttributeError):
+        _bad_frame("Frame is not a JSON object of v, floor, ip_addr and records.")
+
+
+def _check_count(count: int) -> None:
+    if count > max_records:
+        _bad_frame(f"Frames must hold at most {max_records} records.")
+
+
+def _records(records: Iterable[Tuple[int, int, float, int]]) -> List[Record]:
+    res = []
+    for pos, code, at, seq in records:
+        if code not in state_codes:
+            _bad_frame(f"State {code} of machine at position {pos} is unknown.")
+        try:
+            at = datetime.utcfromtimestamp(at)
+        except (ValueError, OverflowError, OSError):
+            _bad_frame(f"Time {at} of machine at position {pos} is out of range.")
+        res.append(Record(pos, state_codes[code], at, seq))
+    return res
+
+
+def _bad_frame(detail: str) -> None:
+    raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=detail)
@@ -3,9 +3,11 @@
 import json
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import List, Optional, Protocol, abstractmethod
+from typing import Any, Dict, List, Optional, Protocol, Tuple, abstractmethod
 
-from pydantic import BaseModel, Field
+from app import utc
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, Field, root_validator, validator
 
 _field_floor = Field(..., description="Self explanatory.")
 _field_floor_opt = Field(None, description=_field_floor.description)
@@ -34,6 +36,10 @@ _field_approx_time_left = Field(
 _field_approx_time_left_opt = Field(
     None, description=_field_approx_time_left.description
 )
+_field_estimated_finish_at = Field(
+    None,
+    description="When this machine's cycle should finish, or null if it is not in use.",
+)
 _field_status = Field(..., description="Brief status of the machine.")
 _field_status_opt = Field(None, description=_field_status.description)
 
@@ -57,6 +63,13 @@ class MachineStatus(str, Enum):
     finishing = "finishing"
 
 
+# Statuses which a machine must be in before it can be started or stopped.
+_start_from = [MachineStatus.idle, MachineStatus.finishing, MachineStatus.error]
+_stop_from = [MachineStatus.in_use, MachineStatus.finishing, MachineStatus.error]
+# Statuses which mean a cycle was running, and is recorded as usage once stopped.
+_usage_from = [MachineStatus.in_use, MachineStatus.finishing]
+
+
 class MachineType(str, Enum):
     """Type of the machine."""
 
@@ -83,17 +96,70 @@ class _BaseMachine(BaseModel):
         return cls(**json.loads(j))
 
 
-class Machine(_BaseMachine):
-    """The default Machine model."""
+class MachineDocument(_BaseMachine):
+    """A machine as it is stored, without the fields computed when it is read."""
 
     type: MachineType = _field_type
     status: MachineStatus = _field_status
     duration: timedelta = _field_duration
     last_started_at: datetime = _field_last_started_at
 
+    _naive_last_started_at = validator("last_started_at", allow_reuse=True)(utc.naive)
+
+
+class Machine(MachineDocument):
+    """The default Machine model."""
+
+    approx_time_left: timedelta = _field_approx_time_left
+    estimated_finish_at: Optional[datetime] = _field_estimated_finish_at
+
+    @root_validator(skip_on_failure=True)
+    def estimate_time_left(cls, values):
+        """Computes the time left from the duration, which is learned from past
+        cycles when the machine starts, see app.redis.duration. The stored
+        values are ignored, as they go stale while the machine runs."""
+        values["approx_time_left"] = timedelta(0)
+        values["estimated_finish_at"] = None
+        if values["status"] == MachineStatus.in_use:
+            finish = values["last_started_at"] + values["duration"]
+            values["approx_time_left"] = max(finish - datetime.utcnow(), timedelta(0))
+            values["estimated_finish_at"] = finish
+        return values
+
     def create_typed_key(self):
         """Creates an id by pairing the floor and pos fields, along with the machine type."""
-        return f"{self.type}:{self.floor}:{self.pos}"
+        return f"{self.type.value}:{self.floor}:{self.pos}"
+
+    def to_document(self) -> Dict[str, Any]:
+        """Returns the fields of the machine which are stored, leaving out
+        those computed when it is read."""
+        return jsonable_encoder(self, exclude=_computed_fields)
+
+
+# Fields of Machine computed by estimate_time_left.
+_computed_fields = {"approx_time_left", "estimated_finish_at"}
+
+
+class MachineState(_BaseMachine):
+    """Model for setting the status of a machine."""
+
+    status: MachineStatus = _field_status
+    at: Optional[datetime] = Field(
+        None,
+        description="When the status changed, defaults to now. Set by agents replaying updates they could not send at the time.",
+    )
+
+    _naive_at = validator("at", allow_reuse=True)(utc.naive)
+
+
+class MachineBulkResult(_BaseMachine):
+    """Outcome for one machine of a bulk request."""
+
+    ok: bool = Field(..., description="Whether this machine was updated.")
+    detail: Optional[str] = Field(None, description="Why this machine was not updated.")
+    machine: Optional[Machine] = Field(
+        None, description="The machine after it was updated."
+    )
 
 
 class _BaseMachineOptional(BaseModel):
@@ -109,6 +175,8 @@ class MachineUpdate(_BaseMachineOptional):
     duration: Optional[timedelta] = _field_duration_opt
     last_started_at: Optional[datetime] = _field_last_started_at_opt
 
+    _naive_last_started_at = validator("last_started_at", allow_reuse=True)(utc.naive)
+
 
 class MachineFilter(_BaseMachineOptional):
     """Model for searching machines."""
@@ -118,29 +186,70 @@ class MachineFilter(_BaseMachineOptional):
     type: Optional[MachineType] = _field_type_opt
 
 
+class DurationEstimate(BaseModel):
+    """Cycle durations learned for a machine from its past cycles."""
+
+    samples: int = Field(..., description="Number of cycles learned from.")
+    mean: timedelta = Field(
+        ..., description="Exponentially weighted mean duration, in seconds."
+    )
+    stddev: timedelta = Field(
+        ..., description="Exponentially weighted standard deviation, in seconds."
+    )
+    p50: timedelta = Field(..., description="Estimated median duration, in seconds.")
+    p90: timedelta = Field(
+        ...,
+        description="Estimated duration, in seconds, which 90% of cycles finish within.",
+    )
+
+
 class IMachineService(Protocol):
     """Interface contract for CRUD methods associated to machines."""
 
     @abstractmethod
-    def create(self, m: Machine) -> None:
+    async def create(self, m: Machine) -> None:
+        pass
+
+    @abstractmethod
+    async def find(self, mf: MachineFilter) -> List[Machine]:
+        pass
+
+    @abstractmethod
+    async def find_page(
+        self, mf: MachineFilter, limit: int, cursor: Optional[str]
+    ) -> Tuple[List[Machine], Optional[str]]:
+        pass
+
+    @abstractmethod
+    async def update(self, floor: int, pos: int, mu: MachineUpdate) -> Machine:
+        pass
+
+    @abstractmethod
+    async def delete(self, floor: int, pos: int) -> Machine:
+        pass
+
+    @abstractmethod
+    async def start(self, floor: int, pos: int) -> Machine:
         pass
 
     @abstractmethod
-    def find(self, mf: MachineFilter) -> List[Machine]:
+    async def stop(self, floor: int, pos: int) -> Machine:
         pass
 
     @abstractmethod
-    def update(self, floor: int, pos: int, mu: MachineUpdate) -> Machine:
+    async def bulk_upsert(self, machines: List[Machine]) -> List[MachineBulkResult]:
         pass
 
     @abstractmethod
-    def delete(self, floor: int, pos: int) -> Machine:
+    async def bulk_set_status(
+        self, states: List[MachineState]
+    ) -> List[MachineBulkResult]:
         pass
 
     @abstractmethod
-    def start(self, floor: int, pos: int) -> Machine:
+    async def version(self, floor: Optional[int]) -> int:
         pass
 
     @abstractmethod
-    def stop(self, floor: int, pos: int) -> Machine:
+    async def snapshot(self) -> Tuple[int, bytes]:
         pass
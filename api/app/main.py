@@ -1,4 +1,8 @@
 from app import routers
+from app.redis import get_redis
+from app.redis.index import ensure_indexes
+from app.redis.machine import machine_index
+from app.redis.raspi import get_raspi_service, raspi_index
 from fastapi import FastAPI
 from mangum import Mangum
 
@@ -6,5 +10,18 @@ app = FastAPI()
 
 app.include_router(routers.machine)
 app.include_router(routers.raspi)
+app.include_router(routers.metrics)
+app.include_router(routers.ingest)
+app.include_router(routers.analytics)
+
+
+@app.on_event("startup")
+async def create_indexes():
+    """Creates or migrates the RediSearch indexes once per process, so that
+    requests never have to, and adds raspis which were never seen to the set
+    the worker finds stale raspis in."""
+    await ensure_indexes(get_redis(), [machine_index, raspi_index])
+    await get_raspi_service().backfill_seen()
+
 
 handler = Mangum(app)
@@ -0,0 +1,21 @@
+"""Contains simple in-process counters for observing the API."""
+
+from collections import Counter
+from typing import Dict
+
+_counters: Counter = Counter()
+
+
+def incr(name: str, amount: int = 1) -> None:
+    """Increments the counter with the given name."""
+    _counters[name] += amount
+
+
+def get(name: str) -> int:
+    """Returns the current value of a counter."""
+    return _counters[name]
+
+
+def snapshot() -> Dict[str, int]:
+    """Returns a copy of every counter in this process."""
+    return dict(_counters)
@@ -0,0 +1,21 @@
+"""Contains settings and query parameters shared by endpoints which return
+results a page at a time."""
+
+from fastapi import Query
+
+default_limit = 100
+max_limit = 1000
+
+# Response header holding the cursor for the next page.
+next_cursor_header = "X-Next-Cursor"
+
+_query_limit_opt = Query(
+    None,
+    ge=1,
+    le=max_limit,
+    description="Maximum number of results to return. If neither this nor a cursor is given, every result is returned.",
+)
+_query_cursor_opt = Query(
+    None,
+    description=f"Opaque cursor from the {next_cursor_header} header of the previous page.",
+)
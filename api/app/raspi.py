@@ -1,6 +1,6 @@
 import json
-from datetime import datetime
-from typing import List, Optional, Protocol, abstractmethod
+from datetime import datetime, timedelta
+from typing import List, Optional, Protocol, Tuple, abstractmethod
 
 from pydantic import BaseModel, Field
 
@@ -69,21 +69,31 @@ class IRaspiService(Protocol):
     """'Interface' declaration for the methods a raspi service should implement."""
 
     @abstractmethod
-    def create(self, rpi: RaspiIn) -> None:
+    async def create(self, rpi: RaspiIn) -> None:
         pass
 
     @abstractmethod
-    def upsert(self, rpi: RaspiIn) -> None:
+    async def upsert(self, rpi: RaspiIn) -> None:
         pass
 
     @abstractmethod
-    def find(self, rpif: RaspiFilter) -> List[RaspiOut]:
+    async def find(self, rpif: RaspiFilter) -> List[RaspiOut]:
         pass
 
     @abstractmethod
-    def update(self, floor: int, rpiu: RaspiUpdate) -> RaspiOut:
+    async def find_page(
+        self, rpif: RaspiFilter, limit: int, cursor: Optional[str]
+    ) -> Tuple[List[RaspiOut], Optional[str]]:
         pass
 
     @abstractmethod
-    def delete(self, floor: int) -> RaspiOut:
+    async def update(self, floor: int, rpiu: RaspiUpdate) -> RaspiOut:
+        pass
+
+    @abstractmethod
+    async def find_stale(self, older_than: timedelta) -> List[RaspiOut]:
+        pass
+
+    @abstractmethod
+    async def delete(self, floor: int) -> RaspiOut:
         pass
@@ -1,5 +1,7 @@
+from functools import lru_cache
+
 from app.config import get_settings
-from redis import ConnectionPool, Redis
+from redis.asyncio import ConnectionPool, Redis
 
 settings = get_settings()
 pool = ConnectionPool(
@@ -10,8 +12,9 @@ pool = ConnectionPool(
 )
 
 
+@lru_cache()
 def get_redis() -> Redis:
-    """Fastapi dependency to get a redis client."""
-    client = Redis(connection_pool=pool)
-    yield client
-    client.close()
+    """Returns the async redis client shared by the whole process. Connections
+    are taken from the pool per command, so the client is safe to share between
+    concurrent requests."""
+    return Redis(connection_pool=pool)
@@ -0,0 +1,45 @@
+-- Lua script to learn the cycle duration of a machine from one finished cycle
+--
+-- KEYS[1]: hash of the learned durations of the machine
+-- ARGV[1]: hour of day, in UTC, the cycle started at
+-- ARGV[2]: duration of the cycle, in seconds
+-- ARGV[3]: weight of the newest cycle in the moving averages
+-- ARGV[4...]: quantiles to track, as percentages
+--
+-- For the hour, and for all hours together, keeps the number of cycles seen
+-- (<bucket>:n), the exponentially weighted mean (<bucket>:mean) and variance
+-- (<bucket>:var) of their durations, and an estimate of each quantile
+-- (<bucket>:p<percent>). transition.lua reads the means when a cycle starts.
+--
+-- A quantile estimate is moved up by step * p when a cycle is at least as long,
+-- and down by step * (1 - p) when it is shorter, so it settles where a fraction p
+-- of cycles is shorter. The step scales with the standard deviation, so the
+-- estimate follows a machine about as quickly as the mean does.
+
+local x = tonumber(ARGV[2])
+for _, bucket in ipairs({ "h" .. ARGV[1], "all" }) do
+	local n = redis.call("HINCRBY", KEYS[1], bucket .. ":n", 1)
+	-- the first cycles are weighted evenly, so one odd cycle does not dominate
+	local alpha = math.max(tonumber(ARGV[3]), 1 / n)
+	local mean = tonumber(redis.call("HGET", KEYS[1], bucket .. ":mean")) or x
+	local var = tonumber(redis.call("HGET", KEYS[1], bucket .. ":var")) or 0
+	local diff = x - mean
+	mean = mean + alpha * diff
+	var = (1 - alpha) * (var + alpha * diff * diff)
+	redis.call("HSET", KEYS[1], bucket .. ":mean", mean, bucket .. ":var", var)
+
+	local step = alpha * math.sqrt(var)
+	for i = 4, #ARGV do
+		local field = bucket .. ":p" .. ARGV[i]
+		local p = tonumber(ARGV[i]) / 100
+		local q = tonumber(redis.call("HGET", KEYS[1], field))
+		if not q then
+			q = x
+		elseif x < q then
+			q = q - step * (1 - p)
+		else
+			q = q + step * p
+		end
+		redis.call("HSET", KEYS[1], field, q)
+	end
+end
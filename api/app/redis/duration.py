@@ -0,0 +1,101 @@
+"""Contains the per-machine model of cycle durations, learned from usage records.
+
+Every finished cycle updates the exponentially weighted mean and variance of the
+durations of its machine, and estimates of their median and 90th percentile,
+for the hour of day it started at and for all hours, in constant time, see
+duration.lua. When a machine is started, transition.lua copies the learned mean
+into the duration of the machine, so reading machines never looks at past
+usage."""
+
+import math
+from datetime import timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional
+
+from app.machine import DurationEstimate
+from app.usage import UsageDetail
+from redis.asyncio import Redis
+
+from . import get_redis
+
+_duration_script = (Path(__file__).parent / "duration.lua").read_text()
+
+# Weight of the newest cycle in the moving averages, once a bucket has seen
+# more than 1 / alpha cycles.
+alpha = 0.2
+
+# Cycles a bucket needs before its mean replaces the default duration. Also
+# checked by transition.lua, so both must change together.
+min_samples = 3
+
+# Quantiles of the durations estimated, as percentages, matching the fields of
+# DurationEstimate.
+quantiles = (50, 90)
+
+# Cycles outside these bounds are sensor glitches or forgotten laundry, and
+# are not learned from.
+min_cycle = timedelta(minutes=1)
+max_cycle = timedelta(hours=4)
+
+
+def duration_key(floor: int, pos: int) -> str:
+    return f"duration:{floor}:{pos}"
+
+
+class DurationModel:
+    """Learned cycle durations of every machine."""
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self.learn_script = redis.register_script(_duration_script)
+
+    async def learn(self, uds: List[UsageDetail]) -> int:
+        """Updates the model with every cycle given, in one round trip, and
+        returns how many cycles were learned from."""
+        learned = 0
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for ud in uds:
+                took = ud.stopped_at - ud.started_at
+                if not min_cycle <= took <= max_cycle:
+                    continue
+                _, floor, pos = ud.loc.split(":")
+                await self.learn_script(
+                    keys=[duration_key(int(floor), int(pos))],
+                    args=[ud.started_at.hour, took.total_seconds(), alpha, *quantiles],
+                    client=pipe,
+                )
+                learned += 1
+            if learned:
+                await pipe.execute()
+        return learned
+
+    async def estimate(
+        self, floor: int, pos: int, hour: Optional[int] = None
+    ) -> Optional[DurationEstimate]:
+        """Returns the durations learned for the cycles of a machine starting at
+        the given hour, falling back to all hours, or None if too few cycles
+        were seen."""
+        buckets = ([f"h{hour}"] if hour is not None else []) + ["all"]
+        names = ["n", "mean", "var", *(f"p{q}" for q in quantiles)]
+        fields = [f"{b}:{f}" for b in buckets for f in names]
+        values = await self.redis.hmget(duration_key(floor, pos), fields)
+        for n, mean, var, *qs in zip(*[iter(values)] * len(names)):
+            if n is None or int(n) < min_samples:
+                continue
+            # buckets learned before quantiles were tracked start them at the
+            # next cycle
+            qs = [mean if q is None else q for q in qs]
+            return DurationEstimate(
+                samples=int(n),
+                mean=timedelta(seconds=float(mean)),
+                stddev=timedelta(seconds=math.sqrt(float(var))),
+                **{f"p{q}": timedelta(seconds=float(v)) for q, v in zip(quantiles, qs)},
+            )
+        return None
+
+
+@lru_cache()
+def get_duration_model() -> DurationModel:
+    """Fastapi dependency for getting the DurationModel instance of this process."""
+    return DurationModel(get_redis())
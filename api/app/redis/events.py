@@ -0,0 +1,146 @@
+"""Contains the stream of machine state changes.
+
+transition.lua appends every updated machine to the event stream. Each API
+process runs a single reader of that stream, which fans events out to every
+subscriber in the process, so N subscribers cost one Redis read loop rather
+than N polls."""
+
+import asyncio
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator, List, NamedTuple, Optional, Set, Tuple
+
+from fastapi.logger import logger
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+from . import get_redis
+
+events_stream = "events:machine"
+# Approximate number of events kept for subscribers resuming from an event id.
+events_max_len = 10000
+
+_block_ms = 5000
+_read_count = 100
+_queue_size = 1000
+
+
+class MachineEvent(NamedTuple):
+    id: str
+    floor: int
+    type: str
+    machine: bytes
+
+
+def parse_event_id(id: str) -> Tuple[int, int]:
+    """Parses a stream entry id into a tuple which sorts in stream order."""
+    ms, _, seq = id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class Subscription:
+    """Queue of events for one subscriber. A subscriber which falls too far
+    behind is marked as overflowed and no longer receives events."""
+
+    def __init__(self):
+        self.queue: "asyncio.Queue[MachineEvent]" = asyncio.Queue(_queue_size)
+        self.overflowed = False
+
+    def put(self, event: MachineEvent) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self) -> MachineEvent:
+        return await self.queue.get()
+
+
+class MachineEvents:
+    """Fans out events from the event stream to the subscribers of this process."""
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self.subscriptions: Set[Subscription] = set()
+        self._reader: Optional[asyncio.Task] = None
+        # Held while the reader starts, so concurrent first subscribers start one
+        self._starting = asyncio.Lock()
+
+    @staticmethod
+    def parse(entry) -> MachineEvent:
+        id, fields = entry
+        return MachineEvent(
+            id=id.decode(),
+            floor=int(fields[b"floor"]),
+            type=fields[b"type"].decode(),
+            machine=fields[b"machine"],
+        )
+
+    async def _read(self, last_id: str) -> None:
+        try:
+            while self.subscriptions:
+                res = await self.redis.xread(
+                    {events_stream: last_id}, count=_read_count, block=_block_ms
+                )
+                for _, entries in res or []:
+                    for entry in entries:
+                        event = self.parse(entry)
+                        last_id = event.id
+                        for s in list(self.subscriptions):
+                            s.put(event)
+                        self.subscriptions = {
+                            s for s in self.subscriptions if not s.overflowed
+                        }
+        except Exception as e:
+            logger.error(f"Machine event reader stopped: {e}")
+            for s in self.subscriptions:
+                s.overflowed = True
+        finally:
+            self._reader = None
+
+    @asynccontextmanager
+    async def subscribe(self) -> AsyncIterator[Subscription]:
+        """Subscribes to events published from now on, starting the reader of
+        this process if it is not running."""
+        s = Subscription()
+        async with self._starting:
+            if self._reader is None:
+                last_id = await self.latest_id()
+                self._reader = asyncio.ensure_future(self._read(last_id))
+            self.subscriptions.add(s)
+        try:
+            yield s
+        finally:
+            self.subscriptions.discard(s)
+
+    async def latest_id(self) -> str:
+        """Returns the id of the latest event in the stream."""
+        latest = await self.redis.xrevrange(events_stream, count=1)
+        return latest[0][0].decode() if latest else "0-0"
+
+    async def replay(self, after: str) -> List[MachineEvent]:
+        """Returns the events still kept in the stream which came after the
+        given event id."""
+        try:
+            entries = await self.redis.xrange(
+                events_stream, min=f"({after}", count=events_max_len
+            )
+        except ResponseError:
+            return []
+        return [self.parse(entry) for entry in entries]
+
+
+async def publish(redis: Redis, floor: int, type: str, machine: str) -> None:
+    """Appends an event for a machine which was not updated through transition.lua."""
+    await redis.xadd(
+        events_stream,
+        {"floor": floor, "type": type, "machine": machine},
+        maxlen=events_max_len,
+        approximate=True,
+    )
+
+
+@lru_cache()
+def get_machine_events() -> MachineEvents:
+    """Fastapi dependency for getting the MachineEvents instance of this process."""
+    return MachineEvents(get_redis())
@@ -0,0 +1,95 @@
+"""Contains RediSearch index definitions and the bootstrap logic which keeps
+the indexes in Redis in sync with them."""
+
+import json
+from typing import List
+
+from app import metrics
+from fastapi.logger import logger
+from redis.asyncio import Redis
+from redis.commands.search.field import Field
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.exceptions import ResponseError
+
+
+class IndexSpec:
+    """Describes a RediSearch index over JSON documents. Bump `version` whenever
+    `fields` change so that running deployments migrate the index."""
+
+    def __init__(self, name: str, prefix: str, version: int, fields: List[Field]):
+        self.name = name
+        self.prefix = prefix
+        self.version = version
+        self.fields = fields
+
+    @property
+    def meta_key(self) -> str:
+        return f"idx:{self.name}"
+
+    @staticmethod
+    def signature(f: Field) -> str:
+        return " ".join(str(a) for a in f.redis_args())
+
+    def signatures(self) -> List[str]:
+        return [self.signature(f) for f in self.fields]
+
+
+async def _create(redis: Redis, spec: IndexSpec) -> None:
+    metrics.incr("redis_index_create")
+    try:
+        await redis.ft(index_name=spec.name).create_index(
+            spec.fields,
+            definition=IndexDefinition(index_type=IndexType.JSON, prefix=[spec.prefix]),
+        )
+    except ResponseError as e:
+        # another process may have won the race to create the index
+        logger.info(e)
+
+
+async def _save_meta(redis: Redis, spec: IndexSpec) -> None:
+    await redis.hset(
+        spec.meta_key,
+        mapping={"version": spec.version, "fields": json.dumps(spec.signatures())},
+    )
+
+
+async def ensure_index(redis: Redis, spec: IndexSpec) -> None:
+    """Creates the index if it is missing, and migrates it if its stored
+    schema version is older than the spec. Fields which were only added are
+    applied with FT.ALTER; any other change, or an index with no recorded
+    schema, is dropped and recreated while keeping the documents."""
+    ft = redis.ft(index_name=spec.name)
+    try:
+        await ft.info()
+    except ResponseError:
+        await _create(redis, spec)
+        await _save_meta(redis, spec)
+        return
+
+    meta = await redis.hgetall(spec.meta_key)
+    version = int(meta.get(b"version", 0))
+    if version == spec.version:
+        return
+    if version > spec.version:
+        logger.warning(
+            f"Index {spec.name} is at version {version}, which is newer than {spec.version}."
+        )
+        return
+
+    old = set(json.loads(meta.get(b"fields", b"[]")))
+    new = spec.signatures()
+    if meta and old.issubset(new):
+        added = [f for f, sig in zip(spec.fields, new) if sig not in old]
+        if added:
+            metrics.incr("redis_index_alter")
+            await ft.alter_schema_add(added)
+    else:
+        await ft.dropindex(delete_documents=False)
+        await _create(redis, spec)
+    await _save_meta(redis, spec)
+
+
+async def ensure_indexes(redis: Redis, specs: List[IndexSpec]) -> None:
+    """Runs `ensure_index` for every spec given."""
+    for spec in specs:
+        await ensure_index(redis, spec)
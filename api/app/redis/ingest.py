@@ -0,0 +1,89 @@
+from datetime import datetime
+from functools import lru_cache
+
+from app import metrics
+from app.ingest import Frame, IIngestService, IngestResult
+from app.machine import MachineBulkResult
+from app.raspi import RaspiOut
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import HTTPException
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+from . import get_redis
+from .machine import MachineService, get_machine_service
+from .raspi import RaspiService
+
+
+class IngestService(IIngestService):
+    """Service class implementing the IIngestService interface,
+    with Redis as the datastore."""
+
+    def __init__(self, redis: Redis, ms: MachineService):
+        self.redis: Redis = redis
+        self.ms = ms
+        self.rs = RaspiService(redis)
+
+    async def ingest(self, frame: Frame) -> IngestResult:
+        """Records the heartbeat of the raspi and applies every machine state of
+        the frame, in one round trip once the flagged machines of the floor are
+        read. Each state is applied as set_status would, unless its sequence
+        number shows it was already applied."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            # restored before the records are applied, see RaspiService.heartbeat
+            queued = await self.heartbeat(pipe, frame)
+            for r in frame.records:
+                keys, args = self.ms.transition_call(
+                    frame.floor,
+                    r.pos,
+                    *self.ms.transition_for(r.status, r.at),
+                    r.at,
+                    r.seq,
+                )
+                await self.ms.transition(keys=keys, args=args, client=pipe)
+            replies = await pipe.execute(raise_on_error=False)
+        # the commands of the heartbeat come first, then one per record
+        res = replies[queued:]
+
+        applied = duplicate = 0
+        rejected = []
+        for r, out in zip(frame.records, res):
+            if not isinstance(out, Exception):
+                applied += 1
+                continue
+            if "DUPLICATE" in str(out):
+                duplicate += 1
+                continue
+            try:
+                self.ms.raise_for_transition(frame.floor, r.pos, out)
+            except HTTPException as e:
+                detail = e.detail
+            except Exception as e:
+                detail = str(e)
+            rejected.append(
+                MachineBulkResult(floor=frame.floor, pos=r.pos, ok=False, detail=detail)
+            )
+
+        metrics.incr("ingest_applied", applied)
+        metrics.incr("ingest_duplicate", duplicate)
+        return IngestResult(applied=applied, duplicate=duplicate, rejected=rejected)
+
+    async def heartbeat(self, pipe: Pipeline, frame: Frame) -> int:
+        """Queues the upsert of the raspi, or only its updated_at if the frame
+        does not say its IP address, and records that the raspi was seen.
+        Returns the number of commands queued."""
+        key = RaspiOut._create_key(frame.floor)
+        now = datetime.utcnow()
+        if frame.ip_addr is None:
+            # fails harmlessly if the raspi does not exist yet
+            pipe.json().set(key, ".updated_at", jsonable_encoder(now))
+        else:
+            rpi = RaspiOut(floor=frame.floor, ip_addr=frame.ip_addr, updated_at=now)
+            pipe.json().set(key, ".", jsonable_encoder(rpi))
+        return 1 + await self.rs.heartbeat(pipe, frame.floor, now)
+
+
+@lru_cache()
+def get_ingest_service() -> IngestService:
+    """Fastapi dependency for getting the IngestService instance of this process."""
+    return IngestService(get_redis(), get_machine_service())
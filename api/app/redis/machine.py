@@ -1,27 +1,75 @@
+import json
 from datetime import datetime
-from typing import List
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
 from app.machine import (
     IMachineService,
     Machine,
+    MachineBulkResult,
     MachineFilter,
+    MachineState,
     MachineStatus,
     MachineUpdate,
+    _start_from,
+    _stop_from,
+    _usage_from,
 )
-from fastapi import Depends, status
+from app.paging import default_limit
+from fastapi import status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import HTTPException
-from fastapi.logger import logger
-from redis import Redis
+from redis.asyncio import Redis
 from redis.commands.json import JSON as RedisJSON
-from redis.commands.search import Search as RediSearch
+from redis.commands.search import AsyncSearch as RediSearch
 from redis.commands.search.document import Document
 from redis.commands.search.field import NumericField, TextField
-from redis.commands.search.indexDefinition import IndexDefinition, IndexType
-from redis.commands.search.query import Query
 from redis.exceptions import ResponseError
 
 from . import get_redis
+from .duration import duration_key
+from .events import events_max_len, events_stream, publish
+from .index import IndexSpec
+from .paging import read_all, read_page
+from .snapshot import MachineSnapshot, snapshot_key
+from .usage import usage_stream
+
+machine_index = IndexSpec(
+    name="machineIdx",
+    prefix="machine:",
+    version=1,
+    fields=[
+        NumericField("$.floor", sortable=True, as_name="floor"),
+        NumericField("$.pos", sortable=True, as_name="pos"),
+        TextField("$.status", sortable=True, as_name="status"),
+        TextField("$.type", sortable=True, as_name="type"),
+    ],
+)
+
+_transition_script = (Path(__file__).parent / "transition.lua").read_text()
+_restore_script = (Path(__file__).parent / "restore.lua").read_text()
+
+# Hash of versions per floor, incremented whenever a machine on the floor changes.
+floor_versions_key = "version:machine"
+
+# Hash of the last sequence number applied per floor, from the raspi of the floor.
+raspi_seq_key = "seq:raspi"
+
+
+def flagged_key(floor: int) -> str:
+    """Key of the hash of the status each machine of the floor was in before it
+    was flagged as an error, by position."""
+    return f"flagged:machine:{floor}"
+
+
+def restore_call(floor: int, positions: List[int]) -> Tuple[List[str], List[Any]]:
+    """Returns the keys and args to call restore.lua with, which restores the
+    machines at the given positions of the floor, flagged by flag_error."""
+    keys = [flagged_key(floor), snapshot_key, events_stream, floor_versions_key]
+    keys += [Machine._create_key(floor, pos) for pos in positions]
+    return keys, [floor, events_max_len, *positions]
 
 
 class MachineService(IMachineService):
@@ -29,69 +77,276 @@ class MachineService(IMachineService):
     with Redis as the datastore."""
 
     root_path: str = "."
+    sort_by: List[str] = ["@floor", "@pos"]
 
     def __init__(self, redis: Redis):
+        # the index is created once at startup, see app.redis.index
         self.redis: Redis = redis
         self.rj: RedisJSON = redis.json()
-        self.rs: RediSearch = redis.ft(index_name="machineIdx")
-
-        # create the index
-        try:
-            self.rs.create_index(
-                [
-                    NumericField("$.floor", sortable=True, as_name="floor"),
-                    NumericField("$.pos", sortable=True, as_name="pos"),
-                    TextField("$.status", sortable=True, as_name="status"),
-                    TextField("$.type", sortable=True, as_name="type"),
-                ],
-                definition=IndexDefinition(
-                    index_type=IndexType.JSON, prefix=["machine:"]
-                ),
-            )
-        except ResponseError as e:
-            logger.info(e)
+        self.rs: RediSearch = redis.ft(index_name=machine_index.name)
+        self.transition = redis.register_script(_transition_script)
+        self.snapshot_store = MachineSnapshot(redis, self.rs)
 
-    def create(self, m: Machine) -> None:
+    async def create(self, m: Machine) -> None:
         """Creates a machine. Fails silently if a machine at the same floor
         and position already exists."""
-        res = self.rj.set(m.create_key(), self.root_path, jsonable_encoder(m), nx=True)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.json().set(m.create_key(), self.root_path, m.to_document(), nx=True)
+            pipe.hincrby(snapshot_key, "version", 1)
+            pipe.hincrby(floor_versions_key, m.floor, 1)
+            res, *_ = await pipe.execute()
         if res is None:
             raise HTTPException(
                 status.HTTP_400_BAD_REQUEST,
                 detail=f"Machine at floor {m.floor} position {m.pos} already exists.",
             )
+        await publish(self.redis, m.floor, m.type.value, json.dumps(m.to_document()))
 
-    def find(self, mf: MachineFilter) -> List[Machine]:
-        """Queries Redis for machines, based on the filter provided."""
-        res = self.rs.search(self.build_query(mf))
-        return [self.from_document(doc) for doc in res.docs]
+    async def find(self, mf: MachineFilter) -> List[Machine]:
+        """Queries Redis for every machine matching the filter provided."""
+        docs = await read_all(self.rs, self.build_query(mf), self.sort_by)
+        return [Machine.from_json(doc) for doc in docs]
 
-    def update(self, floor: int, pos: int, mu: MachineUpdate) -> Machine:
-        key = Machine._create_key(floor, pos)
-        res = self.rj.get(key)
-        if res is None:
+    async def find_page(
+        self,
+        mf: MachineFilter,
+        limit: int = default_limit,
+        cursor: Optional[str] = None,
+    ) -> Tuple[List[Machine], Optional[str]]:
+        """Queries Redis for up to `limit` machines matching the filter provided,
+        ordered by floor and position. Returns the machines along with the cursor
+        for the next page, which is None on the last page."""
+        docs, next_cursor = await read_page(
+            self.rs, self.build_query(mf), self.sort_by, limit, cursor
+        )
+        return [Machine.from_json(doc) for doc in docs], next_cursor
+
+    async def update(self, floor: int, pos: int, mu: MachineUpdate) -> Machine:
+        """Performs partial update of a machine."""
+        return await self.apply(
+            floor, pos, jsonable_encoder(mu, exclude_unset=True, exclude_none=True)
+        )
+
+    async def start(self, floor: int, pos: int) -> Machine:
+        return await self.set_status(floor, pos, MachineStatus.in_use)
+
+    async def stop(self, floor: int, pos: int) -> Machine:
+        """Stops a machine. If a cycle was running, its usage record is queued
+        in the same round trip, see app.redis.usage."""
+        return await self.set_status(floor, pos, MachineStatus.idle)
+
+    async def set_status(
+        self, floor: int, pos: int, s: MachineStatus, at: Optional[datetime] = None
+    ) -> Machine:
+        """Moves a machine to the given status, with the same rules as
+        start and stop for in_use and idle. `at` is when the status changed,
+        and defaults to now."""
+        return await self.apply(floor, pos, *self.transition_for(s, at), at=at)
+
+    async def apply(
+        self,
+        floor: int,
+        pos: int,
+        fields: Dict[str, Any],
+        allowed: List[MachineStatus] = [],
+        usage_from: List[MachineStatus] = [],
+        at: Optional[datetime] = None,
+    ) -> Machine:
+        """Sets the given fields of a machine in one atomic round trip, and returns
+        the updated machine. If `allowed` is not empty, the update is rejected
+        unless the machine is currently in one of those statuses. If the machine
+        was in one of the `usage_from` statuses, a usage record is queued. The
+        updated machine is published to event subscribers, see app.redis.events."""
+        keys, args = self.transition_call(floor, pos, fields, allowed, usage_from, at)
+        try:
+            res = await self.transition(keys=keys, args=args)
+        except ResponseError as e:
+            self.raise_for_transition(floor, pos, e)
+        return Machine.from_json(res)
+
+    async def bulk_upsert(self, machines: List[Machine]) -> List[MachineBulkResult]:
+        """Creates or replaces every machine given, in one round trip."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for m in machines:
+                doc = m.to_document()
+                pipe.json().set(m.create_key(), self.root_path, doc)
+                pipe.hincrby(floor_versions_key, m.floor, 1)
+                pipe.xadd(
+                    events_stream,
+                    {
+                        "floor": m.floor,
+                        "type": m.type.value,
+                        "machine": json.dumps(doc),
+                    },
+                    maxlen=events_max_len,
+                    approximate=True,
+                )
+            pipe.hincrby(snapshot_key, "version", 1)
+            res = await pipe.execute(raise_on_error=False)
+
+        # each machine queued three commands, see above
+        outcomes = iter(res)
+        results = []
+        for m in machines:
+            errors = [r for r in islice(outcomes, 3) if isinstance(r, Exception)]
+            e = errors[0] if errors else None
+            results.append(
+                MachineBulkResult(
+                    floor=m.floor,
+                    pos=m.pos,
+                    ok=e is None,
+                    detail=None if e is None else str(e),
+                    machine=m if e is None else None,
+                )
+            )
+        return results
+
+    async def bulk_set_status(
+        self, states: List[MachineState]
+    ) -> List[MachineBulkResult]:
+        """Moves every machine given to its status, as set_status does, in one
+        round trip. Each machine is updated atomically, and one machine failing
+        does not prevent the others from being updated."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for ms in states:
+                keys, args = self.transition_call(
+                    ms.floor, ms.pos, *self.transition_for(ms.status, ms.at), ms.at
+                )
+                await self.transition(keys=keys, args=args, client=pipe)
+            res = await pipe.execute(raise_on_error=False)
+
+        results = []
+        for ms, r in zip(states, res):
+            try:
+                if isinstance(r, ResponseError):
+                    self.raise_for_transition(ms.floor, ms.pos, r)
+                if isinstance(r, Exception):
+                    raise r
+                results.append(
+                    MachineBulkResult(
+                        floor=ms.floor,
+                        pos=ms.pos,
+                        ok=True,
+                        machine=Machine.from_json(r),
+                    )
+                )
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                results.append(
+                    MachineBulkResult(
+                        floor=ms.floor, pos=ms.pos, ok=False, detail=detail
+                    )
+                )
+        return results
+
+    async def flag_error(self, floors: List[int]) -> List[MachineBulkResult]:
+        """Sets every machine on the given floors to error, skipping machines
+        which already are. Used for floors whose raspi stopped reporting, see
+        app.worker. The status each machine was in is kept, and restored by
+        restore.lua on the next heartbeat of the raspi, see RaspiService."""
+        if not floors:
+            return []
+        on_floors = "|".join(f"@floor:[{f} {f}]" for f in floors)
+        docs = await read_all(self.rs, f"({on_floors}) -@status:error", self.sort_by)
+        machines = [Machine.from_json(doc) for doc in docs]
+        if not machines:
+            return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for m in machines:
+                pipe.hset(flagged_key(m.floor), m.pos, m.status.value)
+            await pipe.execute()
+        return await self.bulk_set_status(
+            [
+                MachineState(floor=m.floor, pos=m.pos, status=MachineStatus.error)
+                for m in machines
+            ]
+        )
+
+    @staticmethod
+    def transition_for(
+        s: MachineStatus, at: Optional[datetime] = None
+    ) -> Tuple[Dict[str, Any], List[MachineStatus], List[MachineStatus]]:
+        """Returns the fields, allowed statuses and usage statuses for moving
+        a machine to the given status at the given time, see apply."""
+        if s == MachineStatus.in_use:
+            fields = {
+                "status": s,
+                "last_started_at": jsonable_encoder(at or datetime.utcnow()),
+            }
+            return fields, _start_from, []
+        if s == MachineStatus.idle:
+            return {"status": s}, _stop_from, _usage_from
+        return {"status": s}, [], []
+
+    @staticmethod
+    def transition_call(
+        floor: int,
+        pos: int,
+        fields: Dict[str, Any],
+        allowed: List[MachineStatus],
+        usage_from: List[MachineStatus],
+        at: Optional[datetime] = None,
+        seq: Optional[int] = None,
+    ) -> Tuple[List[str], List[Any]]:
+        """Returns the keys and args to call transition.lua with. `at` is
+        recorded as the end of the cycle, and defaults to now. If `seq` is given,
+        the update is skipped unless it is greater than the last sequence number
+        applied for the raspi of the floor, see app.redis.ingest. If the update
+        starts a cycle, the machine takes the duration learned for cycles
+        starting at that hour, see app.redis.duration."""
+        at = at or datetime.utcnow()
+        starts = fields.get("status") == MachineStatus.in_use
+        keys = [
+            Machine._create_key(floor, pos),
+            snapshot_key,
+            events_stream,
+            floor_versions_key,
+            usage_stream,
+            raspi_seq_key,
+            duration_key(floor, pos),
+        ]
+        args = [
+            json.dumps(fields),
+            json.dumps(allowed),
+            events_max_len,
+            json.dumps(usage_from),
+            jsonable_encoder(at),
+            floor,
+            "" if seq is None else seq,
+            at.hour if starts else "",
+        ]
+        return keys, args
+
+    @staticmethod
+    def raise_for_transition(floor: int, pos: int, e: ResponseError) -> None:
+        """Raises the HTTPException matching an error from transition.lua."""
+        if "NOT_FOUND" in str(e):
             raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
+                status.HTTP_404_NOT_FOUND,
                 detail=f"Machine at floor {floor} and position {pos} was not found.",
             )
-        old = Machine(**res)
-        new = old.copy(update=mu.dict(exclude_unset=True, exclude_none=True))
-        self.rj.set(key, self.root_path, jsonable_encoder(new))
-        return new
+        if "ILLEGAL_TRANSITION" in str(e):
+            raise HTTPException(
+                status.HTTP_409_CONFLICT,
+                detail=f"Machine at floor {floor} and position {pos} cannot be "
+                f"updated while it is {str(e).split()[-1]}.",
+            )
+        raise e
 
-    def start(self, floor: int, pos: int) -> None:
-        self.update(
-            floor,
-            pos,
-            MachineUpdate(
-                status=MachineStatus.in_use, last_started_at=datetime.utcnow()
-            ),
-        )
+    async def version(self, floor: Optional[int] = None) -> int:
+        """Returns the version of a floor, which increases whenever one of its
+        machines changes. Without a floor, returns the version of all machines."""
+        if floor is None:
+            res = await self.redis.hget(snapshot_key, "version")
+        else:
+            res = await self.redis.hget(floor_versions_key, floor)
+        return int(res or 0)
 
-    def stop(self, floor: int, pos: int) -> None:
-        self.update(floor, pos, MachineUpdate(status=MachineStatus.idle))
+    async def snapshot(self) -> Tuple[int, bytes]:
+        """Returns the version and JSON body of the snapshot of every machine."""
+        return await self.snapshot_store.get()
 
-    def delete(self, floor: int, pos: int) -> Machine:
+    async def delete(self, floor: int, pos: int) -> Machine:
         raise NotImplementedError()
 
     @staticmethod
@@ -99,7 +354,7 @@ class MachineService(IMachineService):
         return Machine.from_json(doc.__dict__["json"])
 
     @staticmethod
-    def build_query(mf: MachineFilter) -> Query:
+    def build_query(mf: MachineFilter) -> str:
         """Builds a RediSearch query string based on a
         MachineFilter instance."""
 
@@ -120,13 +375,11 @@ class MachineService(IMachineService):
         mf_dict = mf.dict(exclude_unset=True, exclude_none=True)
 
         if not mf_dict:
-            q = Query("*")
-        else:
-            q = Query(" ".join([q_mapping[k](v) for k, v in mf_dict.items()]))
-        q.paging(0, 20)
-        return q
+            return "*"
+        return " ".join([q_mapping[k](v) for k, v in mf_dict.items()])
 
 
-def get_machine_service(redis: Redis = Depends(get_redis)):
-    """Fastapi dependency for getting a MachineService instance."""
-    return MachineService(redis)
+@lru_cache()
+def get_machine_service() -> MachineService:
+    """Fastapi dependency for getting the MachineService instance of this process."""
+    return MachineService(get_redis())
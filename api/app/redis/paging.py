@@ -0,0 +1,63 @@
+"""Contains helpers for paging through RediSearch results with FT.AGGREGATE
+cursors. The cursor lives in Redis, so reading the next page continues where
+the previous one stopped instead of rescanning earlier results."""
+
+from typing import List, Optional, Tuple
+
+from app.paging import default_limit, max_limit
+from fastapi import status
+from fastapi.exceptions import HTTPException
+from redis.commands.search import AsyncSearch as RediSearch
+from redis.commands.search.aggregation import AggregateRequest, Cursor
+from redis.exceptions import ResponseError
+
+# Cursors which are not read for this many seconds are deleted by Redis.
+_max_idle = 300
+# Upper bound on the number of results sorted by a query.
+_max_results = 100000
+
+# A page of raw JSON documents, along with the cursor for the next page.
+Page = Tuple[List[bytes], Optional[str]]
+
+
+async def read_page(
+    rs: RediSearch,
+    query: str,
+    sort_by: List[str],
+    limit: int = default_limit,
+    cursor: Optional[str] = None,
+) -> Page:
+    """Reads up to `limit` documents matching the query, sorted by the given
+    sortable fields. Pass the cursor returned with a page to read the next one.
+    The cursor is None once every document has been read."""
+    if cursor is None:
+        req = (
+            AggregateRequest(query)
+            .load("$")
+            .sort_by(*sort_by, max=_max_results)
+            .cursor(count=limit, max_idle=_max_idle)
+        )
+        res = await rs.aggregate(req)
+    else:
+        try:
+            c = Cursor(int(cursor))
+            c.count = limit
+            res = await rs.aggregate(c)
+        except (ValueError, ResponseError):
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST,
+                detail="Cursor is invalid or has expired.",
+            )
+
+    docs = [dict(zip(row[::2], row[1::2]))[b"$"] for row in res.rows]
+    cid = res.cursor.cid if res.cursor else 0
+    return docs, str(cid) if cid else None
+
+
+async def read_all(rs: RediSearch, query: str, sort_by: List[str]) -> List[bytes]:
+    """Reads every document matching the query, a page at a time."""
+    docs, cursor = await read_page(rs, query, sort_by, max_limit)
+    while cursor is not None:
+        page, cursor = await read_page(rs, query, sort_by, max_limit, cursor)
+        docs += page
+    return docs
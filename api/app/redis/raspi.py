@@ -1,17 +1,36 @@
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import List, Optional, Tuple, Union
+
+from app.paging import default_limit
 from app.raspi import RaspiFilter, RaspiIn, RaspiOut, RaspiUpdate
-from fastapi import Depends, status
+from fastapi import status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import HTTPException
-from fastapi.logger import logger
-from redis import Redis
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
 from redis.commands.json import JSON as RedisJSON
-from redis.commands.search import Search as RediSearch
+from redis.commands.search import AsyncSearch as RediSearch
 from redis.commands.search.document import Document
 from redis.commands.search.field import NumericField, TextField
-from redis.commands.search.indexDefinition import IndexDefinition, IndexType
-from redis.exceptions import ResponseError
 
 from . import get_redis
+from .index import IndexSpec
+from .machine import _restore_script, flagged_key, restore_call
+from .paging import read_all, read_page
+
+raspi_index = IndexSpec(
+    name="raspiIdx",
+    prefix="raspi:",
+    version=1,
+    fields=[
+        NumericField("$.floor", sortable=True, as_name="floor"),
+        TextField("$.ip_addr", sortable=True, as_name="ip_addr"),
+    ],
+)
+
+# Sorted set of floors, scored by the Unix time their raspi was last seen.
+raspi_seen_key = "seen:raspi"
 
 
 class RaspiService:
@@ -21,31 +40,20 @@ class RaspiService:
     root_path: str = "."
 
     def __init__(self, redis: Redis):
+        # the index is created once at startup, see app.redis.index
         self.redis = redis
         self.rj: RedisJSON = redis.json()
-        self.rs: RediSearch = redis.ft(index_name="raspiIdx")
-
-        # create the index
-        try:
-            self.rs.create_index(
-                [
-                    NumericField("$.floor", sortable=True, as_name="floor"),
-                    TextField("$.ip_addr", sortable=True, as_name="ip_addr"),
-                ],
-                definition=IndexDefinition(
-                    index_type=IndexType.JSON, prefix=["raspi:"]
-                ),
-            )
-        except ResponseError as e:
-            logger.info(e)
+        self.rs: RediSearch = redis.ft(index_name=raspi_index.name)
+        self.restore = redis.register_script(_restore_script)
 
-    def create(self, rpi: RaspiIn):
+    async def create(self, rpi: RaspiIn):
         """Creates a raspi. Fails if a raspi at the same floor
         already exists."""
-        res = self.rj.set(
+        out = rpi.to_raspi_out()
+        res = await self.rj.set(
             rpi.create_key(),
             self.root_path,
-            jsonable_encoder(rpi.to_raspi_out()),
+            jsonable_encoder(out),
             nx=True,
         )
         if res is None:
@@ -53,23 +61,40 @@ class RaspiService:
                 status.HTTP_400_BAD_REQUEST,
                 detail=f"Raspi at floor {rpi.floor} already exists.",
             )
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await self.heartbeat(pipe, out.floor, out.updated_at)
+            await pipe.execute()
 
-    def upsert(self, rpi: RaspiIn):
+    async def upsert(self, rpi: RaspiIn):
         """Performs upsert for a raspi."""
-
-        self.rj.set(
-            rpi.create_key(), self.root_path, jsonable_encoder(rpi.to_raspi_out())
+        out = rpi.to_raspi_out()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.json().set(rpi.create_key(), self.root_path, jsonable_encoder(out))
+            await self.heartbeat(pipe, out.floor, out.updated_at)
+            await pipe.execute()
+
+    sort_by: List[str] = ["@floor"]
+
+    async def find(self, rf: RaspiFilter):
+        """Queries Redis for every raspi matching the filter provided."""
+        docs = await read_all(self.rs, self.build_query(rf), self.sort_by)
+        return [RaspiOut.from_json(doc) for doc in docs]
+
+    async def find_page(
+        self, rf: RaspiFilter, limit: int = default_limit, cursor: Optional[str] = None
+    ) -> Tuple[List[RaspiOut], Optional[str]]:
+        """Queries Redis for up to `limit` raspis matching the filter provided,
+        ordered by floor. Returns the raspis along with the cursor for the next
+        page, which is None on the last page."""
+        docs, next_cursor = await read_page(
+            self.rs, self.build_query(rf), self.sort_by, limit, cursor
         )
+        return [RaspiOut.from_json(doc) for doc in docs], next_cursor
 
-    def find(self, rf: RaspiFilter):
-        """Queries Redis for raspis, based on the filter provided."""
-        res = self.rs.search(self.build_query(rf))
-        return [self.from_document(doc) for doc in res.docs]
-
-    def update(self, floor: int, ru: RaspiUpdate):
+    async def update(self, floor: int, ru: RaspiUpdate):
         """Performs partial update of a raspi."""
         key = RaspiIn._create_key(floor)
-        res = self.rj.get(key)
+        res = await self.rj.get(key)
         if res is None:
             raise HTTPException(
                 status.HTTP_404_NOT_FOUND,
@@ -77,10 +102,74 @@ class RaspiService:
             )
         old = RaspiIn(**res)
         new = old.copy(update=ru.dict(exclude_unset=True, exclude_none=True))
-        self.rj.set(key, self.root_path, jsonable_encoder(new))
+        await self.rj.set(key, self.root_path, jsonable_encoder(new))
+        if ru.updated_at is not None:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                await self.heartbeat(pipe, floor, ru.updated_at)
+                await pipe.execute()
         return new
 
-    def delete(self, floor: int):
+    async def find_stale(self, older_than: timedelta) -> List[RaspiOut]:
+        """Returns every raspi which was last seen more than `older_than` ago,
+        ordered by when it was last seen."""
+        cutoff = datetime.utcnow() - older_than
+        floors = await self.redis.zrangebyscore(
+            raspi_seen_key, "-inf", f"({self.unix_time(cutoff)}"
+        )
+        if not floors:
+            return []
+        keys = [RaspiOut._create_key(int(f)) for f in floors]
+        docs = await self.rj.mget(keys, self.root_path)
+        return [RaspiOut(**doc) for doc in docs if doc is not None]
+
+    async def backfill_seen(self) -> int:
+        """Adds every raspi missing from the set of when raspis were last seen,
+        as seen at its updated_at, so raspis which stopped reporting before
+        they were ever added are still found stale. Run when the API and the
+        worker start. Returns how many raspis were added."""
+        added, cursor = 0, 0
+        while True:
+            cursor, keys = await self.redis.scan(
+                cursor, match=f"{raspi_index.prefix}*", count=default_limit
+            )
+            docs = await self.rj.mget(keys, self.root_path) if keys else []
+            seen = {
+                doc["floor"]: self.unix_time(RaspiOut(**doc).updated_at)
+                for doc in docs
+                if doc is not None
+            }
+            if seen:
+                added += await self.redis.zadd(raspi_seen_key, seen, nx=True)
+            if cursor == 0:
+                break
+        return added
+
+    @classmethod
+    def seen(cls, client: Union[Redis, Pipeline], floor: int, at: datetime):
+        """Records that the raspi of the floor was seen at the given time. Returns
+        the awaitable of the command, which is queued if `client` is a pipeline."""
+        return client.zadd(raspi_seen_key, {floor: cls.unix_time(at)})
+
+    async def heartbeat(self, pipe: Pipeline, floor: int, at: datetime) -> int:
+        """Queues the commands recording that the raspi of the floor was seen at
+        the given time: the machines flagged as errors while it was not
+        reporting are restored, see MachineService.flag_error. The flagged
+        positions are read first, so the script is given the keys it writes, and
+        is only queued if there are any. Returns the number of commands queued."""
+        self.seen(pipe, floor, at)
+        flagged = await self.redis.hkeys(flagged_key(floor))
+        if not flagged:
+            return 1
+        keys, args = restore_call(floor, sorted(int(pos) for pos in flagged))
+        await self.restore(keys=keys, args=args, client=pipe)
+        return 2
+
+    @staticmethod
+    def unix_time(at: datetime) -> float:
+        # naive datetimes are UTC throughout the API
+        return at.replace(tzinfo=timezone.utc).timestamp()
+
+    async def delete(self, floor: int):
         """Deletes a raspi."""
         raise NotImplementedError()
 
@@ -104,5 +193,6 @@ class RaspiService:
         return RaspiOut.from_json(doc.__dict__["json"])
 
 
-def get_raspi_service(redis: Redis = Depends(get_redis)):
-    return RaspiService(redis)
+@lru_cache()
+def get_raspi_service() -> RaspiService:
+    return RaspiService(get_redis())
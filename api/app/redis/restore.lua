@@ -0,0 +1,44 @@
+-- Lua script to restore the machines of a floor flagged as errors while its raspi
+-- was not reporting, see flag_error in machine.py
+--
+-- KEYS[1]: hash of the status each flagged machine of the floor was in, by position
+-- KEYS[2]: snapshot hash, whose version is incremented
+-- KEYS[3]: stream to append the restored machines to, for event subscribers
+-- KEYS[4]: hash of per-floor versions, whose field for this floor is incremented
+-- KEYS[5...]: keys of the flagged machines, in the order of their positions
+-- ARGV[1]: floor
+-- ARGV[2]: approximate maximum length of the event stream
+-- ARGV[3...]: positions of the flagged machines, as read from KEYS[1]
+--
+-- Machines which are still errors are moved back to the status they were in, so a
+-- cycle which was running carries on and is recorded once it stops. Machines which
+-- changed since are left alone. Positions another heartbeat already restored are
+-- skipped. Returns the number of machines restored.
+
+local restored = 0
+for i = 3, #ARGV do
+	local key = KEYS[i + 2]
+	local previous = redis.call("HGET", KEYS[1], ARGV[i])
+	if previous then
+		redis.call("HDEL", KEYS[1], ARGV[i])
+		local status = redis.call("JSON.GET", key, ".status")
+		if status and cjson.decode(status) == "error" then
+			redis.call("JSON.SET", key, ".status", cjson.encode(previous))
+			local updated = redis.call("JSON.GET", key, ".")
+			local doc = cjson.decode(updated)
+			redis.call(
+				"XADD", KEYS[3], "MAXLEN", "~", ARGV[2], "*",
+				"floor", doc.floor,
+				"type", doc.type,
+				"machine", updated
+			)
+			restored = restored + 1
+		end
+	end
+end
+
+if restored > 0 then
+	redis.call("HINCRBY", KEYS[2], "version", 1)
+	redis.call("HINCRBY", KEYS[4], ARGV[1], restored)
+end
+return restored
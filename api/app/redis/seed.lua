@@ -36,3 +36,6 @@ for _, floor in ipairs(FLOORS) do
 		))
 	end
 end
+
+-- invalidate the machine snapshot, so that it is rebuilt on the next read
+redis.call("HINCRBY", "snapshot:machine", "version", 1)
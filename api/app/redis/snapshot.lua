@@ -0,0 +1,13 @@
+-- Lua script to store a machine snapshot, unless a snapshot built for a newer
+-- version is already stored
+--
+-- KEYS[1]: snapshot hash
+-- ARGV[1]: version the snapshot was built for
+-- ARGV[2]: JSON body of the snapshot
+
+local current = tonumber(redis.call("HGET", KEYS[1], "body_version") or "0")
+if tonumber(ARGV[1]) < current then
+	return 0
+end
+redis.call("HSET", KEYS[1], "body_version", ARGV[1], "body", ARGV[2])
+return 1
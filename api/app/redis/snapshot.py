@@ -0,0 +1,54 @@
+"""Contains the precomputed snapshot of every machine.
+
+The snapshot is a hash holding a `version`, which transition.lua increments on
+every machine update, and the JSON `body` of all machines along with the
+`body_version` it was built for. Writes only increment the version, so they stay
+one round trip however many machines there are, and the first read which finds
+the body behind the version rebuilds it."""
+
+from pathlib import Path
+from typing import Tuple
+
+from redis.asyncio import Redis
+from redis.commands.search import AsyncSearch as RediSearch
+
+from .paging import read_all
+
+snapshot_key = "snapshot:machine"
+
+_snapshot_script = (Path(__file__).parent / "snapshot.lua").read_text()
+
+
+class MachineSnapshot:
+    """Builds and serves the machine snapshot. Keeps the last body it has seen
+    in memory, so unchanged snapshots are not transferred from Redis again."""
+
+    def __init__(self, redis: Redis, rs: RediSearch):
+        self.redis = redis
+        self.rs = rs
+        self.store = redis.register_script(_snapshot_script)
+        self._cached: Tuple[int, bytes] = (-1, b"")
+
+    async def rebuild(self) -> Tuple[int, bytes]:
+        """Builds the snapshot from every machine document, stores it, and
+        returns its version and body."""
+        version = int(await self.redis.hget(snapshot_key, "version") or 0)
+        docs = await read_all(self.rs, "*", ["@floor", "@pos"])
+        body = b"[" + b",".join(docs) + b"]"
+        await self.store(keys=[snapshot_key], args=[version, body])
+        self._cached = (version, body)
+        return self._cached
+
+    async def get(self) -> Tuple[int, bytes]:
+        """Returns the version and body of the current snapshot."""
+        version, body_version = await self.redis.hmget(
+            snapshot_key, "version", "body_version"
+        )
+        if body_version is None or int(body_version) < int(version or 0):
+            return await self.rebuild()
+        if self._cached[0] != int(body_version):
+            body_version, body = await self.redis.hmget(
+                snapshot_key, "body_version", "body"
+            )
+            self._cached = (int(body_version), body)
+        return self._cached
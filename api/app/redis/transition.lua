@@ -0,0 +1,95 @@
+-- Lua script to atomically update a machine document
+--
+-- KEYS[1]: key of the machine
+-- KEYS[2]: snapshot hash, whose version is incremented
+-- KEYS[3]: stream to append the updated machine to, for event subscribers
+-- KEYS[4]: hash of per-floor versions, whose field for this floor is incremented
+-- KEYS[5]: stream to append a usage record to
+-- KEYS[6]: hash of the last sequence number applied per raspi
+-- KEYS[7]: hash of the learned cycle durations of the machine, see duration.lua
+-- ARGV[1]: JSON object of the fields to set
+-- ARGV[2]: JSON array of statuses the machine is allowed to be in before the
+--          update. An empty array allows any status.
+-- ARGV[3]: approximate maximum length of the event stream
+-- ARGV[4]: JSON array of statuses which, when left, mean a cycle has ended and
+--          a usage record should be appended
+-- ARGV[5]: time the cycle stopped at
+-- ARGV[6]: field of the raspi sending the update
+-- ARGV[7]: sequence number of the update, which is skipped if it is not
+--          greater than the last one applied, or empty to skip the check
+-- ARGV[8]: hour of day, in UTC, of a cycle the update starts, or empty. The
+--          learned duration of cycles starting at that hour, or else at any
+--          hour, replaces the duration of the machine.
+--
+-- Returns the updated document, or errors with DUPLICATE, NOT_FOUND or
+-- ILLEGAL_TRANSITION.
+
+-- cycles a bucket of the duration model needs before it is used, the same as
+-- min_samples in duration.py
+local MIN_SAMPLES = 3
+
+if ARGV[7] ~= "" then
+	local last = tonumber(redis.call("HGET", KEYS[6], ARGV[6]) or 0)
+	if tonumber(ARGV[7]) <= last then
+		return redis.error_reply("DUPLICATE")
+	end
+	-- an update which cannot be applied is not retried either
+	redis.call("HSET", KEYS[6], ARGV[6], ARGV[7])
+end
+
+local doc = redis.call("JSON.GET", KEYS[1], ".")
+if not doc then
+	return redis.error_reply("NOT_FOUND")
+end
+doc = cjson.decode(doc)
+
+local function contains(list, value)
+	for _, v in ipairs(list) do
+		if v == value then
+			return true
+		end
+	end
+	return false
+end
+
+local allowed = cjson.decode(ARGV[2])
+if #allowed > 0 and not contains(allowed, doc.status) then
+	return redis.error_reply("ILLEGAL_TRANSITION " .. doc.status)
+end
+
+local fields = cjson.decode(ARGV[1])
+if ARGV[8] ~= "" then
+	local hour = "h" .. ARGV[8]
+	local learned = redis.call(
+		"HMGET", KEYS[7], hour .. ":n", hour .. ":mean", "all:n", "all:mean"
+	)
+	if (tonumber(learned[1]) or 0) >= MIN_SAMPLES then
+		fields.duration = tonumber(learned[2])
+	elseif (tonumber(learned[3]) or 0) >= MIN_SAMPLES then
+		fields.duration = tonumber(learned[4])
+	end
+end
+for field, value in pairs(fields) do
+	redis.call("JSON.SET", KEYS[1], "." .. field, cjson.encode(value))
+end
+
+redis.call("HINCRBY", KEYS[2], "version", 1)
+redis.call("HINCRBY", KEYS[4], doc.floor, 1)
+
+if contains(cjson.decode(ARGV[4]), doc.status) then
+	redis.call(
+		"XADD", KEYS[5], "*",
+		"loc", doc.type .. ":" .. doc.floor .. ":" .. doc.pos,
+		"started_at", doc.last_started_at,
+		"stopped_at", ARGV[5]
+	)
+end
+
+local updated = redis.call("JSON.GET", KEYS[1], ".")
+redis.call(
+	"XADD", KEYS[3], "MAXLEN", "~", ARGV[3], "*",
+	"floor", doc.floor,
+	"type", doc.type,
+	"machine", updated
+)
+return updated
@@ -0,0 +1,137 @@
+"""Contains the Redis Stream which queues usage records until they are written
+to DynamoDB.
+
+Records are appended by transition.lua when a machine is stopped, and read by
+the worker in app.worker through a consumer group. Entries are acknowledged and
+deleted only after DynamoDB has accepted them, so every record is delivered at
+least once."""
+
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.usage import UsageDetail
+from fastapi.logger import logger
+from pydantic import ValidationError
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+usage_stream = "usage"
+usage_group = "dynamodb"
+
+# Entries which stay unacknowledged for this long are claimed by the next drain.
+_claim_idle_ms = 60 * 1000
+
+# Entries which could not be parsed have no usage detail.
+Entry = Tuple[bytes, Optional[UsageDetail]]
+
+
+class UsageQueue:
+    """Consumer side of the usage stream."""
+
+    def __init__(self, redis: Redis, consumer: str, batch_size: int = 25):
+        self.redis = redis
+        self.consumer = consumer
+        self.batch_size = batch_size
+
+    async def create_group(self) -> None:
+        """Creates the consumer group, and the stream if it is missing."""
+        try:
+            await self.redis.xgroup_create(
+                usage_stream, usage_group, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def claim(self) -> List[Entry]:
+        """Claims entries which were read by a consumer but never acknowledged,
+        for example because DynamoDB was down or the consumer was frozen.
+        Entries which were trimmed or deleted meanwhile are acknowledged, so
+        they are not claimed again."""
+        _, messages = (
+            await self.redis.xautoclaim(
+                usage_stream,
+                usage_group,
+                self.consumer,
+                min_idle_time=_claim_idle_ms,
+                start_id="0-0",
+                count=self.batch_size,
+            )
+        )[:2]
+        # Redis 7 drops deleted entries from the group itself, while Redis 6.2
+        # claims them and returns them without their id or fields
+        if any(not fields for _, fields in messages):
+            await self.ack_deleted()
+        return self.parse(messages)
+
+    async def ack_deleted(self) -> None:
+        """Acknowledges the entries pending for this consumer which are no
+        longer in the stream."""
+        pending = await self.redis.xpending_range(
+            usage_stream,
+            usage_group,
+            min="-",
+            max="+",
+            count=self.batch_size,
+            consumername=self.consumer,
+        )
+        ids = [p["message_id"] for p in pending]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for id in ids:
+                pipe.xrange(usage_stream, min=id, max=id)
+            found = await pipe.execute()
+        deleted = [id for id, entries in zip(ids, found) if not entries]
+        if deleted:
+            logger.warning(f"Acknowledging {len(deleted)} deleted usage records.")
+            await self.redis.xack(usage_stream, usage_group, *deleted)
+
+    async def read(self) -> List[Entry]:
+        """Reads entries which were never delivered to any consumer."""
+        res = await self.redis.xreadgroup(
+            usage_group,
+            self.consumer,
+            {usage_stream: ">"},
+            count=self.batch_size,
+        )
+        return self.parse(res[0][1]) if res else []
+
+    async def ack(self, ids: List[bytes]) -> None:
+        """Acknowledges and removes entries which were written to DynamoDB."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xack(usage_stream, usage_group, *ids)
+            pipe.xdel(usage_stream, *ids)
+            await pipe.execute()
+
+    @staticmethod
+    def parse(messages) -> List[Entry]:
+        entries = []
+        for id, fields in messages:
+            if not fields:
+                continue
+            try:
+                ud = UsageDetail(**{k.decode(): v.decode() for k, v in fields.items()})
+            except ValidationError as e:
+                logger.error(f"Dropping invalid usage record {id}: {e}")
+                ud = None
+            entries.append((id, ud))
+        return entries
+
+
+async def usage_queue_stats(redis: Redis) -> Dict[str, int]:
+    """Returns the depth of the usage queue, how many entries are being
+    processed, and the age in seconds of the oldest entry."""
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.xlen(usage_stream)
+        pipe.xrange(usage_stream, count=1)
+        pipe.xpending(usage_stream, usage_group)
+        depth, oldest, pending = await pipe.execute(raise_on_error=False)
+
+    stats = {"usage_queue_depth": depth if isinstance(depth, int) else 0}
+    stats["usage_queue_pending"] = (
+        pending["pending"] if isinstance(pending, dict) else 0
+    )
+    stats["usage_queue_lag_seconds"] = 0
+    if isinstance(oldest, list) and oldest:
+        oldest_ms = int(oldest[0][0].split(b"-")[0])
+        stats["usage_queue_lag_seconds"] = max(0, int(time.time() - oldest_ms / 1000))
+    return stats
@@ -1,3 +1,6 @@
 # flake8: noqa
+from .analytics import router as analytics
+from .ingest import router as ingest
 from .machine import router as machine
+from .metrics import router as metrics
 from .raspi import router as raspi
@@ -0,0 +1,54 @@
+from datetime import datetime
+from typing import List, Optional
+
+from app.analytics import BusyHour, Granularity, IAnalyticsService, Source, UsageReport
+from app.dynamodb.analytics import get_analytics_service
+from app.machine import _field_floor, _field_pos
+from fastapi import APIRouter, Depends, Query, status
+
+router = APIRouter(prefix="/analytics")
+
+_query_pos_opt = Query(
+    None,
+    description=f"{_field_pos.description} If not given, the whole floor is counted.",
+)
+_query_source_opt = Query(
+    None,
+    description="Read totals from the usage rollups, or total the usage records. Defaults to the rollups, falling back to the records if the rollups cannot be read.",
+)
+
+
+@router.get(
+    "/usage",
+    status_code=status.HTTP_200_OK,
+    response_model=UsageReport,
+    description="Get the utilisation, number of cycles and average cycle length of a machine or floor, in total and per hour or day. Times are in the local time of the laundry rooms. The range may be at most a year long with hourly buckets, and five years with daily buckets.",
+)
+async def get_usage(
+    floor: int = Query(..., description=_field_floor.description),
+    pos: Optional[int] = _query_pos_opt,
+    start: datetime = Query(..., description="Start of the range, in local time."),
+    end: datetime = Query(..., description="End of the range, in local time."),
+    granularity: Granularity = Query(
+        Granularity.hour, description="Length of each period."
+    ),
+    source: Optional[Source] = _query_source_opt,
+    ans: IAnalyticsService = Depends(get_analytics_service),
+):
+    return await ans.usage(floor, pos, start, end, granularity, source)
+
+
+@router.get(
+    "/busiest",
+    status_code=status.HTTP_200_OK,
+    response_model=List[BusyHour],
+    description="Get the busiest hours of the week of a machine or floor, busiest first.",
+)
+async def get_busiest_hours(
+    floor: int = Query(..., description=_field_floor.description),
+    pos: Optional[int] = _query_pos_opt,
+    limit: int = Query(10, ge=1, le=168, description="Number of hours to return."),
+    source: Optional[Source] = _query_source_opt,
+    ans: IAnalyticsService = Depends(get_analytics_service),
+):
+    return await ans.busiest_hours(floor, pos, limit, source)
@@ -0,0 +1,17 @@
+from app.auth import validate_api_key
+from app.ingest import IIngestService, IngestResult, decode, max_records, media_types
+from app.redis.ingest import get_ingest_service
+from fastapi import APIRouter, Depends, Request, status
+
+router = APIRouter(prefix="/ingest", dependencies=[Depends(validate_api_key)])
+
+
+@router.post(
+    "",
+    status_code=status.HTTP_200_OK,
+    response_model=IngestResult,
+    description=f"Records the heartbeat of a raspi along with up to {max_records} machine states it reports, in one round trip. States already applied, by their sequence number, are skipped. The frame is read according to its Content-Type, one of {', '.join(media_types)}, see app.ingest for the layouts.",
+)
+async def ingest(request: Request, ins: IIngestService = Depends(get_ingest_service)):
+    media_type = request.headers.get("content-type", "").split(";")[0].strip()
+    return await ins.ingest(decode(media_type, await request.body()))
@@ -1,13 +1,15 @@
 import asyncio
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 
 from app.auth import validate_api_key
-from app.dynamodb import get_dynamodb
-from app.dynamodb.usage import create as create_usage
 from app.machine import (
+    DurationEstimate,
     IMachineService,
     Machine,
+    MachineBulkResult,
+    MachineDocument,
     MachineFilter,
+    MachineState,
     MachineStatus,
     MachineType,
     MachineUpdate,
@@ -16,8 +18,23 @@ from app.machine import (
     _field_status,
     _field_type,
 )
+from app.paging import (
+    _query_cursor_opt,
+    _query_limit_opt,
+    default_limit,
+    next_cursor_header,
+)
+from app.redis.duration import DurationModel, get_duration_model
+from app.redis.events import (
+    MachineEvent,
+    MachineEvents,
+    get_machine_events,
+    parse_event_id,
+)
 from app.redis.machine import get_machine_service
-from fastapi import APIRouter, Depends, Query, status
+from fastapi import APIRouter, Body, Depends, Header, Query, Response, status
+from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
 
 router = APIRouter(prefix="/machine")
 
@@ -31,26 +48,227 @@ router = APIRouter(prefix="/machine")
 async def create_machine(
     m: Machine, ms: IMachineService = Depends(get_machine_service)
 ):
-    ms.create(m)
+    await ms.create(m)
+
+
+# Response header holding the version of the machines returned.
+version_header = "X-Version"
+# Longest a request may wait for a change, within the API gateway timeout.
+_max_wait = 25
+
+
+async def _wait_for_change(
+    ms: IMachineService,
+    events: MachineEvents,
+    floor: Optional[int],
+    since_version: int,
+    wait: int,
+) -> int:
+    """Waits up to `wait` seconds for the version of the floor to pass
+    `since_version`, and returns the latest version."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + wait
+    async with events.subscribe() as sub:
+        version = await ms.version(floor)
+        while version <= since_version and not sub.overflowed:
+            try:
+                event = await asyncio.wait_for(sub.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if floor is None or event.floor == floor:
+                version = await ms.version(floor)
+    return version
+
+
+def _not_modified(version: int) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={version_header: str(version)},
+    )
 
 
 @router.get(
     "",
     status_code=status.HTTP_200_OK,
     response_model=List[Machine],
-    description="Get a list of machines.",
+    responses={
+        status.HTTP_304_NOT_MODIFIED: {"description": "Nothing changed while waiting."}
+    },
+    description=f"Get a list of machines, ordered by floor and position. If there are more results, the cursor for the next page is in the {next_cursor_header} header. The {version_header} header holds the version of the floor, or of all machines if no floor is given. Pass it as since_version along with wait to block until something changes.",
 )
 async def get_machines(
+    response: Response,
     status: Optional[MachineStatus] = Query(
         None, description=_field_status.description
     ),
     floor: Optional[int] = Query(None, description=_field_floor.description),
     pos: Optional[int] = Query(None, description=_field_pos.description),
     type: Optional[MachineType] = Query(None, description=_field_type.description),
+    limit: Optional[int] = _query_limit_opt,
+    cursor: Optional[str] = _query_cursor_opt,
+    wait: Optional[int] = Query(
+        None,
+        ge=1,
+        le=_max_wait,
+        description="Seconds to wait for the version to pass since_version. Responds with 304 if nothing changed in time.",
+    ),
+    since_version: Optional[int] = Query(
+        None,
+        description=f"Version from the {version_header} header of a previous response.",
+    ),
     ms: IMachineService = Depends(get_machine_service),
+    events: MachineEvents = Depends(get_machine_events),
 ):
+    if wait is not None and since_version is not None:
+        version = await _wait_for_change(ms, events, floor, since_version, wait)
+        if version <= since_version:
+            return _not_modified(version)
+    else:
+        version = await ms.version(floor)
+    response.headers[version_header] = str(version)
+
     mf = MachineFilter(status=status, floor=floor, pos=pos, type=type)
-    return ms.find(mf)
+    if limit is None and cursor is None:
+        return await ms.find(mf)
+    res, next_cursor = await ms.find_page(mf, limit or default_limit, cursor)
+    if next_cursor is not None:
+        response.headers[next_cursor_header] = next_cursor
+    return res
+
+
+@router.get(
+    "/snapshot",
+    status_code=status.HTTP_200_OK,
+    response_model=List[MachineDocument],
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "Not modified."}},
+    description="Get every machine on every floor from a precomputed snapshot. Send the ETag of a previous response in If-None-Match to get a 304 if nothing has changed. The snapshot holds machines as they are stored, so approx_time_left and estimated_finish_at are left out; compute them from last_started_at and duration.",
+)
+async def get_snapshot(
+    if_none_match: Optional[str] = Header(None),
+    ms: IMachineService = Depends(get_machine_service),
+):
+    version, body = await ms.snapshot()
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    tags = {t.strip() for t in (if_none_match or "").split(",")}
+    if "*" in tags or etag in tags:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# Seconds between comments sent to keep idle event streams open.
+_keepalive = 15
+
+
+def _format_event(event: MachineEvent) -> str:
+    return f"id: {event.id}\nevent: machine\ndata: {event.machine.decode()}\n\n"
+
+
+async def _stream_events(
+    events: MachineEvents,
+    floor: Optional[int],
+    type: Optional[MachineType],
+    last_event_id: Optional[str],
+    wait: Optional[int],
+) -> AsyncIterator[str]:
+    def wanted(event: MachineEvent) -> bool:
+        return (floor is None or event.floor == floor) and (
+            type is None or event.type == type
+        )
+
+    loop = asyncio.get_event_loop()
+    deadline = None if wait is None else loop.time() + wait
+    async with events.subscribe() as sub:
+        last = (0, 0)
+        sent = False
+        cursor = last_event_id
+        if wait is not None and cursor is None:
+            cursor = await events.latest_id()
+        if cursor:
+            for event in await events.replay(cursor):
+                last = parse_event_id(event.id)
+                cursor = event.id
+                if wanted(event):
+                    sent = True
+                    yield _format_event(event)
+        while not sub.overflowed:
+            if deadline is None:
+                timeout = _keepalive
+            elif sent or loop.time() >= deadline:
+                # when waiting, end once events were sent, like a long poll,
+                # along with those which arrived meanwhile
+                if sub.queue.empty():
+                    break
+                timeout = None
+            else:
+                timeout = deadline - loop.time()
+            try:
+                event = await asyncio.wait_for(sub.get(), timeout)
+            except asyncio.TimeoutError:
+                if deadline is None:
+                    yield ": keepalive\n\n"
+                continue
+            # skip events which were already sent while replaying
+            if parse_event_id(event.id) <= last:
+                continue
+            cursor = event.id
+            if wanted(event):
+                sent = True
+                yield _format_event(event)
+        if wait is not None:
+            # where to resume from, even if no event was wanted
+            yield f"id: {cursor}\nevent: position\ndata:\n\n"
+
+
+@router.get(
+    "/events",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    description="Stream machine state changes as server-sent events. Each event holds the updated machine. Send the id of the last event received in Last-Event-ID to resume after reconnecting. An open stream needs a server which sends responses as they are written, such as uvicorn. Behind the Lambda deployment, which only sends a response once it is complete, pass wait.",
+)
+async def get_events(
+    floor: Optional[int] = Query(None, description=_field_floor.description),
+    type: Optional[MachineType] = Query(None, description=_field_type.description),
+    wait: Optional[int] = Query(
+        None,
+        ge=1,
+        le=_max_wait,
+        description="Seconds to wait for events. The response ends as soon as events have been sent, or once the time is up, and closes with a position event whose id to send in Last-Event-ID next.",
+    ),
+    last_event_id: Optional[str] = Header(None),
+    events: MachineEvents = Depends(get_machine_events),
+):
+    return StreamingResponse(
+        _stream_events(events, floor, type, last_event_id, wait),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/duration",
+    status_code=status.HTTP_200_OK,
+    response_model=DurationEstimate,
+    description="Get the cycle durations learned for this machine from its past cycles. Fails with 404 until enough cycles were seen.",
+)
+async def get_machine_duration(
+    floor: int = Query(..., description=_field_floor.description),
+    pos: int = Query(..., description=_field_pos.description),
+    hour: Optional[int] = Query(
+        None,
+        ge=0,
+        le=23,
+        description="Hour of day, in UTC, the cycle starts at. Cycles of every hour are used if too few started in it.",
+    ),
+    durations: DurationModel = Depends(get_duration_model),
+):
+    est = await durations.estimate(floor, pos, hour)
+    if est is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail=f"Too few cycles of floor {floor} position {pos} were seen.",
+        )
+    return est
 
 
 @router.put(
@@ -66,13 +284,14 @@ async def update_machine(
     pos: int = Query(..., description=_field_pos.description),
     ms: IMachineService = Depends(get_machine_service),
 ):
-    return ms.update(floor, pos, mu)
+    return await ms.update(floor, pos, mu)
 
 
 @router.put(
     "/start",
     status_code=status.HTTP_202_ACCEPTED,
-    description="Start this machine.",
+    response_model=Machine,
+    description="Start this machine. Fails with 409 if the machine is already in use.",
     dependencies=[Depends(validate_api_key)],
 )
 async def start_machine(
@@ -80,20 +299,51 @@ async def start_machine(
     pos: int = Query(..., description=_field_pos.description),
     ms: IMachineService = Depends(get_machine_service),
 ):
-    return ms.start(floor, pos)
+    return await ms.start(floor, pos)
 
 
 @router.put(
     "/stop",
     status_code=status.HTTP_202_ACCEPTED,
-    description="Stop this machine.",
+    response_model=Machine,
+    description="Stop this machine, and queue a usage record if a cycle was running. Fails with 409 if the machine is already idle.",
     dependencies=[Depends(validate_api_key)],
 )
 async def stop_machine(
     floor: int = Query(..., description=_field_floor.description),
     pos: int = Query(..., description=_field_pos.description),
     ms: IMachineService = Depends(get_machine_service),
-    db=Depends(get_dynamodb),
 ):
-    asyncio.ensure_future(create_usage(floor, pos, db, ms))
-    return ms.stop(floor, pos)
+    return await ms.stop(floor, pos)
+
+
+# Most machines which may be sent in one bulk request.
+_max_bulk = 100
+
+
+@router.post(
+    "/bulk",
+    status_code=status.HTTP_200_OK,
+    response_model=List[MachineBulkResult],
+    description=f"Creates or replaces up to {_max_bulk} machines in one round trip, and reports the outcome for each.",
+    dependencies=[Depends(validate_api_key)],
+)
+async def bulk_upsert_machines(
+    machines: List[Machine] = Body(..., min_items=1, max_items=_max_bulk),
+    ms: IMachineService = Depends(get_machine_service),
+):
+    return await ms.bulk_upsert(machines)
+
+
+@router.put(
+    "/bulk/state",
+    status_code=status.HTTP_200_OK,
+    response_model=List[MachineBulkResult],
+    description=f"Sets the status of up to {_max_bulk} machines in one round trip, and reports the outcome for each. Setting in_use and idle follows the same rules as /start and /stop.",
+    dependencies=[Depends(validate_api_key)],
+)
+async def bulk_set_machine_states(
+    states: List[MachineState] = Body(..., min_items=1, max_items=_max_bulk),
+    ms: IMachineService = Depends(get_machine_service),
+):
+    return await ms.bulk_set_status(states)
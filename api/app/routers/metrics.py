@@ -0,0 +1,20 @@
+from typing import Dict
+
+from app import metrics
+from app.auth import validate_api_key
+from app.redis import get_redis
+from app.redis.usage import usage_queue_stats
+from fastapi import APIRouter, Depends, status
+from redis.asyncio import Redis
+
+router = APIRouter(prefix="/metrics", dependencies=[Depends(validate_api_key)])
+
+
+@router.get(
+    "",
+    status_code=status.HTTP_200_OK,
+    response_model=Dict[str, int],
+    description="Get the counters of the API process serving this request, along with the state of the usage queue.",
+)
+async def get_metrics(redis: Redis = Depends(get_redis)):
+    return {**metrics.snapshot(), **await usage_queue_stats(redis)}
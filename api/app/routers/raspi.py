@@ -1,6 +1,13 @@
+from datetime import timedelta
 from typing import List, Optional
 
 from app.auth import validate_api_key
+from app.paging import (
+    _query_cursor_opt,
+    _query_limit_opt,
+    default_limit,
+    next_cursor_header,
+)
 from app.raspi import (
     IRaspiService,
     RaspiFilter,
@@ -11,7 +18,7 @@ from app.raspi import (
     _field_ip_addr,
 )
 from app.redis.raspi import get_raspi_service
-from fastapi import APIRouter, Depends, Query, status
+from fastapi import APIRouter, Depends, Query, Response, status
 
 router = APIRouter(prefix="/raspi", dependencies=[Depends(validate_api_key)])
 
@@ -22,21 +29,45 @@ router = APIRouter(prefix="/raspi", dependencies=[Depends(validate_api_key)])
     description="Creates a new raspi. Fails if a raspi at the same floor already exists.",
 )
 async def create_raspi(rpi: RaspiIn, rs: IRaspiService = Depends(get_raspi_service)):
-    rs.create(rpi)
+    await rs.create(rpi)
 
 
 @router.get(
     "",
     status_code=status.HTTP_200_OK,
     response_model=List[RaspiOut],
-    description="Get a list of raspis.",
+    description=f"Get a list of raspis, ordered by floor. If there are more results, the cursor for the next page is in the {next_cursor_header} header.",
 )
 async def get_raspis(
+    response: Response,
     floor: Optional[int] = Query(None, description=_field_floor.description),
     ip_addr: Optional[str] = Query(None, description=_field_ip_addr.description),
+    limit: Optional[int] = _query_limit_opt,
+    cursor: Optional[str] = _query_cursor_opt,
+    rs: IRaspiService = Depends(get_raspi_service),
+):
+    rf = RaspiFilter(floor=floor, ip_addr=ip_addr)
+    if limit is None and cursor is None:
+        return await rs.find(rf)
+    res, next_cursor = await rs.find_page(rf, limit or default_limit, cursor)
+    if next_cursor is not None:
+        response.headers[next_cursor_header] = next_cursor
+    return res
+
+
+@router.get(
+    "/stale",
+    status_code=status.HTTP_200_OK,
+    response_model=List[RaspiOut],
+    description="Get a list of raspis which have not been seen for longer than the given time, least recently seen first.",
+)
+async def get_stale_raspis(
+    older_than: int = Query(
+        ..., ge=0, description="Seconds since the raspi was last seen."
+    ),
     rs: IRaspiService = Depends(get_raspi_service),
 ):
-    return rs.find(RaspiFilter(floor=floor, ip_addr=ip_addr))
+    return await rs.find_stale(timedelta(seconds=older_than))
 
 
 @router.patch(
@@ -50,7 +81,7 @@ async def update_raspi(
     floor: int = Query(..., description=_field_floor.description),
     rs: IRaspiService = Depends(get_raspi_service),
 ):
-    return rs.update(floor, ru)
+    return await rs.update(floor, ru)
 
 
 @router.put(
@@ -62,4 +93,4 @@ async def upsert_raspi(
     rpi: RaspiIn,
     rs: IRaspiService = Depends(get_raspi_service),
 ):
-    rs.upsert(rpi)
+    await rs.upsert(rpi)
@@ -1,6 +1,7 @@
 import re
 from datetime import datetime
 
+from app import utc
 from pydantic import BaseModel, validator
 
 
@@ -9,6 +10,8 @@ class UsageDetail(BaseModel):
     started_at: datetime
     stopped_at: datetime
 
+    _naive_times = validator("started_at", "stopped_at", allow_reuse=True)(utc.naive)
+
     @validator("loc")
     def loc_is_correct_format(cls, v):
         if re.match(r"^(washer|dryer):\d+:\d+$", v) is None:
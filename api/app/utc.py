@@ -0,0 +1,12 @@
+"""Helpers for the naive UTC datetimes used throughout the API."""
+
+from datetime import datetime, timezone
+from typing import Optional
+
+
+def naive(at: Optional[datetime]) -> Optional[datetime]:
+    """Converts an aware datetime to naive UTC. Naive datetimes are already UTC,
+    and are returned as is."""
+    if at is None or at.tzinfo is None:
+        return at
+    return at.astimezone(timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,94 @@
+"""Worker which drains usage records from the Redis usage stream into DynamoDB,
+learns the cycle durations of machines from them, and flags the machines of raspis which stopped reporting as errors.
+
+Deployed as a scheduled lambda through `handler`, and can be run locally with
+`python -m app.worker`."""
+
+import asyncio
+import socket
+from datetime import timedelta
+from typing import Any, Optional
+
+from app import metrics
+from app.config import get_settings
+from app.dynamodb import get_dynamodb
+from app.dynamodb.usage import batch_size, write_usage
+from app.redis.duration import DurationModel
+from app.redis.machine import MachineService
+from app.redis.raspi import RaspiService
+from app.redis.usage import UsageQueue
+from fastapi.logger import logger
+from redis.asyncio import Redis
+
+
+async def drain(
+    queue: UsageQueue, db: Any, durations: Optional[DurationModel] = None
+) -> int:
+    """Writes every queued usage record to DynamoDB, along with its usage
+    rollups, and returns how many records were written. Records are
+    acknowledged only once written, so a failed batch stays in the stream and
+    is claimed again by a later drain, which skips the records already written.
+    Records are also learned from by `durations`, if given, the first time they
+    are written."""
+    await queue.create_group()
+    written = 0
+    while True:
+        entries = await queue.claim() or await queue.read()
+        if not entries:
+            return written
+        uds = [ud for _, ud in entries if ud is not None]
+        if uds:
+            uds = await write_usage(db, uds)
+            if durations is not None and uds:
+                metrics.incr("cycles_learned", await durations.learn(uds))
+            written += len(uds)
+        await queue.ack([id for id, _ in entries])
+
+
+async def flag_stale(
+    rs: RaspiService, ms: MachineService, older_than: timedelta
+) -> int:
+    """Sets every machine on the floor of a raspi not seen for `older_than` to
+    error, and returns how many machines were flagged. Machines go back to the
+    status they were in on the next heartbeat of their raspi, see
+    RaspiService.heartbeat."""
+    stale = await rs.find_stale(older_than)
+    flagged = sum(r.ok for r in await ms.flag_error([r.floor for r in stale]))
+    metrics.incr("machines_flagged_stale", flagged)
+    return flagged
+
+
+async def run(once: bool = True, interval: float = 5) -> None:
+    settings = get_settings()
+    redis = Redis(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        db=settings.redis_db,
+        password=settings.redis_pass,
+    )
+    queue = UsageQueue(redis, consumer=socket.gethostname(), batch_size=batch_size)
+    rs, ms = RaspiService(redis), MachineService(redis)
+    durations = DurationModel(redis)
+    stale_after = timedelta(seconds=settings.raspi_stale_after)
+    try:
+        await rs.backfill_seen()
+        while True:
+            written = await drain(queue, get_dynamodb(), durations)
+            logger.info(f"Wrote {written} usage records.")
+            flagged = await flag_stale(rs, ms, stale_after)
+            if flagged:
+                logger.warning(f"Flagged {flagged} machines of stale raspis.")
+            if once:
+                return
+            await asyncio.sleep(interval)
+    finally:
+        await redis.close()
+
+
+def handler(event, context):
+    """Lambda entrypoint."""
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    asyncio.run(run(once=False))
@@ -0,0 +1,77 @@
+"""Measures how throughput of concurrent machine queries scales with the async
+redis client, compared with the blocking client the handlers used before.
+
+Each simulated request runs `MachineService.find` for one floor. The blocking
+variant issues the same query with the synchronous client from inside a
+coroutine, which is what the async handlers did before, so requests serialize
+on the event loop.
+
+Run against the test redis with `python -m benchmarks.concurrency`."""
+
+import asyncio
+import time
+from datetime import timedelta
+
+from app.config import get_settings
+from app.machine import Machine, MachineFilter, MachineStatus, MachineType
+from app.redis.index import ensure_indexes
+from app.redis.machine import MachineService, machine_index
+from redis import Redis
+from redis.asyncio import ConnectionPool
+from redis.asyncio import Redis as AsyncRedis
+
+N = 2000
+CONCURRENCY = [1, 8, 32, 128]
+FLOOR = 999
+
+
+async def load(name: str, request, concurrency: int) -> None:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with sem:
+            await request()
+
+    t = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(N)))
+    elapsed = time.perf_counter() - t
+    print(f"{name:>9} c={concurrency:<4} {N / elapsed:8.0f} req/s")
+
+
+async def main() -> None:
+    url = get_settings().redis_test_url
+    sync = Redis.from_url(url)
+    aredis = AsyncRedis(
+        connection_pool=ConnectionPool.from_url(url, max_connections=max(CONCURRENCY))
+    )
+    await ensure_indexes(aredis, [machine_index])
+    ms = MachineService(aredis)
+    mf = MachineFilter(floor=FLOOR)
+    keys = []
+    for pos in range(4):
+        m = Machine(
+            floor=FLOOR,
+            pos=pos,
+            status=MachineStatus.idle,
+            duration=timedelta(minutes=30),
+            type=MachineType.washer,
+        )
+        keys.append(m.create_key())
+        sync.json().set(m.create_key(), ".", m.to_document())
+
+    async def blocking():
+        res = sync.ft(index_name=machine_index.name).search(ms.build_query(mf))
+        return [ms.from_document(doc) for doc in res.docs]
+
+    try:
+        for c in CONCURRENCY:
+            await load("blocking", blocking, c)
+            await load("async", lambda: ms.find(mf), c)
+    finally:
+        sync.delete(*keys)
+        sync.close()
+        await aredis.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""Compares applying machine states reported by a raspi one request at a time,
+as with PUT /machine, against batches of them through POST /ingest.
+
+Run against the test redis with `python -m benchmarks.ingest`."""
+
+import asyncio
+import time
+from datetime import timedelta
+
+from app.config import get_settings
+from app.ingest import _headers, _record, binary_media_type, decode, frame_version
+from app.machine import Machine, MachineStatus, MachineType
+from app.raspi import RaspiOut
+from app.redis.ingest import IngestService
+from app.redis.machine import MachineService, raspi_seq_key
+from redis.asyncio import Redis
+
+FLOOR = 999
+MACHINES = 100
+N = 5000
+
+# Alternating between these does not queue usage records.
+CODES = [(1, MachineStatus.in_use), (2, MachineStatus.finishing)]
+
+
+async def run(name: str, apply) -> None:
+    t = time.perf_counter()
+    await apply()
+    elapsed = time.perf_counter() - t
+    print(f"{name:>20}: {N / elapsed:8.0f} events/s")
+
+
+async def one_at_a_time(ms: MachineService) -> None:
+    for i in range(N):
+        await ms.set_status(FLOOR, i % MACHINES, CODES[i // MACHINES % 2][1])
+
+
+async def batched(ins: IngestService, size: int, seq: int) -> None:
+    now = time.time()
+    header = _headers[frame_version]
+    for start in range(0, N, size):
+        records = [
+            _record.pack(i % MACHINES, CODES[i // MACHINES % 2][0], now, seq + i + 1)
+            for i in range(start, start + size)
+        ]
+        body = header.pack(frame_version, FLOOR, size, bytes([10, 0, 0, 2]))
+        await ins.ingest(decode(binary_media_type, body + b"".join(records)))
+
+
+async def main() -> None:
+    redis = Redis.from_url(get_settings().redis_test_url)
+    ms = MachineService(redis)
+    ins = IngestService(redis, ms)
+    machines = [
+        Machine(
+            floor=FLOOR,
+            pos=pos,
+            status=MachineStatus.idle,
+            duration=timedelta(minutes=30),
+            type=MachineType.washer,
+        )
+        for pos in range(MACHINES)
+    ]
+    for m in machines:
+        await redis.json().set(m.create_key(), ".", m.to_document())
+
+    try:
+        await run("one at a time", lambda: one_at_a_time(ms))
+        for i, size in enumerate([10, 100]):
+            await run(f"ingest, {size} per frame", lambda: batched(ins, size, i * N))
+    finally:
+        await redis.delete(*[m.create_key() for m in machines])
+        await redis.delete(RaspiOut._create_key(FLOOR))
+        await redis.hdel(raspi_seq_key, FLOOR)
+        await redis.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
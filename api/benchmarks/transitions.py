@@ -0,0 +1,114 @@
+"""Compares starting and stopping a machine with the atomic transition script
+against the previous GET-then-SET implementation.
+
+The transitions are timed through MachineService.start and stop, as the
+endpoints call them. The snapshot is rebuilt by the first read after a write,
+not by the write, so its cost is not part of a transition. The events and usage
+records appended for the benchmark machine are deleted when it finishes.
+
+Run against the test redis with `python -m benchmarks.transitions`."""
+
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from app.config import get_settings
+from app.machine import Machine, MachineStatus, MachineType, MachineUpdate
+from app.redis.duration import duration_key
+from app.redis.events import events_stream
+from app.redis.machine import MachineService, floor_versions_key
+from app.redis.snapshot import snapshot_key
+from app.redis.usage import usage_stream
+from fastapi.encoders import jsonable_encoder
+from redis.asyncio import Redis
+
+N = 2000
+
+
+async def get_then_set(ms: MachineService, floor: int, pos: int, mu: MachineUpdate):
+    """The implementation of MachineService.update before transition.lua."""
+    key = Machine._create_key(floor, pos)
+    old = Machine(**await ms.rj.get(key))
+    new = old.copy(update=mu.dict(exclude_unset=True, exclude_none=True))
+    await ms.rj.set(key, ms.root_path, jsonable_encoder(new))
+    return new
+
+
+async def last_id(redis: Redis, stream: str) -> bytes:
+    res = await redis.xrevrange(stream, count=1)
+    return res[0][0] if res else b"0-0"
+
+
+def is_about(fields: dict, m: Machine) -> bool:
+    """Whether an entry of the usage or event stream is about `m`."""
+    if b"loc" in fields:
+        return fields[b"loc"] == m.create_typed_key().encode()
+    return fields.get(b"floor") == str(m.floor).encode()
+
+
+async def delete_added(redis: Redis, stream: str, since: bytes, m: Machine) -> int:
+    """Deletes the entries about `m` appended to the stream after `since`, and
+    returns how many were deleted."""
+    entries = await redis.xrange(stream, min=b"(" + since)
+    ids = [id for id, fields in entries if is_about(fields, m)]
+    return await redis.xdel(stream, *ids) if ids else 0
+
+
+async def run(name: str, start, stop) -> None:
+    t = time.perf_counter()
+    for _ in range(N):
+        await start()
+        await stop()
+    elapsed = time.perf_counter() - t
+    print(
+        f"{name:>14}: {2 * N / elapsed:8.0f} transitions/s, "
+        f"{elapsed / (2 * N) * 1e6:6.0f} us/transition"
+    )
+
+
+async def main() -> None:
+    redis = Redis.from_url(get_settings().redis_test_url)
+    ms = MachineService(redis)
+    m = Machine(
+        floor=999,
+        pos=0,
+        status=MachineStatus.idle,
+        duration=timedelta(minutes=30),
+        type=MachineType.washer,
+    )
+    await redis.json().set(m.create_key(), ".", m.to_document())
+    streams = {s: await last_id(redis, s) for s in (events_stream, usage_stream)}
+
+    try:
+        await run(
+            "get-then-set",
+            lambda: get_then_set(
+                ms,
+                m.floor,
+                m.pos,
+                MachineUpdate(
+                    status=MachineStatus.in_use, last_started_at=datetime.utcnow()
+                ),
+            ),
+            lambda: get_then_set(
+                ms, m.floor, m.pos, MachineUpdate(status=MachineStatus.idle)
+            ),
+        )
+        await run(
+            "transition.lua",
+            lambda: ms.start(m.floor, m.pos),
+            lambda: ms.stop(m.floor, m.pos),
+        )
+        print("  (snapshot rebuilds are left to the next read of the snapshot)")
+    finally:
+        for stream, since in streams.items():
+            await delete_added(redis, stream, since, m)
+        await redis.delete(m.create_key(), duration_key(m.floor, m.pos))
+        await redis.hdel(floor_versions_key, m.floor)
+        # the snapshot may hold the machine, so the next read rebuilds it
+        await redis.hincrby(snapshot_key, "version", 1)
+        await redis.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
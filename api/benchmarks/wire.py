@@ -0,0 +1,61 @@
+"""Compares the size and decode cost of a raspi's machine states in the JSON
+accepted by PUT /machine/bulk/state against the frames accepted by POST /ingest.
+
+Needs no redis, run with `python -m benchmarks.wire`."""
+
+import json
+import time
+from datetime import datetime
+from typing import Any, Callable, List
+
+from app.ingest import _headers, _record, decode_binary, decode_json, frame_version
+from app.machine import MachineState
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_raw_as
+
+N = 2000
+
+
+def run(name: str, body: bytes, decode: Callable[[bytes], Any]):
+    t = time.perf_counter()
+    for _ in range(N):
+        decode(body)
+    elapsed = time.perf_counter() - t
+    print(f"{name:>16}: {len(body):6d} bytes, {elapsed / N * 1e6:7.1f} us/frame")
+
+
+def main() -> None:
+    now = time.time()
+    for n in [1, 4, 26, 100]:
+        records = [(pos % 256, pos % 3, now + pos, pos) for pos in range(n)]
+        bulk = [
+            {
+                "floor": 5,
+                "pos": pos,
+                "status": ["idle", "in_use", "finishing"][state],
+                "at": datetime.utcfromtimestamp(at),
+            }
+            for pos, state, at, _ in records
+        ]
+
+        print(f"{n} machine(s):")
+        run(
+            "json (pydantic)",
+            json.dumps(jsonable_encoder(bulk)).encode(),
+            lambda b: parse_raw_as(List[MachineState], b),
+        )
+        run(
+            "json frame",
+            json.dumps({"v": frame_version, "floor": 5, "records": records}).encode(),
+            decode_json,
+        )
+        header = _headers[frame_version].pack(frame_version, 5, n, bytes(4))
+        run(
+            "binary frame",
+            header + b"".join(_record.pack(*r) for r in records),
+            decode_binary,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,17 @@
+import asyncio
 from datetime import timedelta
 
 import pytest
 from app.config import get_settings
 from app.machine import Machine, MachineStatus, MachineType
-from app.raspi import RaspiIn
-from app.redis.machine import MachineService
-from app.redis.raspi import RaspiService
+from app.raspi import RaspiIn, RaspiOut
+from app.redis.duration import duration_key
+from app.redis.index import ensure_indexes
+from app.redis.ingest import IngestService
+from app.redis.machine import MachineService, flagged_key, machine_index, raspi_seq_key
+from app.redis.raspi import RaspiService, raspi_index
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 
 
 @pytest.fixture(scope="session")
@@ -17,13 +22,37 @@ def redis():
 
 
 @pytest.fixture(scope="session")
-def machine_service(redis):
-    return MachineService(redis)
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
 
 
 @pytest.fixture(scope="session")
-def raspi_service(redis):
-    return RaspiService(redis)
+async def async_redis():
+    client = AsyncRedis.from_url(get_settings().redis_test_url)
+    yield client
+    await client.close()
+
+
+@pytest.fixture(scope="session")
+async def indexes(async_redis):
+    await ensure_indexes(async_redis, [machine_index, raspi_index])
+
+
+@pytest.fixture(scope="session")
+def machine_service(async_redis, indexes):
+    return MachineService(async_redis)
+
+
+@pytest.fixture(scope="session")
+def raspi_service(async_redis, indexes):
+    return RaspiService(async_redis)
+
+
+@pytest.fixture(scope="session")
+def ingest_service(async_redis, machine_service):
+    return IngestService(async_redis, machine_service)
 
 
 @pytest.fixture(scope="session")
@@ -37,6 +66,23 @@ def mock_washer():
     )
 
 
+@pytest.fixture
+async def washer(redis, machine_service, mock_washer):
+    """Creates the mock washer, yields it as stored, and deletes it and
+    everything written about it and its floor afterwards."""
+    await machine_service.create(mock_washer)
+    key = mock_washer.create_key()
+    yield Machine(**redis.json().get(key))
+    redis.json().delete(key)
+    redis.delete(
+        duration_key(mock_washer.floor, mock_washer.pos),
+        flagged_key(mock_washer.floor),
+        RaspiOut._create_key(mock_washer.floor),
+    )
+    redis.hdel(raspi_seq_key, mock_washer.floor)
+    await machine_service.snapshot_store.rebuild()
+
+
 @pytest.fixture(scope="session")
 def mock_dryer():
     return Machine(
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+import pytest
+from app.machine import Machine, MachineStatus
+from app.redis.duration import DurationModel, min_samples
+from app.usage import UsageDetail
+
+
+@pytest.fixture
+def durations(async_redis):
+    return DurationModel(async_redis)
+
+
+def cycles(m: Machine, minutes: int, n: int, hour: int = 10):
+    started = datetime(2022, 1, 3, hour)
+    return [
+        UsageDetail(
+            loc=m.create_typed_key(),
+            started_at=started,
+            stopped_at=started + timedelta(minutes=minutes),
+        )
+        for _ in range(n)
+    ]
+
+
+async def test_learn(durations, washer):
+    assert await durations.learn(cycles(washer, 40, min_samples - 1)) == 2
+    assert await durations.estimate(washer.floor, washer.pos, 10) is None
+
+    await durations.learn(cycles(washer, 40, 1))
+    est = await durations.estimate(washer.floor, washer.pos, 10)
+    assert est.mean == timedelta(minutes=40)
+    assert est.stddev == timedelta(0)
+
+    # other hours fall back to the cycles of every hour
+    est = await durations.estimate(washer.floor, washer.pos, 22)
+    assert est.mean == timedelta(minutes=40)
+
+
+async def test_learn_quantiles(durations, washer):
+    # one cycle left running long after the laundry was done
+    await durations.learn(cycles(washer, 40, 9) + cycles(washer, 120, 1))
+
+    est = await durations.estimate(washer.floor, washer.pos)
+    assert est.samples == 10
+    assert timedelta(minutes=40) <= est.p50 < timedelta(minutes=45) < est.mean
+    assert est.p50 <= est.p90
+
+
+async def test_learn_skips_glitches(durations, washer):
+    assert await durations.learn(cycles(washer, 0, 1) + cycles(washer, 600, 1)) == 0
+
+
+async def test_start_uses_learned_duration(machine_service, durations, washer):
+    await durations.learn(cycles(washer, 42, min_samples, hour=datetime.utcnow().hour))
+
+    started = await machine_service.start(washer.floor, washer.pos)
+    assert started.status == MachineStatus.in_use
+    assert started.duration == timedelta(minutes=42)
+    assert started.estimated_finish_at == started.last_started_at + started.duration
+    assert timedelta(minutes=41) < started.approx_time_left <= started.duration
+
+    stopped = await machine_service.stop(washer.floor, washer.pos)
+    assert stopped.approx_time_left == timedelta(0)
+    assert stopped.estimated_finish_at is None
@@ -0,0 +1,77 @@
+import asyncio
+import json
+from contextlib import AsyncExitStack
+
+import pytest
+from app.machine import MachineStatus
+from app.redis.events import MachineEvents, events_stream
+from app.routers.machine import _stream_events
+
+
+@pytest.fixture
+async def events(redis, async_redis):
+    redis.delete(events_stream)
+    yield MachineEvents(async_redis)
+    redis.delete(events_stream)
+
+
+async def test_subscribe_receives_updates(machine_service, events, washer):
+    async with events.subscribe() as sub:
+        await machine_service.start(washer.floor, washer.pos)
+        event = await asyncio.wait_for(sub.get(), 5)
+
+    assert event.floor == washer.floor
+    assert event.type == washer.type
+    assert json.loads(event.machine)["status"] == MachineStatus.in_use
+
+
+async def test_replay_after_event_id(machine_service, events, washer):
+    await machine_service.start(washer.floor, washer.pos)
+    await machine_service.stop(washer.floor, washer.pos)
+
+    started, stopped = (await events.replay("0-0"))[-2:]
+    assert json.loads(started.machine)["status"] == MachineStatus.in_use
+
+    res = await events.replay(started.id)
+    assert [e.id for e in res] == [stopped.id]
+    assert json.loads(res[0].machine)["status"] == MachineStatus.idle
+
+
+async def test_concurrent_subscribers_share_reader(machine_service, events, washer):
+    async with AsyncExitStack() as stack:
+        subs = await asyncio.gather(
+            *(stack.enter_async_context(events.subscribe()) for _ in range(3))
+        )
+        readers = [
+            t
+            for t in asyncio.all_tasks()
+            if t.get_coro().__qualname__ == "MachineEvents._read"
+        ]
+        assert readers == [events._reader]
+
+        await machine_service.start(washer.floor, washer.pos)
+        for s in subs:
+            await asyncio.wait_for(s.get(), 5)
+        await asyncio.sleep(0.1)
+        assert all(s.queue.empty() for s in subs)
+
+
+async def test_events_wait_ends_after_events(machine_service, events, washer):
+    async def start():
+        await asyncio.sleep(0.5)
+        await machine_service.start(washer.floor, washer.pos)
+
+    asyncio.ensure_future(start())
+    res = [e async for e in _stream_events(events, washer.floor, None, None, wait=5)]
+
+    assert "event: machine" in res[0]
+    last_id = res[0].split("\n")[0]
+    assert res[-1] == f"{last_id}\nevent: position\ndata:\n\n"
+
+
+async def test_events_wait_times_out_with_position(events):
+    latest = await events.latest_id()
+
+    res = [e async for e in _stream_events(events, None, None, None, wait=1)]
+
+    assert res == [f"id: {latest}\nevent: position\ndata:\n\n"]
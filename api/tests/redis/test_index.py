@@ -0,0 +1,55 @@
+import pytest
+from app import metrics
+from app.redis.index import IndexSpec, ensure_index
+from app.redis.machine import MachineService
+from redis.commands.search.field import NumericField, TextField
+
+_fields = [
+    NumericField("$.floor", sortable=True, as_name="floor"),
+    TextField("$.name", sortable=True, as_name="name"),
+]
+
+
+@pytest.fixture
+def spec(redis):
+    s = IndexSpec(name="testIdx", prefix="test:", version=1, fields=_fields[:1])
+    yield s
+    redis.ft(index_name=s.name).dropindex(delete_documents=False)
+    redis.delete(s.meta_key)
+
+
+async def test_ensure_index_is_idempotent(redis, async_redis, spec):
+    before = metrics.get("redis_index_create")
+    await ensure_index(async_redis, spec)
+    await ensure_index(async_redis, spec)
+    assert metrics.get("redis_index_create") == before + 1
+    assert int(redis.hget(spec.meta_key, "version")) == 1
+
+
+async def test_ensure_index_alters_added_fields(redis, async_redis, spec):
+    await ensure_index(async_redis, spec)
+    before = metrics.get("redis_index_create")
+
+    spec.version, spec.fields = 2, _fields
+    await ensure_index(async_redis, spec)
+
+    assert metrics.get("redis_index_create") == before
+    assert int(redis.hget(spec.meta_key, "version")) == 2
+    assert "name" in str(redis.ft(index_name=spec.name).info()["attributes"])
+
+
+async def test_ensure_index_recreates_changed_fields(redis, async_redis, spec):
+    await ensure_index(async_redis, spec)
+    before = metrics.get("redis_index_create")
+
+    spec.version, spec.fields = 2, _fields[1:]
+    await ensure_index(async_redis, spec)
+
+    assert metrics.get("redis_index_create") == before + 1
+    assert int(redis.hget(spec.meta_key, "version")) == 2
+
+
+def test_service_does_not_create_index(async_redis, indexes):
+    before = metrics.get("redis_index_create")
+    MachineService(async_redis)
+    assert metrics.get("redis_index_create") == before
@@ -0,0 +1,86 @@
+from datetime import datetime
+
+from app.ingest import Frame, Record
+from app.machine import MachineStatus
+from app.raspi import RaspiOut
+from app.redis.machine import flagged_key
+from app.redis.usage import usage_stream
+
+
+async def test_ingest(redis, ingest_service, washer):
+    w = washer
+    at = datetime(2021, 10, 1, 12, 30)
+    frame = Frame(w.floor, "10.0.0.2", [Record(w.pos, MachineStatus.in_use, at, 1)])
+
+    res = await ingest_service.ingest(frame)
+
+    assert (res.applied, res.duplicate, res.rejected) == (1, 0, [])
+    machine = redis.json().get(w.create_key())
+    assert machine["status"] == MachineStatus.in_use
+    assert machine["last_started_at"] == at.isoformat()
+    assert redis.json().get(RaspiOut._create_key(w.floor))["ip_addr"] == "10.0.0.2"
+
+
+async def test_ingest_duplicate(redis, ingest_service, washer):
+    w = washer
+    at = datetime.utcnow()
+    start = Record(w.pos, MachineStatus.in_use, at, 1)
+    stop = Record(w.pos, MachineStatus.idle, at, 2)
+
+    await ingest_service.ingest(Frame(w.floor, None, [start]))
+    # a retried frame, after the first one was applied but its response was lost
+    res = await ingest_service.ingest(Frame(w.floor, None, [start, stop]))
+
+    assert (res.applied, res.duplicate, res.rejected) == (1, 1, [])
+    assert redis.json().get(w.create_key())["status"] == MachineStatus.idle
+
+
+async def test_ingest_rejected(ingest_service, washer):
+    w = washer
+    stop = Record(w.pos, MachineStatus.idle, datetime.utcnow(), 1)
+    missing = Record(99, MachineStatus.idle, datetime.utcnow(), 2)
+
+    res = await ingest_service.ingest(Frame(w.floor, None, [stop, missing]))
+
+    assert res.applied == 0
+    assert "idle" in res.rejected[0].detail
+    assert "not found" in res.rejected[1].detail
+
+
+async def test_ingest_restores_flagged(redis, machine_service, ingest_service, washer):
+    w = washer
+    started = await machine_service.start(w.floor, w.pos)
+    await machine_service.flag_error([w.floor])
+    assert redis.json().get(w.create_key())["status"] == MachineStatus.error
+
+    # the raspi comes back, and reports the cycle it saw end meanwhile
+    stop = Record(w.pos, MachineStatus.idle, datetime.utcnow(), 1)
+    res = await ingest_service.ingest(Frame(w.floor, None, [stop]))
+
+    assert res.applied == 1
+    assert redis.json().get(w.create_key())["status"] == MachineStatus.idle
+    assert not redis.exists(flagged_key(w.floor))
+    _, usage = redis.xrevrange(usage_stream, count=1)[0]
+    assert usage[b"started_at"].decode() == started.last_started_at.isoformat()
+
+
+async def test_ingest_each_outcome(machine_service, ingest_service, washer):
+    # a flagged machine makes the heartbeat queue a restore before the records
+    await machine_service.flag_error([washer.floor])
+    at = datetime.utcnow()
+    records = [
+        Record(washer.pos, MachineStatus.in_use, at, 1),
+        Record(99, MachineStatus.idle, at, 2),
+        Record(washer.pos, MachineStatus.in_use, at, 3),
+        Record(washer.pos, MachineStatus.idle, at, 4),
+    ]
+
+    res = await ingest_service.ingest(Frame(washer.floor, None, records))
+
+    assert (res.applied, res.duplicate) == (2, 0)
+    assert [r.pos for r in res.rejected] == [99, washer.pos]
+    assert "not found" in res.rejected[0].detail
+    assert "in_use" in res.rejected[1].detail
+
+    res = await ingest_service.ingest(Frame(washer.floor, None, records[3:]))
+    assert (res.applied, res.duplicate, res.rejected) == (0, 1, [])
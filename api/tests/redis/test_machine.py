@@ -1,71 +1,62 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pytest
 from app.machine import (
     Machine,
     MachineFilter,
+    MachineState,
     MachineStatus,
     MachineType,
     MachineUpdate,
 )
-from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import HTTPException
 
 
 @pytest.fixture
-def create_washer(redis, machine_service, mock_washer):
-    machine_service.create(mock_washer)
-    rj = redis.json()
-    key = mock_washer.create_key()
-    yield rj.get(key)
-    rj.delete(key)
-
-
-@pytest.fixture
-def create_dryer(redis, machine_service, mock_dryer):
-    machine_service.create(mock_dryer)
+async def create_dryer(redis, machine_service, mock_dryer):
+    await machine_service.create(mock_dryer)
     rj = redis.json()
     key = mock_dryer.create_key()
     yield rj.get(key)
     rj.delete(key)
 
 
-def test_create_machine(create_washer, mock_washer, create_dryer, mock_dryer):
-    assert create_washer == jsonable_encoder(mock_washer)
-    assert create_dryer == jsonable_encoder(mock_dryer)
+async def test_create_machine(washer, mock_washer, create_dryer, mock_dryer):
+    assert washer.to_document() == mock_washer.to_document()
+    assert create_dryer == mock_dryer.to_document()
 
 
-def test_create_dup_machine(create_washer, mock_washer, machine_service):
+async def test_create_dup_machine(washer, mock_washer, machine_service):
     with pytest.raises(HTTPException):
-        machine_service.create(mock_washer)
+        await machine_service.create(mock_washer)
 
 
-def test_find_machine(
-    machine_service, create_washer, mock_washer, create_dryer, mock_dryer
+async def test_find_machine(
+    machine_service, washer, mock_washer, create_dryer, mock_dryer
 ):
-    res = machine_service.find(MachineFilter(floor=14))
+    res = await machine_service.find(MachineFilter(floor=14))
     assert res == [mock_washer, mock_dryer]
 
-    res = machine_service.find(MachineFilter(type=MachineType.washer))
+    res = await machine_service.find(MachineFilter(type=MachineType.washer))
     assert res == [mock_washer]
 
-    res = machine_service.find(MachineFilter(status=MachineStatus.error))
+    res = await machine_service.find(MachineFilter(status=MachineStatus.error))
     assert res == []
 
 
-def test_update_machine(redis, machine_service, create_washer, create_dryer):
+async def test_update_machine(redis, machine_service, washer, create_dryer):
     rj = redis.json()
 
-    new_w = machine_service.update(
-        create_washer["floor"],
-        create_washer["pos"],
+    new_w = await machine_service.update(
+        washer.floor,
+        washer.pos,
         MachineUpdate(status=MachineStatus.in_use),
     )
     assert new_w.status == MachineStatus.in_use
     assert rj.get(new_w.create_key())["status"] == MachineStatus.in_use
 
     now = datetime.utcnow()
-    new_d = machine_service.update(
+    new_d = await machine_service.update(
         create_dryer["floor"],
         create_dryer["pos"],
         MachineUpdate(last_started_at=now),
@@ -74,11 +65,11 @@ def test_update_machine(redis, machine_service, create_washer, create_dryer):
     assert rj.get(new_d.create_key())["last_started_at"] == now.isoformat()
 
 
-def test_start_machine(redis, machine_service, create_washer):
+async def test_start_machine(redis, machine_service, washer):
     rj = redis.json()
-    w = Machine(**create_washer)
+    w = washer
 
-    machine_service.start(w.floor, w.pos)
+    await machine_service.start(w.floor, w.pos)
     res = rj.get(w.create_key())
     w_updated = Machine(**res)
 
@@ -86,14 +77,134 @@ def test_start_machine(redis, machine_service, create_washer):
     pytest.approx(datetime.utcnow(), w_updated.last_started_at)
 
 
-def test_stop_machine(redis, machine_service, create_washer):
+async def test_stop_machine(redis, machine_service, washer):
     rj = redis.json()
-    w = Machine(**create_washer)
+    w = washer
 
     rj.set(w.create_key(), ".status", MachineStatus.error, xx=True)
 
-    machine_service.stop(w.floor, w.pos)
+    await machine_service.stop(w.floor, w.pos)
     res = rj.get(w.create_key())
     w_updated = Machine(**res)
 
     assert w_updated.status == MachineStatus.idle
+
+
+async def test_stop_idle_machine(redis, machine_service, washer):
+    w = washer
+
+    with pytest.raises(HTTPException) as e:
+        await machine_service.stop(w.floor, w.pos)
+    assert e.value.status_code == 409
+    assert redis.json().get(w.create_key())["status"] == MachineStatus.idle
+
+
+async def test_start_returns_machine(machine_service, washer):
+    w = washer
+
+    res = await machine_service.start(w.floor, w.pos)
+    assert res.status == MachineStatus.in_use
+    assert res.last_started_at > w.last_started_at
+
+
+async def test_update_missing_machine(machine_service):
+    with pytest.raises(HTTPException) as e:
+        await machine_service.update(420, 0, MachineUpdate(status=MachineStatus.idle))
+    assert e.value.status_code == 404
+
+
+async def test_find_machine_pages(
+    machine_service, washer, mock_washer, create_dryer, mock_dryer
+):
+    res, cursor = await machine_service.find_page(MachineFilter(floor=14), limit=1)
+    assert res == [mock_washer]
+
+    pages = []
+    while cursor is not None:
+        page, cursor = await machine_service.find_page(
+            MachineFilter(floor=14), limit=1, cursor=cursor
+        )
+        pages += page
+    assert pages == [mock_dryer]
+
+
+async def test_find_machine_invalid_cursor(machine_service):
+    with pytest.raises(HTTPException) as e:
+        await machine_service.find_page(MachineFilter(), limit=1, cursor="420")
+    assert e.value.status_code == 400
+
+
+async def test_version_increases_on_update(machine_service, washer):
+    w = washer
+    floor_version = await machine_service.version(w.floor)
+    version = await machine_service.version()
+
+    await machine_service.start(w.floor, w.pos)
+
+    assert await machine_service.version(w.floor) == floor_version + 1
+    assert await machine_service.version() == version + 1
+    assert await machine_service.version(420) == 0
+
+
+async def test_bulk_upsert(redis, machine_service, mock_washer, mock_dryer):
+    res = await machine_service.bulk_upsert([mock_washer, mock_dryer])
+    try:
+        assert [r.ok for r in res] == [True, True]
+        assert redis.json().get(mock_dryer.create_key()) == mock_dryer.to_document()
+    finally:
+        redis.delete(mock_washer.create_key(), mock_dryer.create_key())
+
+
+async def test_bulk_set_status(machine_service, washer, create_dryer):
+    w, d = washer, Machine(**create_dryer)
+
+    res = await machine_service.bulk_set_status(
+        [
+            MachineState(floor=w.floor, pos=w.pos, status=MachineStatus.in_use),
+            MachineState(floor=d.floor, pos=d.pos, status=MachineStatus.idle),
+            MachineState(floor=420, pos=0, status=MachineStatus.error),
+        ]
+    )
+
+    assert [r.ok for r in res] == [True, False, False]
+    assert res[0].machine.status == MachineStatus.in_use
+    assert "idle" in res[1].detail
+    assert "not found" in res[2].detail
+
+
+async def test_bulk_set_status_replayed(machine_service, washer):
+    w = washer
+    at = datetime(2021, 10, 1, 12, 30)
+
+    res = await machine_service.bulk_set_status(
+        [MachineState(floor=w.floor, pos=w.pos, status=MachineStatus.in_use, at=at)]
+    )
+
+    assert res[0].ok
+    assert res[0].machine.last_started_at == at
+
+
+async def test_flag_error(redis, machine_service, washer, create_dryer):
+    w = washer
+    await machine_service.set_status(w.floor, w.pos, MachineStatus.error)
+
+    res = await machine_service.flag_error([w.floor, 420])
+
+    # the washer already was an error
+    assert [(r.pos, r.ok) for r in res] == [(create_dryer["pos"], True)]
+    dryer = redis.json().get(Machine._create_key(w.floor, create_dryer["pos"]))
+    assert dryer["status"] == MachineStatus.error
+
+
+async def test_update_machine_utc_suffix(redis, machine_service, washer):
+    w = washer
+    # as written by seed.lua
+    redis.json().set(w.create_key(), ".last_started_at", "1970-01-01T00:00:00Z")
+
+    res = await machine_service.update(
+        w.floor, w.pos, MachineUpdate(status=MachineStatus.in_use)
+    )
+
+    assert res.last_started_at == datetime(1970, 1, 1)
+    assert res.approx_time_left == timedelta(0)
+    assert (await machine_service.find(MachineFilter(floor=w.floor)))[0] == res
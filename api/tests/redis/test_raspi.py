@@ -1,64 +1,112 @@
+from datetime import datetime, timedelta
+
 import pytest
+from app.machine import MachineStatus
 from app.raspi import RaspiFilter, RaspiIn, RaspiUpdate
+from app.redis.raspi import raspi_seen_key
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import HTTPException
 
 
 @pytest.fixture
-def create_raspi(redis, raspi_service, mock_raspi_in):
+async def create_raspi(redis, raspi_service, mock_raspi_in):
     rj = redis.json()
     key = mock_raspi_in.create_key()
     rj.delete(key)
-    raspi_service.create(mock_raspi_in)
+    await raspi_service.create(mock_raspi_in)
     yield rj.get(key)
     rj.delete(key)
 
 
-def test_create_raspi(create_raspi, mock_raspi_out):
+async def test_create_raspi(create_raspi, mock_raspi_out):
     assert pytest.approx(create_raspi, jsonable_encoder(mock_raspi_out))
 
 
-def test_create_dup_raspi(raspi_service, create_raspi, mock_raspi_in):
+async def test_create_dup_raspi(raspi_service, create_raspi, mock_raspi_in):
     with pytest.raises(HTTPException):
-        raspi_service.create(mock_raspi_in)
+        await raspi_service.create(mock_raspi_in)
 
 
-def test_upsert_raspi_as_insert(redis, raspi_service):
+async def test_upsert_raspi_as_insert(redis, raspi_service):
     mock_raspi = RaspiIn(floor=11, ip_addr="133.220.202.160")
-    raspi_service.upsert(mock_raspi)
+    await raspi_service.upsert(mock_raspi)
 
     rj = redis.json()
     res = rj.get(mock_raspi.create_key())
     assert pytest.approx(res, jsonable_encoder(mock_raspi.to_raspi_out()))
 
 
-def test_upsert_raspi_as_update(redis, raspi_service, mock_raspi_in):
+async def test_upsert_raspi_as_update(redis, raspi_service, mock_raspi_in):
     mock_update = RaspiIn(floor=mock_raspi_in.floor, ip_addr="200.37.8.245")
     assert mock_update != mock_raspi_in
 
-    raspi_service.upsert(mock_update)
+    await raspi_service.upsert(mock_update)
 
     rj = redis.json()
     res = rj.get(mock_update.create_key())
     assert pytest.approx(res, jsonable_encoder(mock_update))
 
 
-def test_find_raspi(create_raspi, mock_raspi_out, raspi_service):
-    res = raspi_service.find(RaspiFilter(floor=mock_raspi_out.floor))
+async def test_find_raspi(create_raspi, mock_raspi_out, raspi_service):
+    res = await raspi_service.find(RaspiFilter(floor=mock_raspi_out.floor))
     assert pytest.approx(res, [mock_raspi_out])
 
-    res = raspi_service.find(RaspiFilter(floor=420))
+    res = await raspi_service.find(RaspiFilter(floor=420))
     assert res == []
 
 
-def test_update_raspi(create_raspi, mock_raspi_in, raspi_service):
+async def test_update_raspi(create_raspi, mock_raspi_in, raspi_service):
     update = RaspiUpdate(ip_addr="38.71.225.173")
-    res = raspi_service.update(mock_raspi_in.floor, update)
+    res = await raspi_service.update(mock_raspi_in.floor, update)
 
     assert res.ip_addr == update.ip_addr
 
 
-def test_update_missing_raspi(raspi_service):
+async def test_update_missing_raspi(raspi_service):
     with pytest.raises(HTTPException):
         update = RaspiUpdate(ip_addr="38.71.225.173")
-        raspi_service.update(420, update)
+        await raspi_service.update(420, update)
+
+
+async def test_find_stale_raspi(create_raspi, mock_raspi_in, raspi_service):
+    try:
+        res = await raspi_service.find_stale(timedelta(minutes=5))
+        assert mock_raspi_in.floor not in [r.floor for r in res]
+
+        an_hour_ago = datetime.utcnow() - timedelta(hours=1)
+        await raspi_service.update(
+            mock_raspi_in.floor, RaspiUpdate(updated_at=an_hour_ago)
+        )
+        res = await raspi_service.find_stale(timedelta(minutes=5))
+        assert mock_raspi_in.floor in [r.floor for r in res]
+    finally:
+        await raspi_service.redis.zrem(raspi_seen_key, mock_raspi_in.floor)
+
+
+async def test_upsert_restores_flagged(
+    redis, machine_service, raspi_service, mock_raspi_in, washer
+):
+    await machine_service.flag_error([washer.floor])
+    try:
+        await raspi_service.upsert(mock_raspi_in)
+        assert redis.json().get(washer.create_key())["status"] == MachineStatus.idle
+    finally:
+        await raspi_service.redis.zrem(raspi_seen_key, mock_raspi_in.floor)
+
+
+async def test_backfill_seen(create_raspi, mock_raspi_in, raspi_service):
+    redis = raspi_service.redis
+    try:
+        # a raspi which went silent before the set of last seen raspis existed
+        an_hour_ago = datetime.utcnow() - timedelta(hours=1)
+        await raspi_service.update(
+            mock_raspi_in.floor, RaspiUpdate(updated_at=an_hour_ago)
+        )
+        await redis.zrem(raspi_seen_key, mock_raspi_in.floor)
+
+        assert await raspi_service.backfill_seen() >= 1
+        assert await raspi_service.backfill_seen() == 0
+        res = await raspi_service.find_stale(timedelta(minutes=5))
+        assert mock_raspi_in.floor in [r.floor for r in res]
+    finally:
+        await redis.zrem(raspi_seen_key, mock_raspi_in.floor)
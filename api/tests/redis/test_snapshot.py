@@ -0,0 +1,41 @@
+import json
+
+from app.machine import Machine
+from app.redis.snapshot import snapshot_key
+
+
+async def test_snapshot_contains_machines(machine_service, washer):
+    _, body = await machine_service.snapshot()
+    assert washer.to_document() in json.loads(body)
+
+
+async def test_snapshot_version_changes_on_write(machine_service, washer):
+    version, _ = await machine_service.snapshot()
+
+    started = await machine_service.start(washer.floor, washer.pos)
+    new_version, body = await machine_service.snapshot()
+
+    assert new_version > version
+    assert started.to_document() in json.loads(body)
+    assert await machine_service.snapshot() == (new_version, body)
+
+
+async def test_snapshot_rebuilt_when_behind(redis, machine_service, washer):
+    redis.json().set(washer.create_key(), ".status", "error", xx=True)
+    redis.hincrby(snapshot_key, "version", 1)
+
+    _, body = await machine_service.snapshot()
+    docs = [Machine(**m) for m in json.loads(body)]
+    assert any(
+        m.create_key() == washer.create_key() and m.status == "error" for m in docs
+    )
+
+
+async def test_snapshot_rebuilt_on_read_not_write(redis, machine_service, washer):
+    await machine_service.snapshot()
+
+    await machine_service.start(washer.floor, washer.pos)
+    version, body_version = redis.hmget(snapshot_key, "version", "body_version")
+    assert int(body_version) < int(version)
+
+    assert (await machine_service.snapshot())[0] == int(version)
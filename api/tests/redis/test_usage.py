@@ -0,0 +1,65 @@
+import pytest
+from app.redis import usage
+from app.redis.usage import UsageQueue, usage_queue_stats, usage_stream
+
+
+@pytest.fixture
+async def queue(redis, async_redis):
+    redis.delete(usage_stream)
+    q = UsageQueue(async_redis, consumer="test")
+    await q.create_group()
+    yield q
+    redis.delete(usage_stream)
+
+
+async def test_stop_queues_usage(machine_service, queue, washer):
+    started = await machine_service.start(washer.floor, washer.pos)
+    await machine_service.stop(washer.floor, washer.pos)
+
+    entries = await queue.read()
+    assert len(entries) == 1
+    _, ud = entries[0]
+    assert ud.loc == washer.create_typed_key()
+    assert ud.started_at == started.last_started_at
+    assert ud.stopped_at >= ud.started_at
+
+
+async def test_stop_from_error_does_not_queue_usage(
+    redis, machine_service, queue, washer
+):
+    redis.json().set(washer.create_key(), ".status", "error", xx=True)
+    await machine_service.stop(washer.floor, washer.pos)
+
+    assert await queue.read() == []
+
+
+async def test_ack_removes_entries(async_redis, machine_service, queue, washer):
+    await machine_service.start(washer.floor, washer.pos)
+    await machine_service.stop(washer.floor, washer.pos)
+
+    stats = await usage_queue_stats(async_redis)
+    assert stats["usage_queue_depth"] == 1
+
+    entries = await queue.read()
+    assert (await usage_queue_stats(async_redis))["usage_queue_pending"] == 1
+
+    await queue.ack([id for id, _ in entries])
+    stats = await usage_queue_stats(async_redis)
+    assert stats["usage_queue_depth"] == 0
+    assert stats["usage_queue_pending"] == 0
+
+
+async def test_claim_acks_deleted_entries(redis, async_redis, monkeypatch, queue):
+    record = {
+        "loc": "washer:14:0",
+        "started_at": "2022-01-03T10:00:00",
+        "stopped_at": "2022-01-03T10:40:00",
+    }
+    deleted, kept = redis.xadd(usage_stream, record), redis.xadd(usage_stream, record)
+    assert [id for id, _ in await queue.read()] == [deleted, kept]
+    # trimmed before the consumer which read it acknowledged it
+    redis.xdel(usage_stream, deleted)
+    monkeypatch.setattr(usage, "_claim_idle_ms", 0)
+
+    assert [id for id, _ in await queue.claim()] == [kept]
+    assert (await usage_queue_stats(async_redis))["usage_queue_pending"] == 1
@@ -0,0 +1,181 @@
+from datetime import datetime, timedelta
+
+import pytest
+from app.analytics import (
+    Granularity,
+    busy_hours,
+    contributions,
+    period_key,
+    profile_key,
+    summarise,
+)
+from app.dynamodb.analytics import AnalyticsService, rollup_transaction
+from app.dynamodb.usage import group_usage, max_transaction_items, write_usage
+from app.usage import UsageDetail
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import HTTPException
+
+sgt = timedelta(hours=8)
+
+
+def usage(started_at, minutes):
+    return UsageDetail(
+        loc="washer:14:0",
+        started_at=started_at,
+        stopped_at=started_at + timedelta(minutes=minutes),
+    )
+
+
+def test_contributions_split_busy_time_across_hours():
+    # Sunday 18:40 to 19:30 in local time
+    totals = contributions(usage(datetime(2022, 1, 2, 10, 40), 50), sgt)
+
+    assert totals["H#2022-01-02T18"] == {
+        "cycles": 1,
+        "cycle_seconds": 3000,
+        "busy_seconds": 1200,
+    }
+    assert totals["H#2022-01-02T19"] == {"busy_seconds": 1800}
+    assert totals["D#2022-01-02"]["busy_seconds"] == 3000
+    assert totals[profile_key(6, 18)]["cycles"] == 1
+    assert totals[profile_key(6, 19)]["busy_seconds"] == 1800
+
+
+def test_contributions_across_days():
+    totals = contributions(usage(datetime(2022, 1, 2, 15, 30), 60), sgt)
+
+    assert totals["D#2022-01-02"]["busy_seconds"] == 1800
+    assert totals["D#2022-01-03"]["busy_seconds"] == 1800
+    assert "cycles" not in totals["D#2022-01-03"]
+
+
+def test_summarise():
+    totals = contributions(usage(datetime(2022, 1, 2, 10, 0), 30), sgt)
+    totals[period_key(Granularity.hour, datetime(2022, 1, 2, 19))].update(
+        contributions(usage(datetime(2022, 1, 2, 11, 0), 60), sgt)["H#2022-01-02T19"]
+    )
+
+    report = summarise(
+        datetime(2022, 1, 2, 18), datetime(2022, 1, 2, 21), Granularity.hour, 2, totals
+    )
+
+    assert [b.cycles for b in report["buckets"]] == [1, 1, 0]
+    assert report["buckets"][0].utilisation == pytest.approx(0.25)
+    assert report["buckets"][1].utilisation == pytest.approx(0.5)
+    assert report["buckets"][2].avg_cycle_seconds is None
+    assert report["cycles"] == 2
+    assert report["avg_cycle_seconds"] == pytest.approx(2700)
+    assert report["utilisation"] == pytest.approx(5400 / (3 * 3600 * 2))
+
+
+def test_busy_hours():
+    profile = {profile_key(6, 18): {"busy_seconds": 100}}
+    profile[profile_key(5, 9)] = {"busy_seconds": 300, "cycles": 2}
+
+    hours = busy_hours(profile)
+
+    assert [(h.weekday, h.hour) for h in hours] == [(5, 9), (6, 18)]
+    assert hours[0].share == pytest.approx(0.75)
+
+
+def test_contributions_clip_long_cycles():
+    totals = contributions(usage(datetime(2022, 1, 2, 10, 0), 60 * 24), sgt)
+
+    assert totals["D#2022-01-02"]["cycle_seconds"] == 4 * 3600
+    assert sum(t.get("busy_seconds", 0) for k, t in totals.items() if k[0] == "H") == (
+        4 * 3600
+    )
+
+
+class TransactionCanceled(Exception):
+    def __init__(self, reasons):
+        self.response = {"CancellationReasons": reasons}
+
+
+class FakeDynamoDB:
+    """Stands in for the boto3 resource, recording TransactWriteItems calls and
+    cancelling those which put a usage record already written."""
+
+    def __init__(self, written=()):
+        self.meta = self
+        self.client = self
+        self.exceptions = self
+        self.TransactionCanceledException = TransactionCanceled
+        self.written = set(written)
+        self.calls = []
+
+    def transact_write_items(self, TransactItems):
+        self.calls.append(TransactItems)
+        puts = [i["Put"]["Item"] for i in TransactItems if "Put" in i]
+        keys = [(p["loc"]["S"], p["started_at"]["S"]) for p in puts]
+        if any(k in self.written for k in keys):
+            reasons = [
+                {"Code": "ConditionalCheckFailed" if k in self.written else "None"}
+                for k in keys
+            ]
+            raise TransactionCanceled(reasons + [{"Code": "None"}] * len(puts))
+        self.written.update(keys)
+
+
+async def test_write_usage_batches_rollups():
+    uds = [usage(datetime(2022, 1, 2, 10, m), 30) for m in range(0, 50, 2)]
+    db = FakeDynamoDB()
+
+    assert await write_usage(db, uds) == uds
+
+    # every record of the hour adds to the same few rollups
+    assert len(db.calls) == 1
+    updates = [i["Update"] for i in db.calls[0] if "Update" in i]
+    assert len(
+        {(u["Key"]["scope"]["S"], u["Key"]["period"]["S"]) for u in updates}
+    ) == len(updates)
+    hour = next(
+        u
+        for u in updates
+        if u["Key"] == {"scope": {"S": "floor:14"}, "period": {"S": "H#2022-01-02T18"}}
+    )
+    assert hour["ExpressionAttributeValues"][":cycles"] == {"N": "25"}
+
+
+async def test_write_usage_skips_written():
+    uds = [usage(datetime(2022, 1, 2, 10, m), 30) for m in (0, 10, 20)]
+    written = {(uds[1].loc, jsonable_encoder(uds[1].started_at))}
+    db = FakeDynamoDB(written)
+
+    assert await write_usage(db, uds) == [uds[0], uds[2]]
+    assert len(db.calls) == 2
+
+
+def test_group_usage_fits_transactions():
+    uds = [usage(datetime(2022, 1, d, h), 240) for d in range(1, 8) for h in (0, 12)]
+
+    groups = group_usage(uds)
+
+    assert sum(groups, []) == uds
+    assert len(groups) > 1
+    assert all(len(rollup_transaction(g)) <= max_transaction_items for g in groups)
+
+
+def test_contributions_utc_suffix():
+    ud = UsageDetail(
+        loc="washer:14:0",
+        started_at="2022-01-02T10:40:00Z",
+        stopped_at=datetime(2022, 1, 2, 11, 30),
+    )
+
+    assert contributions(ud, sgt) == contributions(
+        usage(datetime(2022, 1, 2, 10, 40), 50), sgt
+    )
+
+
+async def test_usage_range_too_long():
+    class Tables:
+        def Table(self, name):
+            return None
+
+    ans = AnalyticsService(Tables(), ms=None)
+    start = datetime(2021, 1, 1)
+
+    with pytest.raises(HTTPException) as e:
+        await ans.usage(14, None, start, start + timedelta(days=400), Granularity.hour)
+    assert e.value.status_code == 400
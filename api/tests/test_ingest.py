@@ -0,0 +1,74 @@
+import json
+from datetime import datetime
+
+import pytest
+from app.ingest import (
+    _headers,
+    _record,
+    binary_media_type,
+    decode,
+    frame_version,
+    json_media_type,
+)
+from app.machine import MachineStatus
+from fastapi.exceptions import HTTPException
+
+at = datetime(2021, 10, 1, 12, 30)
+records = [(0, 1, (at - datetime(1970, 1, 1)).total_seconds(), 7), (3, -1, 0.0, 8)]
+
+
+def binary_frame(version=frame_version, floor=5, records=records):
+    header = [version, floor, len(records)] + (
+        [bytes([10, 0, 0, 2])] if version > 1 else []
+    )
+    body = _headers[version].pack(*header)
+    return body + b"".join(_record.pack(*r) for r in records)
+
+
+def json_frame(version=frame_version, floor=5, records=records):
+    frame = {"v": version, "floor": floor, "ip_addr": "10.0.0.2", "records": records}
+    return json.dumps(frame).encode()
+
+
+@pytest.mark.parametrize(
+    "media_type,body",
+    [(binary_media_type, binary_frame()), (json_media_type, json_frame())],
+)
+def test_decode(media_type, body):
+    frame = decode(media_type, body)
+
+    assert (frame.floor, frame.ip_addr) == (5, "10.0.0.2")
+    assert [(r.pos, r.status, r.seq) for r in frame.records] == [
+        (0, MachineStatus.in_use, 7),
+        (3, MachineStatus.error, 8),
+    ]
+    assert frame.records[0].at == at
+
+
+def test_decode_version_1():
+    frame = decode(binary_media_type, binary_frame(version=1))
+
+    assert frame.ip_addr is None
+    assert len(frame.records) == 2
+
+
+@pytest.mark.parametrize(
+    "media_type,body",
+    [
+        (binary_media_type, b"\x03" + binary_frame()[1:]),
+        (binary_media_type, binary_frame()[:-1]),
+        (binary_media_type, binary_frame(records=[(0, 5, 0.0, 1)])),
+        (json_media_type, json_frame(records=[(0, 1, 0.0)])),
+        (json_media_type, b"[]"),
+    ],
+)
+def test_decode_bad_frame(media_type, body):
+    with pytest.raises(HTTPException) as e:
+        decode(media_type, body)
+    assert e.value.status_code == 400
+
+
+def test_decode_unsupported_media_type():
+    with pytest.raises(HTTPException) as e:
+        decode("text/plain", json_frame())
+    assert e.value.status_code == 415
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+from debounce import SensorWorker, Transition
+from sensor import Machine
+from transport import Transport
+
+
+class Agent:
+    """
+    Event loop of the raspi.
+
+    Nothing here polls the sensors. The sensor worker publishes state transitions to a
+    queue, which the loop applies to the machines, so every state change happens on
+    this thread. Whenever a machine enters an active state, a timer is set for the
+    moment it would time out, and cancelled if the machine changes state before then.
+    The heartbeat to the backend is only sent when the IP address changes, or when
+    `keepalive` seconds have passed since the last one. Sensor edges are classified on
+    the worker's thread and state changes are sent by the transport's own thread, so a
+    slow network never holds up either.
+    """
+
+    def __init__(
+        self,
+        machines: List[Machine],
+        transport: Transport,
+        get_ip: Callable[[], str],
+        *,
+        worker: Callable[[Callable[[Transition], None]], SensorWorker] = SensorWorker,
+        keepalive: float = 600,
+        ip_interval: float = 30,
+    ) -> None:
+        self.machines = machines
+        self.transport = transport
+        self.get_ip = get_ip
+        self.make_worker = worker  # Called with the function publishing transitions
+        self.keepalive = keepalive  # Longest time between two heartbeats
+        self.ip_interval = ip_interval  # How often the IP address is checked locally
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._transitions: Optional["asyncio.Queue[Transition]"] = None
+        self._deadlines: Dict[str, asyncio.TimerHandle] = {}
+        self._ip: Optional[str] = None
+        self._last_heartbeat: float = 0
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._transitions = asyncio.Queue()
+
+        worker = self.make_worker(self._publish)
+        for m in self.machines:
+            worker.watch(m)
+            self._schedule(m)
+        worker.start()
+        try:
+            await asyncio.gather(self.apply_transitions(), self.heartbeat())
+        finally:
+            worker.stop()
+
+    async def apply_transitions(self) -> None:
+        while True:
+            t = await self._transitions.get()
+            t.machine.set_state(t.state, t.at)
+            self._schedule(t.machine)
+
+    async def heartbeat(self) -> None:
+        """Upserts this raspi whenever its IP address changes or the keepalive expires."""
+        while True:
+            ip = self.get_ip()
+            expired = time.monotonic() - self._last_heartbeat >= self.keepalive
+            if ip != self._ip or expired:
+                try:
+                    await self._loop.run_in_executor(
+                        None, self.transport.update_raspi, ip
+                    )
+                    self._ip = ip
+                    self._last_heartbeat = time.monotonic()
+                    logging.debug("Successfully updated RPi IP to backend.")
+                except Exception as e:
+                    logging.error(
+                        f"Error while trying to update RPi IP to backend. Error trace: {e}"
+                    )
+            await asyncio.sleep(self.ip_interval)
+
+    def _publish(self, t: Transition) -> None:
+        # Runs on the sensor worker's thread
+        self._loop.call_soon_threadsafe(self._transitions.put_nowait, t)
+
+    def _schedule(self, m: Machine) -> None:
+        """Replaces the timeout of a machine with one for its current state."""
+        handle = self._deadlines.pop(m.id, None)
+        if handle is not None:
+            handle.cancel()
+
+        deadline = m.deadline
+        if deadline is not None:
+            when = self._loop.time() + deadline - time.time()
+            self._deadlines[m.id] = self._loop.call_at(when, self._expire, m)
+
+    def _expire(self, m: Machine) -> None:
+        self._deadlines.pop(m.id, None)
+        m.update()
+        # Either the machine is now in error, or the clocks drifted apart
+        self._schedule(m)
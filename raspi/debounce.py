@@ -0,0 +1,256 @@
+import queue
+import threading
+import time
+from array import array
+from functools import partial
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sensor import Machine
+
+
+class Transition(NamedTuple):
+    machine: Machine
+    state: int
+    at: float  # Unix time at which the state changed
+
+
+class EdgeClassifier:
+    """
+    Debounces the edges of one sensor into machine states, from their timestamps alone.
+
+    - Staying active for `hold_time` seconds means the machine is in use (1).
+    - Becoming active again within `hold_time` seconds of going inactive means the
+      machine is finishing (2).
+    - Staying inactive for `hold_time` seconds means the machine is unutilised (0).
+
+    Nothing here sleeps or reads the clock: callers pass in the time of every edge, and
+    call `poll` once the time returned by `deadline` has passed.
+    """
+
+    def __init__(self, hold_time: float, active: bool, at: float) -> None:
+        self.hold_time = hold_time
+        self.active = active
+        self.since = at  # Time of the last edge
+        self._held = False  # Whether the current activation already counted as held
+        self._waiting = False  # Whether an activation would now mean finishing
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """Time at which the state changes if no edge comes before then."""
+        if (self.active and not self._held) or (not self.active and self._waiting):
+            return self.since + self.hold_time
+        return None
+
+    def poll(self, now: float) -> List[Tuple[int, float]]:
+        """Returns the state reached at the deadline, and the deadline, if it has
+        passed by `now`."""
+        deadline = self.deadline
+        if deadline is None or now < deadline:
+            return []
+        if self.active:
+            self._held = True
+            return [(1, deadline)]
+        self._waiting = False
+        return [(0, deadline)]
+
+    def feed(self, at: float, active: bool) -> List[Tuple[int, float]]:
+        """Records an edge at time `at`, and returns the states reached up to then,
+        with the time each was reached."""
+        states = self.poll(at)
+        if active == self.active:
+            return states
+
+        self.active = active
+        self.since = at
+        self._held = False
+        if active and self._waiting:
+            self._waiting = False
+            states.append((2, at))
+        elif not active:
+            self._waiting = True
+        return states
+
+
+class DutyCycleClassifier:
+    """
+    Classifies a machine's state from samples of its sensor, by the fraction of the last
+    `size` samples which were active.
+
+    - A duty cycle of at least `high` means the machine is in use (1).
+    - A duty cycle of at most `low` means the machine is unutilised (0).
+    - Falling between the two from in use means the machine is finishing (2), and
+      anything else in between keeps the current state, so noise around either
+      threshold does not flap the state.
+
+    Samples are kept in a fixed array used as a ring buffer, and the duty cycle is
+    updated as each sample replaces the oldest, so sampling allocates nothing.
+    """
+
+    def __init__(self, size: int, high: float, low: float, state: int = 0) -> None:
+        self.size = size
+        self.high = high * size  # Thresholds as counts of active samples
+        self.low = low * size
+        self.state = state
+        # Start from samples matching the state, so a machine already running when
+        # sampling starts is not classified unutilised while the buffer fills
+        if state == 1:
+            active = size
+        elif state == 2:
+            active = round((self.high + self.low) / 2)
+        else:
+            active = 0
+        self._samples = array("B", bytes([1]) * active + bytes(size - active))
+        self._i = 0
+        self._active = active  # Active samples in the buffer
+
+    @property
+    def duty_cycle(self) -> float:
+        return self._active / self.size
+
+    def sample(self, active: bool) -> Optional[int]:
+        """Records a sample, and returns the new state if it changed."""
+        self._active += active - self._samples[self._i]
+        self._samples[self._i] = active
+        self._i = (self._i + 1) % self.size
+
+        if self._active >= self.high:
+            state = 1
+        elif self._active <= self.low:
+            state = 0
+        elif self.state == 1:
+            state = 2
+        else:
+            return None
+        if state == self.state:
+            return None
+        self.state = state
+        return state
+
+
+class SensorWorker:
+    """
+    Thread turning the sensor edges of every machine into state transitions.
+
+    The gpiozero callbacks only timestamp the edge and queue it, so they return at
+    once and edges from machines toggling together keep their order. This thread
+    classifies the edges, and passes every transition to `publish` along with the
+    time it happened.
+    """
+
+    def __init__(
+        self,
+        publish: Callable[[Transition], None],
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.publish = publish
+        self.clock = clock
+        self._machines: Dict[str, Machine] = {}
+        self._classifiers: Dict[str, EdgeClassifier] = {}
+        self._edges: "queue.Queue[tuple]" = queue.Queue()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def watch(self, m: Machine) -> None:
+        self._machines[m.id] = m
+        self._classifiers[m.id] = EdgeClassifier(m.hold_time, m.is_active, self.clock())
+        m.when_activated = partial(self.edge, m, True)
+        m.when_deactivated = partial(self.edge, m, False)
+
+    def edge(self, m: Machine, active: bool) -> None:
+        # Runs on a gpiozero callback thread, so must not block
+        self._edges.put((m, self.clock(), active))
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """Earliest time at which a machine changes state if no edge comes before then."""
+        deadlines = [
+            c.deadline for c in self._classifiers.values() if c.deadline is not None
+        ]
+        return min(deadlines) if deadlines else None
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._edges.put((None, 0, False))
+        self._thread.join()
+
+    def run(self) -> None:
+        while True:
+            deadline = self.deadline
+            timeout = None if deadline is None else max(deadline - self.clock(), 0)
+            try:
+                m, at, active = self._edges.get(timeout=timeout)
+            except queue.Empty:
+                self.poll(self.clock())
+                continue
+            if m is None:
+                return
+            self.handle(m, at, active)
+
+    def drain(self) -> None:
+        """Handles every queued edge without waiting, for driving the worker without its
+        thread, see replay.py."""
+        while True:
+            try:
+                m, at, active = self._edges.get_nowait()
+            except queue.Empty:
+                return
+            self.handle(m, at, active)
+
+    def handle(self, m: Machine, at: float, active: bool) -> None:
+        self.poll(at)
+        for state, t in self._classifiers[m.id].feed(at, active):
+            self.publish(Transition(m, state, t))
+
+    def poll(self, now: float) -> None:
+        """Publishes every transition due by `now`."""
+        for id, c in self._classifiers.items():
+            for state, t in c.poll(now):
+                self.publish(Transition(self._machines[id], state, t))
+
+
+class SamplingWorker(SensorWorker):
+    """
+    Sensor worker sampling the sensor of every machine `rate` times a second instead of
+    reacting to its edges, and classifying each machine by its duty cycle over the last
+    `window` seconds, see DutyCycleClassifier. Slower to react than debouncing edges,
+    but noisy sensors cannot flap the state, which saves requests to the backend.
+    """
+
+    def __init__(
+        self,
+        publish: Callable[[Transition], None],
+        clock: Callable[[], float] = time.time,
+        *,
+        rate: float = 10,
+        window: float = 30,
+        high: float = 0.8,
+        low: float = 0.2,
+    ) -> None:
+        super().__init__(publish, clock)
+        self.interval = 1 / rate
+        self.size = max(int(rate * window), 1)
+        self.high = high
+        self.low = low
+        self._duty: Dict[str, DutyCycleClassifier] = {}
+        self._next = clock()
+
+    def watch(self, m: Machine) -> None:
+        self._machines[m.id] = m
+        self._duty[m.id] = DutyCycleClassifier(self.size, self.high, self.low, m.state)
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """Time of the next sample."""
+        return self._next
+
+    def poll(self, now: float) -> None:
+        """Samples every machine if the next sample is due by `now`."""
+        if now < self._next:
+            return
+        for id, c in self._duty.items():
+            m = self._machines[id]
+            state = c.sample(m.is_active)
+            if state is not None:
+                self.publish(Transition(m, state, now))
+        self._next = max(self._next + self.interval, now)
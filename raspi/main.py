@@ -1,15 +1,17 @@
+import asyncio
 import json
 import logging
 import socket
 from datetime import datetime
+from functools import partial
 from os import mkdir
 from os.path import isdir, join
-from time import sleep
 
-import requests
+from agent import Agent
+from debounce import SamplingWorker, SensorWorker
+from outbox import Outbox
 from sensor import Machine
-
-FLOOR = 4  # TODO: Shift to settings.json
+from transport import Transport
 
 
 def main() -> None:
@@ -22,19 +24,50 @@ def main() -> None:
 
     # Prepend the endpoint with "http://" if necessary
     endpoint: str = settings["endpoint"]
-    endpoint = endpoint if endpoint.startswith("http://") else "http://" + endpoint
+    endpoint = (
+        endpoint
+        if endpoint.startswith(("http://", "https://"))
+        else "http://" + endpoint
+    )
+
+    # One connection to the backend, shared by every machine. State changes are kept
+    # in the outbox until the backend has received them.
+    transport = Transport(
+        endpoint,
+        settings["api_key"],
+        settings["floor"],
+        Outbox(settings.get("outbox", "outbox.db")),
+        http_timeout=timeout,
+        window=settings.get("batch_window", 0.5),
+        binary=settings.get("binary", False),
+    )
+    transport.start()
 
     # Create all the class instances
     machines = [
-        Machine(x["pin"], x["id"], endpoint, http_timeout=timeout)
-        for x in settings["machines"]
+        Machine(x["pin"], x["id"], x["pos"], transport) for x in settings["machines"]
     ]
 
-    while True:
-        update_rpi_ip(endpoint, timeout)
-        for m in machines:
-            m.update()
-        sleep(60)
+    # Debounce sensor edges, unless a sample rate is set to classify by duty cycle
+    worker = SensorWorker
+    if settings.get("sample_rate"):
+        worker = partial(
+            SamplingWorker,
+            rate=settings["sample_rate"],
+            window=settings.get("sample_window", 30),
+        )
+
+    agent = Agent(
+        machines,
+        transport,
+        get_ip,
+        worker=worker,
+        keepalive=settings.get("keepalive", 600),
+    )
+    try:
+        asyncio.run(agent.run())
+    finally:
+        transport.close()
 
 
 # Following code is taken from https://stackoverflow.com/a/28950776
@@ -50,17 +83,6 @@ def get_ip() -> str:
     return IP
 
 
-def update_rpi_ip(endpoint: str, http_timeout: int) -> None:
-    ip: str = get_ip()
-    try:
-        requests.put(endpoint, {"floor": FLOOR, "ip_addr": ip}, timeout=http_timeout)
-        logging.debug("Successfully updated RPi IP to backend.")
-    except (requests.ConnectionError, Exception) as e:
-        logging.error(
-            f"Error while trying to update RPi IP to backend. Error trace: {e}"
-        )
-
-
 if __name__ == "__main__":
     # Set up basic logging
     if not isdir("logs"):
@@ -0,0 +1,79 @@
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple
+
+
+class Entry(NamedTuple):
+    id: int
+    pos: int
+    state: int
+    at: float  # Unix time at which the sensor changed state
+
+
+class Outbox:
+    """
+    Durable queue of machine state changes, backed by SQLite.
+
+    Every state change is written here before it is sent, so updates survive both
+    network outages and restarts of the agent. Entries are read back in the order
+    they were written, and only removed once the backend has received them.
+
+    Entry ids double as sequence numbers for the backend to skip states it already
+    applied. They start from the current Unix time when the outbox is created, so an
+    outbox which is deleted and recreated keeps counting up from where the old one was,
+    as long as it averaged under one state change a second.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pos INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                at REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute(
+            """
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT 'outbox', ? WHERE NOT EXISTS (
+                SELECT 1 FROM sqlite_sequence WHERE name = 'outbox'
+            )
+            """,
+            (int(time.time()),),
+        )
+        self._db.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (n,) = self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()
+        return n
+
+    def put(self, pos: int, state: int, at: float) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO outbox (pos, state, at) VALUES (?, ?, ?)", (pos, state, at)
+            )
+
+    def peek(self, limit: int) -> List[Entry]:
+        """Returns up to `limit` of the oldest entries, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, pos, state, at FROM outbox ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [Entry(*row) for row in rows]
+
+    def remove(self, last_id: int) -> None:
+        """Removes every entry up to and including `last_id`."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,267 @@
+"""
+Replays sensor edge traces through the state detection of the raspi, under a simulated
+clock and gpiozero's mock pins, so it can be tuned without the hardware.
+
+A trace is a JSON list of events, each either an edge of a machine's sensor or the state
+the machine is actually in from then on, which the detected states are scored against:
+
+    [{"t": 0, "pos": 0, "expect": 0}, {"t": 12.5, "pos": 0, "active": true}, ...]
+
+Usage:
+
+    python replay.py trace.json         # replays a recorded trace
+    python replay.py --synthetic 4      # replays a generated trace of 4 machines
+    python replay.py --bench            # measures throughput for 1 to 26 machines
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from debounce import SamplingWorker, SensorWorker, Transition
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+from sensor import Machine
+
+# GPIO pins of a Raspberry Pi available to sensors, in the order they are handed out.
+PINS = [4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23]
+PINS += [24, 25, 26, 27, 2, 3]
+
+
+class Event(NamedTuple):
+    t: float
+    pos: int
+    active: Optional[bool] = None  # Set for an edge of the sensor
+    expect: Optional[int] = None  # Set for the state the machine is actually in
+
+
+class Report(NamedTuple):
+    edges: int
+    transitions: List[Transition]
+    reports: int  # State changes handed to the transport
+    requests: int  # Bulk requests the transport would make for them
+    latencies: List[float]  # Seconds between each expected state and its detection
+    missed: int  # Expected states never detected
+    false: int  # Detected states other than the expected one
+
+
+class SimClock:
+    def __init__(self) -> None:
+        self.t = 0.0
+
+    def __call__(self) -> float:
+        return self.t
+
+
+class CountingTransport:
+    """Stands in for Transport, counting the state changes reported to it and the bulk
+    requests Transport would make for them with the same batching window."""
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self.reports = 0
+        self.requests = 0
+        self._batch_until = float("-inf")
+
+    def report(self, pos: int, state: int, at: Optional[float] = None) -> None:
+        self.reports += 1
+        if at > self._batch_until:
+            self.requests += 1
+            self._batch_until = at + self.window
+
+
+def replay(
+    events: List[Event],
+    *,
+    hold_time: float = 3,
+    timeout: float = 3600,
+    window: float = 0.5,
+    sample_rate: Optional[float] = None,
+    sample_window: float = 30,
+) -> Report:
+    Device.pin_factory = MockFactory()
+    clock = SimClock()
+    transport = CountingTransport(window)
+    transitions: List[Transition] = []
+
+    def apply(t: Transition) -> None:
+        if t.state != t.machine.state:
+            transitions.append(t)
+        t.machine.set_state(t.state, t.at)
+
+    if sample_rate:
+        worker = SamplingWorker(apply, clock, rate=sample_rate, window=sample_window)
+    else:
+        worker = SensorWorker(apply, clock)
+    machines: Dict[int, Machine] = {}
+    for pos in sorted({e.pos for e in events}):
+        m = Machine(
+            PINS[pos], f"sim{pos}", pos, transport, hold_time=hold_time, timeout=timeout
+        )
+        m.last_updated_state = clock()
+        worker.watch(m)
+        machines[pos] = m
+
+    def advance(until: float) -> None:
+        # Fires every debounce and timeout deadline up to `until`, in order
+        while True:
+            deadlines = [worker.deadline] + [m.deadline for m in machines.values()]
+            due = [d for d in deadlines if d is not None and d <= until]
+            if not due:
+                break
+            clock.t = min(due)
+            worker.poll(clock.t)
+            for m in machines.values():
+                m.update(clock.t)
+        clock.t = until
+
+    events = sorted(events, key=lambda e: e.t)
+    edges = [e for e in events if e.active is not None]
+    for e in edges:
+        advance(e.t)
+        m = machines[e.pos]
+        # Buttons are active low unless pull_up is False
+        if e.active != m.pull_up:
+            m.pin.drive_high()
+        else:
+            m.pin.drive_low()
+        worker.drain()
+    if events:
+        advance(events[-1].t + hold_time)
+
+    for m in machines.values():
+        m.close()
+    return Report(
+        len(edges),
+        transitions,
+        transport.reports,
+        transport.requests,
+        *score([e for e in events if e.expect is not None], transitions),
+    )
+
+
+def score(
+    expected: List[Event], transitions: List[Transition]
+) -> Tuple[List[float], int, int]:
+    """Matches every expected state with the first detection of it before the next
+    one, and counts the detections of any other state as false."""
+    by_pos = defaultdict(list)
+    for t in transitions:
+        by_pos[t.machine.pos].append(t)
+
+    latencies: List[float] = []
+    missed = false = 0
+    for pos in {e.pos for e in expected}:
+        exp = [e for e in expected if e.pos == pos]
+        for e, following in zip(exp, exp[1:] + [None]):
+            until = float("inf") if following is None else following.t
+            seen = [t for t in by_pos[pos] if e.t <= t.at < until]
+            hits = [t for t in seen if t.state == e.expect]
+            false += len(seen) - len(hits)
+            if hits:
+                latencies.append(hits[0].at - e.t)
+            elif e is not exp[0]:  # Machines start out in the first expected state
+                missed += 1
+    return latencies, missed, false
+
+
+def synthetic(machines: int, cycles: int, seed: int = 0) -> List[Event]:
+    """Generates `cycles` washes per machine: an idle spell with the odd knock on the
+    sensor, a run with short dropouts of the sensor, then a minute of blinking."""
+    rng = random.Random(seed)
+    events: List[Event] = []
+    for pos in range(machines):
+        t = 0.0
+        events.append(Event(t, pos, expect=0))
+        for _ in range(cycles):
+            end = t + rng.uniform(60, 600)
+            t += rng.expovariate(1 / 120)
+            while t < end:
+                events.append(Event(t, pos, active=True))
+                t += rng.uniform(0.1, 0.5)
+                events.append(Event(t, pos, active=False))
+                t += rng.expovariate(1 / 120)
+            t = max(t, end)
+
+            events.append(Event(t, pos, expect=1))
+            events.append(Event(t, pos, active=True))
+            end = t + rng.uniform(1800, 3600)
+            t += rng.expovariate(1 / 300)
+            while t < end:
+                events.append(Event(t, pos, active=False))
+                t += rng.uniform(0.1, 1)
+                events.append(Event(t, pos, active=True))
+                t += rng.expovariate(1 / 300)
+            t = max(t, end)
+
+            events.append(Event(t, pos, expect=2))
+            for _ in range(30):
+                events.append(Event(t, pos, active=False))
+                events.append(Event(t + 1, pos, active=True))
+                t += 2
+            events.append(Event(t, pos, active=False))
+            events.append(Event(t, pos, expect=0))
+            t += 1
+    return events
+
+
+def print_report(r: Report) -> None:
+    print(f"edges: {r.edges}, transitions: {len(r.transitions)}")
+    print(f"state reports: {r.reports}, bulk requests: {r.requests}")
+    if r.latencies:
+        p50 = statistics.median(r.latencies)
+        print(f"latency: p50 {p50:.2f}s, max {max(r.latencies):.2f}s")
+    print(f"false transitions: {r.false}, missed states: {r.missed}")
+
+
+def bench(cycles: int, **kwargs) -> None:
+    print(f"{'machines':>8} {'edges':>8} {'edges/s':>10} {'requests':>9} {'false':>6}")
+    for n in [1, 4, 16, len(PINS)]:
+        events = synthetic(n, cycles)
+        t = time.perf_counter()
+        r = replay(events, **kwargs)
+        elapsed = time.perf_counter() - t
+        print(
+            f"{n:>8} {r.edges:>8} {r.edges / elapsed:>10.0f} {r.requests:>9} {r.false:>6}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("trace", nargs="?", help="JSON file of events to replay")
+    source.add_argument("--synthetic", type=int, metavar="MACHINES")
+    source.add_argument("--bench", action="store_true")
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hold-time", type=float, default=3)
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--window", type=float, default=0.5)
+    parser.add_argument("--sample-rate", type=float, help="samples a second")
+    parser.add_argument("--sample-window", type=float, default=30)
+    args = parser.parse_args()
+
+    kwargs = dict(
+        hold_time=args.hold_time,
+        timeout=args.timeout,
+        window=args.window,
+        sample_rate=args.sample_rate,
+        sample_window=args.sample_window,
+    )
+    if args.bench:
+        bench(args.cycles, **kwargs)
+        return
+    if args.trace:
+        with open(args.trace, "r") as f:
+            events = [Event(**e) for e in json.load(f)]
+    else:
+        events = synthetic(args.synthetic, args.cycles, args.seed)
+    print_report(replay(events, **kwargs))
+
+
+if __name__ == "__main__":
+    main()
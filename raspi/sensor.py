@@ -1,8 +1,9 @@
 import logging
 import time
+from typing import Optional
 
-import requests
 from gpiozero import Button
+from transport import Transport
 
 
 class Machine(Button):
@@ -20,17 +21,18 @@ class Machine(Button):
         self,
         pin: int,
         id: str,
-        endpoint: str,
+        pos: int,
+        transport: Transport,
         *,
         hold_time: int = 3,
         timeout: int = 3600,
-        http_timeout: int = 5,
         **kwargs,
     ) -> None:
         super().__init__(pin, hold_time=hold_time, **kwargs)
 
         self._id = id
-        self._endpoint = endpoint
+        self._pos = pos
+        self._transport = transport
         self._state: int = self.value
 
         self.timeout: int = (
@@ -43,16 +45,32 @@ class Machine(Button):
     def id(self) -> str:
         return self._id
 
+    @property
+    def pos(self) -> int:
+        return self._pos
+
     @property
     def state(self) -> int:
         return self._state
 
+    @property
+    def deadline(self) -> Optional[float]:
+        """Time at which the machine is considered stuck, if it is in an active state."""
+        if self.state in {1, 2}:
+            return self.last_updated_state + self.timeout
+        return None
+
     ###############
     # STATE LOGIC #
     ###############
 
     @state.setter
     def state(self, val) -> None:
+        self.set_state(val)
+
+    def set_state(self, val: int, at: Optional[float] = None) -> None:
+        """Changes the state of the machine, which happened at Unix time `at` (defaults
+        to now), and queues it to be sent to the backend."""
         # Only update endpoint if state changes
         if self._state == val:
             return
@@ -71,48 +89,24 @@ class Machine(Button):
             )
 
         self._state = val
-        self.last_updated_state = time.time()
+        self.last_updated_state = time.time() if at is None else at
         self.update_endpoint()
 
-    def when_held(self) -> None:
-        self.state = 1
-
-    def when_deactivated(self) -> None:
-        if self.wait_for_activation():
-            self.state = 2
-        else:
-            self.state = 0
-
     ####################
     # HELPER FUNCTIONS #
     ####################
 
-    def wait_for_activation(self, freq: float = 0.1) -> bool:
-        """
-        Reimplementation of `wait_for_active` from the gpiozero library, as that method
-        does not seem to work well in multithreaded scenarioes.
-        """
-        start = time.time()
-        while time.time() - start < self.hold_time:
-            time.sleep(freq)
-            if self.is_active:
-                return True
-        return False
-
-    def update(self) -> None:
-        """Detects if the sensor is in an invalid state."""
-        if (
-            self.state in {1, 2}
-            and time.time() - self.last_updated_state > self.timeout  # noqa: W503
-        ):
+    def update(self, now: Optional[float] = None) -> None:
+        """Detects if the sensor is in an invalid state at Unix time `now` (defaults to
+        now)."""
+        deadline = self.deadline
+        now = time.time() if now is None else now
+        if deadline is not None and now >= deadline:
             # If machine has been in an active state for longer than self.timeout, bring up error
-            self.state = -1
+            self.set_state(-1, now)
 
     def update_endpoint(self) -> None:
-        try:
-            requests.put(self._endpoint, {"id": self.id, "state": self.state})
-            self.last_updated_endpoint = time.time()
-        except requests.ConnectionError as e:
-            logging.error(
-                f"Error while trying to update endpoint of machine state. Error trace: {e}"
-            )
+        """Queues the current state, with the time it changed, to be sent to the backend
+        by the shared transport."""
+        self._transport.report(self.pos, self.state, self.last_updated_state)
+        self.last_updated_endpoint = time.time()
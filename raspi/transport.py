@@ -0,0 +1,204 @@
+import logging
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+import requests
+from outbox import Entry, Outbox
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Machine states used by the sensors, and the API status each one maps to.
+STATUSES = {0: "idle", 1: "in_use", 2: "finishing", -1: "error"}
+
+# Compact frame accepted by POST /ingest: a header followed by one record per machine,
+# little endian. The same layout is decoded by api/app/ingest.py.
+FRAME_VERSION = 2
+FRAME_MEDIA_TYPE = "application/vnd.laundry.state"
+_header = struct.Struct("<BhH4s")  # version, floor, number of records, IPv4 address
+_record = struct.Struct("<BbdI")  # pos, state, unix time, sequence number
+
+
+class Transport:
+    """
+    Shared connection from the raspi to the API.
+
+    All requests go through one keep-alive `requests.Session`, so a state change does
+    not pay for a new TCP handshake. State changes are written to the outbox with the
+    time they happened, and a background thread sends them in order. Changes reported
+    within `window` seconds of each other are sent together in one bulk request. If
+    the backend cannot be reached, the thread retries with exponential backoff up to
+    `max_backoff` seconds, and nothing is lost in the meantime.
+
+    With `binary` set, state changes are sent to POST /ingest as compact binary frames
+    instead of JSON, for Pis on slow or metered networks. Every frame doubles as a
+    heartbeat, and the backend skips states it already applied by their outbox id, so
+    a batch whose response was lost can be retried safely.
+    """
+
+    batch_size: int = 100  # Most machines the API accepts in one bulk request
+
+    def __init__(
+        self,
+        endpoint: str,
+        api_key: str,
+        floor: int,
+        outbox: Outbox,
+        *,
+        http_timeout: float = 5,
+        window: float = 0.5,
+        max_backoff: float = 300,
+        binary: bool = False,
+    ) -> None:
+        self._endpoint = endpoint.rstrip("/")
+        self.floor = floor
+        self.outbox = outbox
+        self.http_timeout = http_timeout
+        self.window = window
+        self.max_backoff = max_backoff
+        self.binary = binary
+        self.ip: Optional[str] = None  # Last IP address sent in a heartbeat
+
+        self.session = requests.Session()
+        self.session.headers["X-API-KEY"] = api_key
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            max_retries=Retry(connect=2, read=0, backoff_factor=0.5),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._sender: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Starts the background thread sending the outbox, including anything left in
+        it from a previous run."""
+        self._sender = threading.Thread(target=self._run, daemon=True)
+        self._sender.start()
+        if len(self.outbox):
+            self._wake.set()
+
+    def report(self, pos: int, state: int, at: Optional[float] = None) -> None:
+        """Stores a state change of the machine at `pos`, which happened at Unix time
+        `at` (defaults to now), to be sent with the next batch."""
+        self.outbox.put(pos, state, time.time() if at is None else at)
+        self._wake.set()
+
+    def flush(self) -> bool:
+        """Sends everything in the outbox, in batches and in order. Returns whether
+        the outbox was emptied."""
+        while True:
+            batch = self.outbox.peek(self.batch_size)
+            if not batch:
+                return True
+
+            try:
+                res = self._send(batch)
+                res.raise_for_status()
+            except requests.HTTPError as e:
+                if res.status_code not in {400, 422}:
+                    logging.error(
+                        f"Error while trying to send {len(batch)} machine state(s). Error trace: {e}"
+                    )
+                    return False
+                # Retrying a malformed batch can never succeed, and would hold up
+                # every update queued behind it.
+                logging.error(
+                    f"Backend refused {len(batch)} machine state(s), dropping them. Error trace: {res.text}"
+                )
+            except requests.RequestException as e:
+                logging.error(
+                    f"Error while trying to send {len(batch)} machine state(s). Error trace: {e}"
+                )
+                return False
+            else:
+                body = res.json()
+                rejected = body["rejected"] if self.binary else body
+                for result in rejected:
+                    if not result["ok"]:
+                        logging.warning(
+                            f"Backend rejected state of machine at position {result['pos']}: {result['detail']}"
+                        )
+                logging.debug(f"Sent {len(batch)} machine state(s) to backend.")
+
+            self.outbox.remove(batch[-1].id)
+
+    def _send(self, batch: List[Entry]) -> requests.Response:
+        if self.binary:
+            return self._ingest(batch)
+
+        body = [
+            {
+                "floor": self.floor,
+                "pos": e.pos,
+                "status": STATUSES[e.state],
+                "at": datetime.utcfromtimestamp(e.at).isoformat(),
+            }
+            for e in batch
+        ]
+        return self.session.put(
+            f"{self._endpoint}/machine/bulk/state",
+            json=body,
+            timeout=self.http_timeout,
+        )
+
+    def _run(self) -> None:
+        backoff = 0.0
+        while not self._closed.is_set():
+            # Retries wait out the backoff, new state changes do not cut it short
+            if backoff:
+                self._closed.wait(backoff)
+            else:
+                self._wake.wait()
+            self._wake.clear()
+
+            # Give changes happening together the chance to share a batch
+            self._closed.wait(self.window)
+
+            if self.flush():
+                backoff = 0.0
+            else:
+                backoff = min(max(2 * backoff, 1.0), self.max_backoff)
+                logging.info(f"Retrying machine state(s) in {backoff} seconds.")
+
+    def _ingest(self, batch: List[Entry]) -> requests.Response:
+        ip = socket.inet_aton(self.ip) if self.ip else bytes(4)
+        body = _header.pack(FRAME_VERSION, self.floor, len(batch), ip) + b"".join(
+            _record.pack(e.pos, e.state, e.at, e.id) for e in batch
+        )
+        return self.session.post(
+            f"{self._endpoint}/ingest",
+            data=body,
+            headers={"Content-Type": FRAME_MEDIA_TYPE},
+            timeout=self.http_timeout,
+        )
+
+    def update_raspi(self, ip: str) -> None:
+        """Upserts this raspi and its IP address."""
+        if self.binary:
+            self.ip = ip
+            res = self._ingest([])
+        else:
+            res = self.session.put(
+                f"{self._endpoint}/raspi",
+                json={"floor": self.floor, "ip_addr": ip},
+                timeout=self.http_timeout,
+            )
+        res.raise_for_status()
+        self.ip = ip
+
+    def close(self) -> None:
+        """Stops the background thread and makes one last attempt to send the outbox.
+        Whatever is left is sent after the next start."""
+        self._closed.set()
+        self._wake.set()
+        if self._sender is not None:
+            self._sender.join()
+        self.flush()
+        self.session.close()
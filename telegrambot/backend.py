@@ -0,0 +1,45 @@
+import asyncio
+from typing import List
+
+import httpx
+
+
+class Backend:
+    """
+    Async client for the laundry API, shared by every handler and job of the bot.
+
+    Requests go through one pool of keep-alive connections, and every request has a
+    timeout, so a slow backend fails a request instead of holding it forever. At most
+    `max_in_flight` requests are sent at once; callers past that wait their turn, so a
+    burst of users cannot open a connection each or pile onto a struggling backend.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        *,
+        max_in_flight: int = 10,
+        timeout: float = 10,
+        transport: httpx.AsyncBaseTransport = None,
+    ) -> None:
+        self.url = url.rstrip("/")
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=5),
+            # one more connection than calls in flight, for the machine event stream
+            limits=httpx.Limits(
+                max_connections=max_in_flight + 1,
+                max_keepalive_connections=max_in_flight + 1,
+            ),
+            transport=transport,
+        )
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def level(self, level: int) -> List[dict]:
+        """Returns every machine on a level."""
+        async with self._in_flight:
+            r = await self.client.get(self.url, params={"floor": level})
+        r.raise_for_status()
+        return r.json()
+
+    async def close(self) -> None:
+        await self.client.aclose()
@@ -0,0 +1,154 @@
+"""Benchmarks how many concurrent /view_status users one bot process can serve.
+
+Each simulated user does what level_status does before replying: fetch a level from
+the backend and render its status message. The backend is simulated in process with a
+fixed latency, so the numbers show the bot's own limits rather than the network's.
+Telegram calls are left out, as they are paced separately.
+
+    python bench.py
+    python bench.py --latency 0.2 --max-in-flight 20 --users 10,100,1000
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from backend import Backend
+from cache import LevelCache
+from laundry import LAUNDRY_LEVELS, level_text
+
+BACKEND_URL = "http://backend.test/machine"
+# Worker threads of the python-telegram-bot v13 dispatcher the bot used to run on
+V13_WORKERS = 4
+
+
+def level_data(level):
+    started = (datetime.datetime.utcnow() - datetime.timedelta(minutes=10)).isoformat()
+    return [
+        {
+            "floor": level,
+            "pos": pos,
+            "type": "washer" if pos < 2 else "dryer",
+            "status": "in_use" if pos % 2 else "idle",
+            "duration": 1800,
+            "last_started_at": started,
+        }
+        for pos in range(4)
+    ]
+
+
+def backend_transport(latency, calls):
+    async def handle(request):
+        calls.append(request)
+        await asyncio.sleep(latency)
+        level = int(request.url.params["floor"])
+        return httpx.Response(200, content=json.dumps(level_data(level)))
+
+    return httpx.MockTransport(handle)
+
+
+async def view_status(get_level, level):
+    t = time.perf_counter()
+    level_text(level, await get_level(level))
+    return time.perf_counter() - t
+
+
+async def run_async(users, latency, max_in_flight, cache_ttl=None):
+    calls = []
+    backend = Backend(
+        BACKEND_URL,
+        max_in_flight=max_in_flight,
+        transport=backend_transport(latency, calls),
+    )
+    get_level = backend.level
+    if cache_ttl is not None:
+        get_level = LevelCache(backend.level, ttl=cache_ttl).get
+    t = time.perf_counter()
+    waits = await asyncio.gather(
+        *(
+            view_status(get_level, LAUNDRY_LEVELS[i % len(LAUNDRY_LEVELS)])
+            for i in range(users)
+        )
+    )
+    elapsed = time.perf_counter() - t
+    await backend.close()
+    return elapsed, waits, len(calls)
+
+
+def run_blocking(users, latency):
+    """The v13 bot: a blocking backend call on one of a few dispatcher threads."""
+
+    t = time.perf_counter()
+
+    def view_status_blocking(level):
+        time.sleep(latency)
+        level_text(level, level_data(level))
+        # every press arrives at once, so waiting for a free thread counts too
+        return time.perf_counter() - t
+
+    with ThreadPoolExecutor(V13_WORKERS) as pool:
+        waits = list(
+            pool.map(
+                view_status_blocking,
+                (LAUNDRY_LEVELS[i % len(LAUNDRY_LEVELS)] for i in range(users)),
+            )
+        )
+    return time.perf_counter() - t, waits, users
+
+
+def report(name, users, elapsed, waits, calls):
+    waits = sorted(waits)
+    p95 = waits[min(len(waits) - 1, int(0.95 * len(waits)))]
+    print(
+        f"{name:<22}{users:>7}{users / elapsed:>12.1f}{statistics.median(waits) * 1000:>11.0f}"
+        f"{p95 * 1000:>11.0f}{calls:>15}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--users",
+        default="1,10,100,1000",
+        help="Comma separated numbers of concurrent users",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.1, help="Seconds the backend takes per call"
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=10,
+        help="Most backend calls in flight at once",
+    )
+    parser.add_argument(
+        "--cache-ttl", type=float, default=5, help="Seconds levels are cached for"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'':<22}{'users':>7}{'views/s':>12}{'p50 ms':>11}{'p95 ms':>11}{'backend calls':>15}"
+    )
+    for users in map(int, args.users.split(",")):
+        report("blocking (v13)", users, *run_blocking(users, args.latency))
+        report(
+            "async",
+            users,
+            *asyncio.run(run_async(users, args.latency, args.max_in_flight)),
+        )
+        report(
+            "async + level cache",
+            users,
+            *asyncio.run(
+                run_async(users, args.latency, args.max_in_flight, args.cache_ttl)
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+
+class LevelCache:
+    """
+    Short-lived cache of the machines on each level, in front of the backend.
+
+    A level fetched within the last `ttl` seconds is served from memory, and callers
+    asking for a level while it is being fetched wait for that same fetch, so any
+    number of users refreshing a level cost one backend call per `ttl`. A level is
+    dropped as soon as one of its machines changes, so the cache never hides a change
+    the bot has been told about; `ttl` only bounds how stale it gets otherwise.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[int], Awaitable[List[dict]]],
+        ttl: float = 5,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.fetch = fetch
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: Dict[int, Tuple[float, List[dict]]] = {}
+        self._fetching: Dict[int, asyncio.Future] = {}
+        # Bumped whenever a level is invalidated, so a fetch which started before
+        # does not put what it got back in the cache
+        self._generations: Dict[int, int] = {}
+
+    async def get(self, level: int) -> List[dict]:
+        """Returns the machines on a level. The list is shared, and must not be changed."""
+        entry = self._entries.get(level)
+        if entry is not None and self._clock() < entry[0]:
+            return entry[1]
+
+        fetching = self._fetching.get(level)
+        if fetching is None:
+            fetching = asyncio.ensure_future(self._fetch(level))
+            self._fetching[level] = fetching
+        # One caller giving up must not cancel the fetch for everyone else
+        return await asyncio.shield(fetching)
+
+    def invalidate(self, level: int) -> None:
+        """Forgets a level, so the next get fetches it again."""
+        self._entries.pop(level, None)
+        self._fetching.pop(level, None)
+        self._generations[level] = self._generations.get(level, 0) + 1
+
+    async def _fetch(self, level: int) -> List[dict]:
+        generation = self._generations.get(level, 0)
+        try:
+            level_data = await self.fetch(level)
+        finally:
+            if self._generations.get(level, 0) == generation:
+                self._fetching.pop(level, None)
+        if self._generations.get(level, 0) == generation:
+            self._entries[level] = (self._clock() + self.ttl, level_data)
+        return level_data
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import logging
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Optional, Tuple
+
+import httpx
+
+
+async def parse_sse(
+    lines: AsyncIterable[str],
+) -> AsyncIterator[Tuple[Optional[str], str, str]]:
+    """Parses a server-sent event stream into (id, event, data) tuples."""
+    id, event, data = None, "message", []
+    async for line in lines:
+        if not line:
+            if data:
+                yield id, event, "\n".join(data)
+            id, event, data = None, "message", []
+        elif line.startswith(":"):
+            continue  # comment, sent to keep the connection open
+        else:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "id":
+                id = value
+            elif field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+
+
+class MachineEvents:
+    """
+    Follows the machine state changes streamed by GET /machine/events, and awaits
+    `on_machine` with every updated machine.
+
+    With `wait` set, the stream is long polled: each request ends once there are
+    events or after `wait` seconds, as it must behind the Lambda deployment, which
+    only sends complete responses. Set it to None to keep one stream open instead.
+
+    Requests resume from the last event received, so no change is missed across
+    short outages, and are retried with exponential backoff when they fail. While
+    they fail, `connected` is False, and callers should poll the API instead.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        on_machine: Callable[[dict], Awaitable[None]],
+        *,
+        wait: Optional[int] = 25,
+        read_timeout: float = 60,
+        max_backoff: float = 60,
+    ) -> None:
+        self.client = client
+        self.url = url
+        self.on_machine = on_machine
+        self.wait = wait
+        # Longer than wait, and than the keepalive comments sent every 15 seconds
+        self.read_timeout = read_timeout
+        self.max_backoff = max_backoff
+        self.connected = False
+        self.last_event_id: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def run(self) -> None:
+        backoff = 1.0
+        while True:
+            try:
+                if await self._follow():
+                    backoff = 1.0  # the response ended, as long polls do
+                    continue
+                error = "the response ended without an event"
+            except httpx.HTTPError as e:
+                error = str(e)
+            self.connected = False
+            logging.warning(
+                f"Machine event stream dropped, retrying in {backoff} s: {error}"
+            )
+            await asyncio.sleep(backoff)
+            backoff = min(2 * backoff, self.max_backoff)
+
+    async def _follow(self) -> bool:
+        """Follows one response, and returns whether it had any event."""
+        headers = {"Accept": "text/event-stream"}
+        if self.last_event_id is not None:
+            headers["Last-Event-ID"] = self.last_event_id
+        params = {} if self.wait is None else {"wait": self.wait}
+        timeout = httpx.Timeout(5, read=self.read_timeout)
+        received = False
+        async with self.client.stream(
+            "GET", self.url, params=params, headers=headers, timeout=timeout
+        ) as r:
+            r.raise_for_status()
+            self.connected = True
+            async for id, event, data in parse_sse(r.aiter_lines()):
+                received = True
+                if event == "machine":
+                    try:
+                        await self.on_machine(json.loads(data))
+                    except Exception:
+                        logging.exception(f"Error while handling machine event {id}")
+                # a long poll ends with a "position" event, to resume from
+                if id is not None:
+                    self.last_event_id = id
+        return received
@@ -0,0 +1,87 @@
+import datetime
+import time
+
+# Global constants
+LAUNDRY_LEVELS = [5, 8, 11, 14, 17]
+WASHERS_INFO = {":1": "Washer 1 (Coin)", ":2": "Washer 2 (PayLah)"}
+DRYERS_INFO = {":3": "Dryer 1 (Coin)", ":4": "Dryer 2 (PayLah)"}
+MACHINES_INFO = {**WASHERS_INFO, **DRYERS_INFO}
+DONE_STATUSES = ("finishing", "idle")
+
+# Reminder keys (e.g. "14:1") of the machines seen so far, by level and position
+machine_keys = {}
+
+
+def machines_by_key(level_data):
+    """Pairs the machines of a level with the keys of MACHINES_INFO, washers and dryers in order of position"""
+
+    by_pos = sorted(level_data, key=lambda x: x["pos"])
+    washers = filter(lambda x: x["type"] == "washer", by_pos)
+    dryers = filter(lambda x: x["type"] == "dryer", by_pos)
+    joined = {
+        **dict(zip(WASHERS_INFO.keys(), washers)),
+        **dict(zip(DRYERS_INFO.keys(), dryers)),
+    }
+    for k, info in joined.items():
+        machine_keys[(info["floor"], info["pos"])] = f"{info['floor']}{k}"
+    return joined
+
+
+def machine_name(machine):
+    """Name of a machine from its reminder key, e.g. "Washer 1 (Coin) (Level 14)" for "14:1" """
+
+    level, k = machine.split(":")
+    return f"{MACHINES_INFO[':' + k]} (Level {level})"
+
+
+def parse_time(text):
+    """Unix time of a timestamp from the backend, which are in UTC"""
+
+    at = datetime.datetime.fromisoformat(text.rstrip("Z"))
+    return at.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def expected_finish(info):
+    """Unix time at which a machine in use should be done"""
+
+    if info.get("estimated_finish_at"):
+        return parse_time(info["estimated_finish_at"])
+    return parse_time(info["last_started_at"]) + info["duration"]
+
+
+def level_text(level, level_data):
+    """The status message of a level"""
+
+    joined = machines_by_key(level_data)
+
+    laundry_data = []
+    for k, v in MACHINES_INFO.items():
+        info = joined[k]
+        status = info["status"]
+
+        text = f"<b>{v}:</b> "
+        if status == "idle":
+            text += "Not in use"
+        elif status == "error":
+            text += "Error :("
+        elif status == "in_use":
+            time_left = max(expected_finish(info) - time.time(), 0)
+            started = datetime.datetime.fromisoformat(
+                info["last_started_at"].rstrip("Z")
+            )
+            text += (
+                "In use\n"
+                f"            - Started on: {started.strftime('%H:%M')}\n"
+                f"            - Approx time left: {round(time_left)} s"
+            )
+        laundry_data.append(text)
+
+    laundry_data = "\n".join(laundry_data)
+
+    # TO DO: use the server's time instead of the local raspberry's time (?)
+    current_time = datetime.datetime.now().strftime("%-d %b '%y %H:%M:%S")
+
+    return f"""<b>=====Level {level} status=====</b>
+{laundry_data}
+
+Last updated: {current_time}\n"""
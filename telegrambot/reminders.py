@@ -0,0 +1,78 @@
+import heapq
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+
+class Reminders:
+    """
+    Users waiting for machines to finish, keyed by machine id (e.g. "14:1").
+
+    Subscribers are indexed by machine, so finding who to remind never loops over
+    other machines or users. Machines with subscribers are kept in a heap ordered by
+    when they are expected to finish, so a check only looks at machines which are
+    due. A reminder is removed as soon as it fires, and the reminders firing together
+    are grouped by user, so each user gets one message for all of their machines.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time) -> None:
+        self._clock = clock
+        self._subscribers: Dict[str, Set[int]] = {}
+        self._heap: List[Tuple[float, str]] = []
+        # When each machine is next due. Heap entries which do not match are stale,
+        # and are skipped when popped instead of being searched for and removed.
+        self._due_at: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def __contains__(self, machine: str) -> bool:
+        return machine in self._subscribers
+
+    def subscribe(self, user: int, machine: str, due: Optional[float] = None) -> None:
+        """Reminds `user` when `machine` finishes. The machine is checked at Unix time
+        `due`, or right away if it has no other subscribers and `due` is not given."""
+        users = self._subscribers.setdefault(machine, set())
+        users.add(user)
+        if due is not None or machine not in self._due_at:
+            self.schedule(machine, self._clock() if due is None else due)
+
+    def schedule(self, machine: str, due: float) -> None:
+        """Checks `machine` again at Unix time `due`, replacing when it was due."""
+        if machine not in self._subscribers:
+            return
+        self._due_at[machine] = due
+        heapq.heappush(self._heap, (due, machine))
+
+    def next_due(self) -> Optional[float]:
+        """Returns when the next machine is due, or None if no machine is."""
+        while self._heap and self._is_stale(*self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def due(self, now: Optional[float] = None) -> List[str]:
+        """Removes and returns the machines which are due. Each of them should then
+        either be scheduled again, or fired."""
+        now = self._clock() if now is None else now
+        machines = []
+        while self.next_due() is not None and self._heap[0][0] <= now:
+            _, machine = heapq.heappop(self._heap)
+            del self._due_at[machine]
+            machines.append(machine)
+        return machines
+
+    def fire(self, machines: List[str]) -> Dict[int, List[str]]:
+        """Removes the reminders of the machines which finished, and returns the
+        machines each subscriber should be reminded of."""
+        by_user: Dict[int, List[str]] = {}
+        for machine in machines:
+            for user in self._subscribers.get(machine, ()):
+                by_user.setdefault(user, []).append(machine)
+            self._forget(machine)
+        return by_user
+
+    def _forget(self, machine: str) -> None:
+        self._subscribers.pop(machine, None)
+        self._due_at.pop(machine, None)
+
+    def _is_stale(self, due: float, machine: str) -> bool:
+        return self._due_at.get(machine) != due
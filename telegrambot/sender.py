@@ -0,0 +1,288 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from enum import IntEnum
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+
+class Priority(IntEnum):
+    """Order in which queued calls are sent, lowest first."""
+
+    REMINDER = 0
+    REPLY = 1
+    EDIT = 2
+
+
+class TokenBucket:
+    """Allows `rate` calls a second on average, and bursts of up to `burst` calls."""
+
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float]) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+        self._blocked_until = 0.0
+
+    def wait_time(self) -> float:
+        """Seconds until a call may be made."""
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return max((1 - self._tokens) / self.rate, self._blocked_until - now, 0)
+
+    def take(self) -> None:
+        self._tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """Allows no calls for `seconds`, as Telegram asked."""
+        self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+
+
+class _Call:
+    def __init__(
+        self, priority: int, seq: int, method: str, chat_id: int, kwargs: dict
+    ) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.futures: List[asyncio.Future] = []
+        self.attempts = 0
+
+    def __lt__(self, other: "_Call") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Sender:
+    """
+    Queue of every call the bot makes to Telegram, paced to stay within its flood limits.
+
+    Calls are sent when both the global token bucket (about 30 messages a second) and
+    the bucket of their chat (about 1 a second) allow, highest priority first, so
+    reminders go out ahead of refreshed status messages. An edit to a message which
+    already has an edit queued is merged into it, so a burst of refreshes costs one
+    edit. When Telegram answers 429, the chat waits the `retry_after` it was given and
+    the call is retried, as are calls which failed on the network.
+
+    Every queueing method returns a future of the call's result, which may be ignored.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        *,
+        rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: float = 3,
+        max_attempts: int = 5,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self._clock = clock
+        self._global = TokenBucket(rate, rate, clock)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._queue: List[_Call] = []
+        # queued edits, by chat and message
+        self._edits: Dict[Tuple[int, int], _Call] = {}
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sending: set = set()
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, timeout: float = 5) -> None:
+        """Stops sending, once what is queued has been sent or after `timeout` seconds."""
+        deadline = self._clock() + timeout
+        while (self._queue or self._sending) and self._clock() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._sending, return_exceptions=True)
+
+    def send_message(
+        self, chat_id: int, text: str, priority: int = Priority.REPLY, **kwargs
+    ) -> asyncio.Future:
+        return self.call("send_message", chat_id, priority, text=text, **kwargs)
+
+    def delete_message(
+        self, chat_id: int, message_id: int, priority: int = Priority.REPLY
+    ) -> asyncio.Future:
+        return self.call("delete_message", chat_id, priority, message_id=message_id)
+
+    def edit_message_text(
+        self,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        priority: int = Priority.EDIT,
+        **kwargs,
+    ) -> asyncio.Future:
+        """Queues an edit of the text, and of the buttons if `reply_markup` is given. It
+        replaces any edit already queued for the message."""
+        pending = self._edits.get((chat_id, message_id))
+        if pending is None:
+            return self._edit(
+                "edit_message_text", chat_id, message_id, priority, text=text, **kwargs
+            )
+        pending.method = "edit_message_text"
+        pending.kwargs = {"message_id": message_id, "text": text, **kwargs}
+        return self._join(pending)
+
+    def edit_message_reply_markup(
+        self,
+        chat_id: int,
+        message_id: int,
+        reply_markup=None,
+        priority: int = Priority.EDIT,
+    ) -> asyncio.Future:
+        """Queues an edit of the buttons. It is folded into an edit already queued for
+        the message."""
+        pending = self._edits.get((chat_id, message_id))
+        if pending is None:
+            return self._edit(
+                "edit_message_reply_markup",
+                chat_id,
+                message_id,
+                priority,
+                reply_markup=reply_markup,
+            )
+        pending.kwargs["reply_markup"] = reply_markup
+        return self._join(pending)
+
+    def call(
+        self, method: str, chat_id: int, priority: int, **kwargs
+    ) -> asyncio.Future:
+        """Queues `bot.<method>(chat_id=chat_id, **kwargs)`."""
+        return self._join(self._push(method, chat_id, priority, kwargs))
+
+    def _edit(
+        self, method: str, chat_id: int, message_id: int, priority: int, **kwargs
+    ) -> asyncio.Future:
+        call = self._push(
+            method, chat_id, priority, {"message_id": message_id, **kwargs}
+        )
+        self._edits[(chat_id, message_id)] = call
+        return self._join(call)
+
+    def _push(self, method: str, chat_id: int, priority: int, kwargs: dict) -> _Call:
+        call = _Call(priority, next(self._seq), method, chat_id, kwargs)
+        heapq.heappush(self._queue, call)
+        self._wake.set()
+        return call
+
+    def _join(self, call: _Call) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # results of calls nobody waits for are only logged
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        call.futures.append(future)
+        return future
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst, self._clock
+            )
+        return bucket
+
+    def _next(self) -> Tuple[Optional[_Call], float]:
+        """Removes and returns the first queued call whose chat may be sent to, or
+        None and how long until one may be."""
+        skipped, wait = [], float("inf")
+        call = None
+        while self._queue:
+            candidate = heapq.heappop(self._queue)
+            chat_wait = self._bucket(candidate.chat_id).wait_time()
+            if chat_wait == 0:
+                call = candidate
+                break
+            skipped.append(candidate)
+            wait = min(wait, chat_wait)
+        for c in skipped:
+            heapq.heappush(self._queue, c)
+        return call, wait
+
+    async def _run(self) -> None:
+        while True:
+            global_wait = self._global.wait_time()
+            if global_wait:
+                await asyncio.sleep(global_wait)
+                continue
+
+            self._wake.clear()
+            call, wait = self._next()
+            if call is None:
+                try:
+                    await asyncio.wait_for(
+                        self._wake.wait(), None if wait == float("inf") else wait
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._global.take()
+            self._bucket(call.chat_id).take()
+            if self._edits.get((call.chat_id, call.kwargs.get("message_id"))) is call:
+                del self._edits[(call.chat_id, call.kwargs["message_id"])]
+            task = asyncio.ensure_future(self._send(call))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, call: _Call) -> None:
+        call.attempts += 1
+        try:
+            result = await getattr(self.bot, call.method)(
+                chat_id=call.chat_id, **call.kwargs
+            )
+        except RetryAfter as e:
+            logging.warning(
+                f"Telegram asked to wait {e.retry_after} s before sending to {call.chat_id}"
+            )
+            self._bucket(call.chat_id).block(float(e.retry_after))
+            self._retry(call, e)
+        except BadRequest as e:
+            if "not modified" in e.message:
+                self._resolve(call, None)
+            else:
+                self._fail(call, e)
+        except NetworkError as e:
+            # covers timeouts too; the call is retried after the chat's next token
+            self._bucket(call.chat_id).block(min(2**call.attempts, 60))
+            self._retry(call, e)
+        except Exception as e:
+            self._fail(call, e)
+        else:
+            self._resolve(call, result)
+
+    def _retry(self, call: _Call, error: Exception) -> None:
+        if call.attempts >= self.max_attempts:
+            self._fail(call, error)
+            return
+        heapq.heappush(self._queue, call)
+        self._wake.set()
+
+    def _resolve(self, call: _Call, result: Any) -> None:
+        for future in call.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def _fail(self, call: _Call, error: Exception) -> None:
+        logging.error(f"Could not {call.method} in chat {call.chat_id}: {error!r}")
+        for future in call.futures:
+            if not future.done():
+                future.set_exception(error)
@@ -3,54 +3,57 @@
 # flake8: noqa
 
 # standard libraries
-import datetime
+import asyncio
 import logging
-import math
+import time
 import traceback
-import requests
+from functools import partial
 
-# third-party packages - telegram
-from telegram import (
-    Update,
-
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
+# third-party packages and application imports
+from admin import API_KEY, BACKEND_URL
+from backend import Backend
+from cache import LevelCache
+from events import MachineEvents
+from laundry import (
+    DONE_STATUSES,
+    DRYERS_INFO,
+    LAUNDRY_LEVELS,
+    MACHINES_INFO,
+    WASHERS_INFO,
+    expected_finish,
+    level_text,
+    machine_keys,
+    machine_name,
+    machines_by_key,
 )
+from reminders import Reminders
+from sender import Priority, Sender
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
-    Updater,
-    CallbackContext,
-
-    CommandHandler,
-    MessageHandler,
-    ConversationHandler,
+    Application,
     CallbackQueryHandler,
     CommandHandler,
-
-    Filters
+    ContextTypes,
+    ConversationHandler,
 )
 
-# application imports
-from admin import API_KEY, BACKEND_URL
-
-
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 
 
-# Global constants
-LAUNDRY_LEVELS = [5, 8, 11, 14, 17]
-WASHERS_INFO = {
-    ":1": "Washer 1 (Coin)",
-    ":2": "Washer 2 (PayLah)"
-}
-DRYERS_INFO = {
-    ":3": "Dryer 1 (Coin)",
-    ":4": "Dryer 2 (PayLah)"
-}
-MACHINES_INFO = {**WASHERS_INFO, **DRYERS_INFO}
 MAIN_MENU, SHOWING, SET_REMINDER = range(3)
+# Seconds between looking for machines due to be checked
+CHECK_INTERVAL = 10
+# Seconds before checking again a machine which is not done yet
+RECHECK_INTERVAL = 30
+# Same, while machine events are pushed to the bot as they happen
+FALLBACK_INTERVAL = 300
+# Most backend calls in flight at once, across every user
+MAX_BACKEND_CALLS = 10
+# Seconds a level fetched from the backend is shown to everyone
+LEVEL_CACHE_TTL = 5
 
 
 # Function copied from nuscollegelaundrybot, unused for now
@@ -63,30 +66,35 @@ def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     return InlineKeyboardMarkup(menu)
 
 
-def start(update: Update, context) -> int:
+async def start(update: Update, context) -> int:
     """Send a message when the command /start is issued."""
 
     # Initialise variables needed for later use in one place here
     user_data = context.user_data
-    user_data["reminder_memory"] = {}    # Needed when user chooses which machines to get reminder
-    user_data["level"] = None            # Store the current level that the user is requesting info from
-    user_data["msg_id_status"] = None    # msg_id of the status msg - needed to edit the message later on
-    user_data["msg_id_reminder"] = None  # msg_id of the reminder msg - needed to delete it later on
+    # Needed when user chooses which machines to get reminder
+    user_data["reminder_memory"] = {}
+    # Store the current level that the user is requesting info from
+    user_data["level"] = None
+    # msg_id of the status msg - needed to edit the message later on
+    user_data["msg_id_status"] = None
+    # msg_id of the reminder msg - needed to delete it later on
+    user_data["msg_id_reminder"] = None
 
     text = f"""Heyyo {update.effective_user.username}! I am RC4's Laundry Bot. <i>I am currently in [BETA] mode</i>.
 
 Send me a /view_status to view some status of machines!"""
 
-    update.message.reply_text(text, parse_mode="HTML")
+    context.bot_data["sender"].send_message(
+        update.effective_chat.id, text, parse_mode="HTML"
+    )
 
     return MAIN_MENU
 
 
-
-def ask_level(update: Update, _: CallbackContext) -> int:
+async def ask_level(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Get level number from user"""
 
-    level_text = """<b>Which laundry level do you wish to check?</b>"""
+    ask_text = """<b>Which laundry level do you wish to check?</b>"""
 
     level_buttons = []
     for level in LAUNDRY_LEVELS:
@@ -95,14 +103,16 @@ def ask_level(update: Update, _: CallbackContext) -> int:
         )
         level_buttons.append(buttons)
 
-    update.message.reply_text(
-        text=level_text, reply_markup=build_menu(level_buttons, 1), parse_mode="HTML"
+    context.bot_data["sender"].send_message(
+        update.effective_chat.id,
+        ask_text,
+        reply_markup=build_menu(level_buttons, 1),
+        parse_mode="HTML",
     )
     return MAIN_MENU
 
 
-
-def level_status(update, context): # -> typing.Union[int, None]
+async def level_status(update, context):  # -> typing.Union[int, None]
 
     query = update.callback_query
     # True if initiated by user giving bot a level number, False if otherwise initiated by update request
@@ -110,51 +120,13 @@ def level_status(update, context): # -> typing.Union[int, None]
 
     if is_first_request:
         level = int(query.data.split("_L")[1])
-        context.user_data['level'] = level
+        context.user_data["level"] = level
     else:
         assert query.data == "refresh"
-        level = context.user_data['level']
-
-    r = requests.get(BACKEND_URL, params={"floor": level})
-    level_data = r.json()
-
-    # TO DO: Make this part more robust
-
-    joined = dict(
-            list(zip(WASHERS_INFO.keys(), filter(lambda x: x['type'] == "washer", level_data)))
-            +
-            list(zip(DRYERS_INFO.keys(), filter(lambda x: x['type'] == "dryer", level_data)))
-    )
-
-
-    laundry_data = "\n".join([f"{v}: " for k, v in (MACHINES_INFO).items()])
-    laundry_data = []
-    for k, v in MACHINES_INFO.items():
-        info = joined[k]
-        status = info["status"]
-
-        text = f"<b>{v}:</b> "
-        if status == "idle":
-            text += "Not in use"
-        elif status == "error":
-            text += "Error :("
-        elif status == "in_use":
-            text += (
-f"""In use
-            - Started on: {datetime.datetime.fromisoformat(info["last_started_at"]).strftime("%H:%M")}
-            - Approx time left: {round(info["approx_time_left"])} s"""
-        )
-        laundry_data.append(text)
-
-    laundry_data = '\n'.join(laundry_data)
-
-    # TO DO: use the server's time instead of the local raspberry's time (?)
-    current_time = datetime.datetime.now().strftime("%-d %b '%y %H:%M:%S")
-
-    text = f"""<b>=====Level {level} status=====</b>
-{laundry_data}
+        level = context.user_data["level"]
 
-Last updated: {current_time}\n"""
+    level_data = await context.bot_data["levels"].get(level)
+    text = level_text(level, level_data)
 
     layout = [
         [
@@ -163,30 +135,35 @@ Last updated: {current_time}\n"""
         ]
     ]
 
-
+    sender = context.bot_data["sender"]
+    chat_id = update.effective_chat.id
+    message_id = query.message.message_id
     if context.user_data["msg_id_status"] is not None:
-        # If there is previous message, remove the inline buttons for that message
-        context.bot.edit_message_reply_markup(
-                chat_id=update.effective_chat.id,
-                message_id=context.user_data["msg_id_status"],
-                reply_markup=None
+        # If there is previous message, remove the inline buttons for that message.
+        # On a refresh that is this message, and the edit below replaces this one
+        sender.edit_message_reply_markup(
+            chat_id, context.user_data["msg_id_status"], None
         )
 
-    # TO FIX: Don't remove buttons at all if we're doing a update 
-    message = update.callback_query.edit_message_text(
-        text=text, reply_markup=InlineKeyboardMarkup(layout), parse_mode="HTML"
+    # Queued edits of one message are merged, so a burst of refreshes costs one edit
+    sender.edit_message_text(
+        chat_id,
+        message_id,
+        text,
+        reply_markup=InlineKeyboardMarkup(layout),
+        parse_mode="HTML",
     )
-    context.user_data["msg_id_status"] = message.message_id
+    context.user_data["msg_id_status"] = message_id
 
     if is_first_request:
-        query.answer()
+        await query.answer()
         return SHOWING
     else:
-        query.answer("Updated!")
+        await query.answer("Updated!")
         return None  # Don't change the conversation state!
 
 
-def set_reminder(update, context) -> int:
+async def set_reminder(update, context) -> int:
     """For user to select which machines for reminder"""
 
     # TO DO: only allow user to press this once at a time!!
@@ -197,8 +174,8 @@ def set_reminder(update, context) -> int:
     memory = context.user_data["reminder_memory"]
 
     if len(memory) == 0:
-    # print(context.user_data["reminder_memory"])
-    # if context.user_data["reminder_memory"] is None:
+        # print(context.user_data["reminder_memory"])
+        # if context.user_data["reminder_memory"] is None:
         memory = {f"{level}{k}": False for k in MACHINES_INFO.keys()}
         context.user_data["reminder_memory"] = memory
     else:
@@ -209,8 +186,18 @@ def set_reminder(update, context) -> int:
     print(memory)
 
     layout = [
-        [InlineKeyboardButton(v + (" ✓" if memory[f"{level}{k}"] else ""), callback_data=f"{level}{k}") for k, v in WASHERS_INFO.items()],
-        [InlineKeyboardButton(v + (" ✓" if memory[f"{level}{k}"] else ""), callback_data=f"{level}{k}") for k, v in DRYERS_INFO.items()]
+        [
+            InlineKeyboardButton(
+                v + (" ✓" if memory[f"{level}{k}"] else ""), callback_data=f"{level}{k}"
+            )
+            for k, v in WASHERS_INFO.items()
+        ],
+        [
+            InlineKeyboardButton(
+                v + (" ✓" if memory[f"{level}{k}"] else ""), callback_data=f"{level}{k}"
+            )
+            for k, v in DRYERS_INFO.items()
+        ],
     ]
 
     text = f"""<b>[Level {level}]</b> Select which machines you'd like to be reminded when complete.
@@ -218,102 +205,189 @@ Send /done when you're done!"""
 
     # TO DO: If reminder has already been set, send a more meaningful message instead
 
+    sender = context.bot_data["sender"]
     if first_run:
-        message = context.bot.send_message(
-            update.effective_chat["id"],
+        message = await sender.send_message(
+            update.effective_chat.id,
             text,
             reply_markup=InlineKeyboardMarkup(layout),
-            parse_mode="HTML"
+            parse_mode="HTML",
         )
-        context.user_data['msg_id_reminder'] = message.message_id
+        context.user_data["msg_id_reminder"] = message.message_id
     else:
-        query.edit_message_reply_markup(
-            reply_markup=InlineKeyboardMarkup(layout)
+        sender.edit_message_reply_markup(
+            update.effective_chat.id,
+            query.message.message_id,
+            InlineKeyboardMarkup(layout),
         )
 
-    query.answer()
+    await query.answer()
     return SET_REMINDER
 
 
-def reminder_done(update, context) -> int:
+async def reminder_done(update, context) -> int:
 
-    memory = context.user_data['reminder_memory']
+    memory = context.user_data["reminder_memory"]
     user_id = update.effective_user.id
 
-    reminders = context.bot_data['reminders']
+    reminders = context.bot_data["reminders"]
     for k, v in memory.items():
         if v:
-            if k not in reminders:
-                reminders[k] = [user_id]
-    print(reminders)
-
+            reminders.subscribe(user_id, k)
 
-    context.bot.delete_message(update.effective_chat.id, context.user_data['msg_id_reminder'])
+    sender = context.bot_data["sender"]
+    chat_id = update.effective_chat.id
+    sender.delete_message(chat_id, context.user_data["msg_id_reminder"])
     if any(memory.values()):
-        update.message.reply_text("Okay! I'll remind you when machine's ready.")
+        sender.send_message(chat_id, "Okay! I'll remind you when machine's ready.")
     else:  # If the user did not tick any of the machines
-        update.message.reply_text("Hey you didn't pick any of the machines!")
+        sender.send_message(chat_id, "Hey you didn't pick any of the machines!")
 
     # Check machines now
-    check_reminders(context)
+    await check_reminders(context)
 
     return SHOWING
 
 
+def recheck_interval(bot_data):
+    """Machine events make polling a fallback, so it can be slow while they arrive"""
 
-def check_reminders(context):
-    """Fetch finishing machines from backend and remind relevant users"""
+    return FALLBACK_INTERVAL if bot_data["events"].connected else RECHECK_INTERVAL
 
-    reminders = context.bot_data["reminders"]
-    if len(reminders) == 0:
-        return
-
-    r = requests.get(BACKEND_URL)
-    # To actually change to get machines that are status=finishing
-    # r = requests.get(BACKEND_URL, params={})
-    all_machines = r.json()
 
+async def check_reminders(context):
+    """Check the machines which are due, and remind the users of those which are done.
 
-    text_template = "Wassup, machine {machine_name} is about to be done!"
+    Only machines someone is waiting for are checked, with one backend call per level.
+    While machine events arrive, reminders are sent from those (see on_machine_event),
+    and this only catches what they might have missed. Otherwise machines still running
+    are checked again when they are expected to finish."""
 
-    # Consider rewriting this part to loop through users first (so each user only gets one message even
-    # if user has multiple machines)
+    reminders = context.bot_data["reminders"]
+    due = reminders.due()
+    if not due:
+        return
 
-    for one in all_machines:
-        machine_id = one["id"]
-        if machine_id in reminders:
-            users_to_remind = reminders[machine_id]
-            for user in users_to_remind:
-                context.bot.send_message(
-                        chat_id=user,
-                        text=text_template.format(machine_name=str(machine_id))
-                )
-            print(f"I gotta send reminders to {reminders[machine_id]}")
+    now = time.time()
+    interval = recheck_interval(context.bot_data)
+    levels = sorted({int(machine.split(":")[0]) for machine in due})
+    results = await asyncio.gather(
+        *(context.bot_data["levels"].get(level) for level in levels),
+        return_exceptions=True,
+    )
+    machines = {}
+    for level, level_data in zip(levels, results):
+        if isinstance(level_data, Exception):
+            logging.error(
+                f"Could not fetch level {level}, checking its machines later: {level_data!r}"
+            )
+            continue
+        for k, info in machines_by_key(level_data).items():
+            machines[f"{level}{k}"] = info
+
+    done = []
+    for machine in due:
+        info = machines.get(machine)
+        if info is not None and info["status"] in DONE_STATUSES:
+            done.append(machine)
+        elif (
+            info is not None
+            and info["status"] == "in_use"
+            and interval == RECHECK_INTERVAL
+        ):
+            reminders.schedule(machine, max(expected_finish(info), now + interval))
+        else:
+            reminders.schedule(machine, now + interval)
+
+    send_reminders(context.bot_data["sender"], reminders.fire(done))
+
+
+async def on_machine_event(application, machine):
+    """Remind users as soon as the backend says a machine they are waiting for is done"""
+
+    application.bot_data["levels"].invalidate(machine["floor"])
+
+    key = machine_keys.get((machine["floor"], machine["pos"]))
+    reminders = application.bot_data["reminders"]
+    if key is None or key not in reminders:
+        return
+    if machine["status"] not in DONE_STATUSES:
+        reminders.schedule(key, time.time() + FALLBACK_INTERVAL)
+        return
 
-    # Also remove entry from dict once reminder is sent
+    send_reminders(application.bot_data["sender"], reminders.fire([key]))
 
 
+def send_reminders(sender, by_user):
+    """One message per user, listing all of their machines which are done.
 
+    They are queued ahead of everything else the bot is sending, see Sender."""
 
+    for user, finished in by_user.items():
+        names = [machine_name(m) for m in sorted(finished)]
+        if len(names) == 1:
+            text = f"Wassup, {names[0]} is about to be done!"
+        else:
+            text = "Wassup, these machines are about to be done:\n" + "\n".join(
+                f"- {n}" for n in names
+            )
+        sender.send_message(user, text, priority=Priority.REMINDER)
+        logging.info(f"Reminding {user} of {finished}")
 
 
-def err(update, context):
+async def err(update, context):
     """The error handler. If an error occurs, this function will be called"""
 
     traceback.print_exc()
 
 
-def cancel(update: Update, _: CallbackContext) -> int:
+async def cancel(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     # Placeholder function
 
     pass
 
 
+async def post_init(application: Application) -> None:
+    """Set up what the handlers share, once the event loop is running"""
+
+    bot_data = application.bot_data
+    # Every message the bot sends goes through one queue, paced to Telegram's flood limits
+    bot_data["sender"] = sender = Sender(application.bot)
+    sender.start()
+    bot_data["backend"] = backend = Backend(
+        BACKEND_URL, max_in_flight=MAX_BACKEND_CALLS
+    )
+    # Everyone looking at a level shares one backend call per LEVEL_CACHE_TTL
+    bot_data["levels"] = LevelCache(backend.level, ttl=LEVEL_CACHE_TTL)
+    bot_data["reminders"] = Reminders()
+    # Machine state changes are pushed to the bot, see on_machine_event
+    bot_data["events"] = events = MachineEvents(
+        backend.client,
+        backend.url + "/events",
+        partial(on_machine_event, application),
+    )
+    events.start()
+
+
+async def post_shutdown(application: Application) -> None:
+    await application.bot_data["events"].stop()
+    await application.bot_data["backend"].close()
+    await application.bot_data["sender"].stop()
+
+
 def main() -> None:
     """Start the bot."""
 
-    updater = Updater(API_KEY)
-    dispatcher = updater.dispatcher
+    # Updates are handled concurrently, so one slow backend call only holds up the user
+    # who made it. Backend calls are pooled and limited, see Backend.
+    application = (
+        Application.builder()
+        .token(API_KEY)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     top_conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -331,20 +405,20 @@ def main() -> None:
                 CommandHandler("done", reminder_done),
             ],
         },
-
-        fallbacks=[CommandHandler("cancel", cancel), CallbackQueryHandler(level_status, pattern="refresh")],
+        fallbacks=[
+            CommandHandler("cancel", cancel),
+            CallbackQueryHandler(level_status, pattern="refresh"),
+        ],
     )
 
-    dispatcher.add_handler(top_conv)
-    dispatcher.add_error_handler(err)
+    application.add_handler(top_conv)
+    application.add_error_handler(err)
 
-    # Other custom initialisation required
-    dispatcher.bot_data["reminders"] = {}
-    dispatcher.job_queue.run_repeating(check_reminders, 30, 10)  # Check every 30 seconds (just for testing)
+    # Cheap unless a machine is due
+    application.job_queue.run_repeating(check_reminders, CHECK_INTERVAL, 10)
 
     # Start the Bot
-    updater.start_polling()
-    updater.idle()
+    application.run_polling()
 
 
 if __name__ == "__main__":